@@ -20,7 +20,7 @@ if (require('electron-squirrel-startup') || isSquirrel) {
 }
 
 import { ManuScrapeController } from './controller';
-import { ensurePythonAvail } from './helpers/pythonBridge';
+import { ensurePythonAvail, startChatJoinerServer, stopChatJoinerServer } from './helpers/pythonBridge';
 import { createTrayWindow } from './helpers/browserWindows';
 import { warnIfEncryptionUnavailable } from './helpers/utils';
 import { ensureFfmpegAvail } from './helpers/ffmpegBridge';
@@ -46,6 +46,7 @@ app.whenReady().then(() => {
 
   app.on('will-quit', () => {
     globalShortcut.unregisterAll();
+    stopChatJoinerServer();
   })
 
   // ensure compiled python executable is available
@@ -53,6 +54,9 @@ app.whenReady().then(() => {
   // NOTE: to compile the python part of the app, read the docs ;)
   ensurePythonAvail();
 
+  // start the python utilities in server mode, so they are warm for the first scrollshot
+  startChatJoinerServer();
+
   // ensure ffmpeg binaries are available
   ensureFfmpegAvail();
 
@@ -1,7 +1,9 @@
 import path from 'path';
 import { app } from 'electron';
 import fs from 'node:fs';
-import { spawn } from 'node:child_process'
+import os from 'node:os';
+import readline from 'node:readline';
+import { spawn, ChildProcessWithoutNullStreams } from 'node:child_process'
 
 function getChatJoinerPath(): string {
     const isWindows = process.platform === 'win32'
@@ -25,14 +27,96 @@ export function ensurePythonAvail(): void {
 }
 
 
+interface IChatJoinerResponse {
+    id: number;
+    status: 'ok' | 'error';
+    output_filename?: string;
+    output_filenames?: string[];
+    error?: string;
+    elapsed: number;
+    // per-stage and per-pair timings, see python/src/profiling.py
+    profile?: object;
+}
+
+// long-lived chatjoiner process started with --serve
+// NOTE: keeps python imports and worker processes warm between scrollshots
+let chatJoinerServer: ChildProcessWithoutNullStreams | null = null;
+let nextRequestId = 0;
+let pendingRequests: Record<number, (response: IChatJoinerResponse) => void> = {};
+
+function getChatJoinerServer(): ChildProcessWithoutNullStreams {
+    if (chatJoinerServer) {
+        return chatJoinerServer;
+    }
+
+    const server = spawn(getChatJoinerPath(), ['--serve']);
+    console.info('started chatjoiner server');
+
+    // every line on stdout is a json response to one request
+    readline.createInterface({ input: server.stdout }).on('line', (line: string) => {
+        let response: IChatJoinerResponse;
+        try {
+            response = JSON.parse(line);
+        } catch (err) {
+            console.info(line);
+            return;
+        }
+        const resolveRequest = pendingRequests[response.id];
+        delete pendingRequests[response.id];
+        if (resolveRequest) {
+            resolveRequest(response);
+        }
+    });
+
+    server.stderr.on("data", (data: string) => {
+        console.error(`stderr: ${data}`);
+    });
+
+    server.on("close", (code: number) => {
+        console.info('chatjoiner server exited with code', code);
+        chatJoinerServer = null;
+
+        // fail all requests that did not get a response
+        const unanswered = pendingRequests;
+        pendingRequests = {};
+        Object.keys(unanswered).forEach((id) => {
+            unanswered[Number(id)]({
+                id: Number(id),
+                status: 'error',
+                error: 'chatjoiner server exited',
+                elapsed: 0,
+            });
+        });
+    });
+
+    chatJoinerServer = server;
+    return server;
+}
+
+export function startChatJoinerServer(): void {
+    getChatJoinerServer();
+}
+
+export function stopChatJoinerServer(): void {
+    if (chatJoinerServer) {
+        // the server stops when stdin is closed
+        chatJoinerServer.stdin.end();
+    }
+}
+
+// file written to the images directory when all images are written
+// NOTE: only used when joining while the images are captured
+export const chatJoinerDoneMarker = 'done';
+
 export function joinImagesVertically(
     imagesDir: string,
     outputPath: string,
     settings: ScrollshotSettings,
+    watch: boolean = false,
 ): Promise<void> {
     console.log('starting to join images...');
     return new Promise((resolve, reject) => {
-        const chatjoinerPath = getChatJoinerPath();
+        const server = getChatJoinerServer();
 
         const beginTime = new Date().getTime();
         const args = [
@@ -55,30 +139,46 @@ export function joinImagesVertically(
             '' + settings.rightCropTo,
             '-o',
             outputPath,
+            // stream the png in strips instead of building the whole image
+            '--output_strip_height',
+            '1024',
+            // compress the png strips in parallel
+            '--encode_workers',
+            '' + Math.min(4, os.cpus().length),
+            // reuse the crop boundary of earlier scrollshots of the same window
+            '--boundary_cache',
+            path.join(app.getPath('userData'), 'boundary_cache.json'),
+            '--boundary_scale',
+            '4',
+            // keep the composite on disk, so long scrollshots do not grow memory
+            '--work_dir',
+            path.join(app.getPath('temp'), 'chatjoiner'),
         ];
-        const python = spawn(chatjoinerPath, args);
+        if (watch) {
+            args.push('--watch', '--done_marker', chatJoinerDoneMarker);
+        }
+        // profiling traces memory allocations, which slows down the join
+        if (settings.profileJoins) {
+            args.push('--profile');
+        }
 
-        const debugCmd = chatjoinerPath + args.join(' ');
-        console.info('> ' + debugCmd)
-    
-        python.stdout.on("data", function (data: string) {
-            console.info(data)
-        });
-    
-        python.stderr.on("data", (data: string) => {
-            console.error(`stderr: ${data}`);
-            console.log(`stderr: ${data}`);
-        }); 
-    
-        python.on("close", (code: number) => {
-            console.info('python program exited with code', code);
-            if (code === 0) {
+        const id = nextRequestId++;
+        console.info('> chatjoiner request ' + id + ': ' + args.join(' '));
+
+        pendingRequests[id] = (response: IChatJoinerResponse) => {
+            if (response.profile) {
+                console.info('chatjoiner profile:', JSON.stringify(response.profile));
+            }
+            if (response.status === 'ok') {
                 console.log('saved result image:', outputPath);
                 console.log('python program took', ((new Date().getTime() - beginTime) / 1000).toFixed(2) + 's')
                 resolve();
             } else {
+                console.error('chatjoiner request failed:', response.error);
                 reject();
             }
-        });
+        };
+
+        server.stdin.write(JSON.stringify({ id, args }) + '\n');
     })
-}
\ No newline at end of file
+}
@@ -1,7 +1,7 @@
 import { desktopCapturer, app, Notification, ipcMain, globalShortcut, BrowserWindow } from 'electron';
 import path from 'path';
 import { sleepAsync } from './utils';
-import { joinImagesVertically } from './pythonBridge';
+import { chatJoinerDoneMarker, joinImagesVertically } from './pythonBridge';
 import { cropVideoFile } from './ffmpegBridge';
 import { errorIcon } from './icons';
 import { blockhashData, hammingDistance } from './blockhash-js';
@@ -183,76 +183,88 @@ export async function scrollScreenshot(
   let lastImageHash = null;
   let totalScreenshots = 0;
 
+  const screenshotsPath = path.join(getTempPath(), dirname);
+
   // change shortcut so it saves instead of initiating a scrollshot
   globalShortcut.unregister('Alt+S');
   globalShortcut.register('Alt+S', () => userIsDone = true);
 
-  // run loop until canceled/finished by user or maximum screenshots reached
-  while (totalScreenshots < maxScreenshots && !isCancelled()) {
-    if (isCancelled()) {
-      // TODO: cleanup files etc
-      throw new Error('Cancelled');
-    }
-
-    // get time before screenshot is taken
-    // NOTE: this is used further down to determine how long to wait between each loop cycle
-    const beforeCapture = new Date().getTime();
-
-    // capture, decode and hash image
-    const { source, buffer } = await captureScreenshot(
-      area,
-      display,
-      displayIndex);
-    const data = jpeg.decode(buffer);
-    const imageHash = blockhashData(data, 128, 2);
-
-
-    // get the distance to the last image captured
-    let imageDiff;
-    if (lastImageHash) {
-      imageDiff = hammingDistance(imageHash, lastImageHash);
-    }
+  // create directory for the joined image
+  fs.mkdirSync(resultImageDir, { recursive: true });
 
-    // update the last image captured hash to the new one
-    lastImageHash = imageHash;
-
-    // get time after capture is done and measure how long it took
-    const afterCapture = new Date().getTime();
-    const captureTookMs = beforeCapture - afterCapture;
-
-    // calculate the delay to wait based on howLong
-    const delay = Math.max(0, captureTookMs + minimumCaptureDelay);
-
-    // decide what to do in different scenarios
-    if (userIsDone || repeatedScreenshots > maxRepeatedScreenshots) {
-      // is max screenshots are reached or user finished the scrollshots, break loop
-      break;
-    } else if (!lastImageHash || (imageDiff && imageDiff > hammeringDiffThreshold)) {
-      // if first image or hammer distance is above threshold, save screenshot and update state
-      repeatedScreenshots = 0;
-      lastSavePath = await saveScreenshot(source.name, buffer, dirname);
-      totalScreenshots++;
-    } else {
-      repeatedScreenshots++;
+  // start joining the images while they are captured
+  // NOTE: rejections are handled when the result is awaited further down
+  const joinResult = joinImagesVertically(
+    screenshotsPath,
+    resultImagePath,
+    settings,
+    true,
+  );
+  joinResult.catch(() => {});
+
+  try {
+    // run loop until canceled/finished by user or maximum screenshots reached
+    while (totalScreenshots < maxScreenshots && !isCancelled()) {
+      if (isCancelled()) {
+        // TODO: cleanup files etc
+        throw new Error('Cancelled');
+      }
+
+      // get time before screenshot is taken
+      // NOTE: this is used further down to determine how long to wait between each loop cycle
+      const beforeCapture = new Date().getTime();
+
+      // capture, decode and hash image
+      const { source, buffer } = await captureScreenshot(
+        area,
+        display,
+        displayIndex);
+      const data = jpeg.decode(buffer);
+      const imageHash = blockhashData(data, 128, 2);
+
+
+      // get the distance to the last image captured
+      let imageDiff;
+      if (lastImageHash) {
+        imageDiff = hammingDistance(imageHash, lastImageHash);
+      }
+
+      // update the last image captured hash to the new one
+      lastImageHash = imageHash;
+
+      // get time after capture is done and measure how long it took
+      const afterCapture = new Date().getTime();
+      const captureTookMs = beforeCapture - afterCapture;
+
+      // calculate the delay to wait based on howLong
+      const delay = Math.max(0, captureTookMs + minimumCaptureDelay);
+
+      // decide what to do in different scenarios
+      if (userIsDone || repeatedScreenshots > maxRepeatedScreenshots) {
+        // is max screenshots are reached or user finished the scrollshots, break loop
+        break;
+      } else if (!lastImageHash || (imageDiff && imageDiff > hammeringDiffThreshold)) {
+        // if first image or hammer distance is above threshold, save screenshot and update state
+        repeatedScreenshots = 0;
+        lastSavePath = await saveScreenshot(source.name, buffer, dirname);
+        totalScreenshots++;
+      } else {
+        repeatedScreenshots++;
+      }
+
+      // sleep the calculated delay to keep fixed delay between screenshots
+      await sleepAsync(delay);
     }
-
-    // sleep the calculated delay to keep fixed delay between screenshots
-    await sleepAsync(delay);
+  } finally {
+    // tell the python utilities that all images are written
+    fs.mkdirSync(screenshotsPath, { recursive: true });
+    fs.writeFileSync(path.join(screenshotsPath, chatJoinerDoneMarker), '');
   }
 
-  // create directory for the joined image
-  fs.mkdirSync(resultImageDir, { recursive: true });
-
   // if there are more than one screenshot, join the images to one big and return path
   if (totalScreenshots > 1) {
-    const screenshotsPath = path.join(getTempPath(), dirname);
-
     try {
-      await joinImagesVertically(
-        screenshotsPath,
-        resultImagePath,
-        settings,
-      );
+      await joinResult;
       return resultImagePath;
     } catch (err) {
       new Notification({
@@ -9,6 +9,7 @@ const defaultScrollshotSettings: ScrollshotSettings = {
   rightCropFrom: 20,
   rightCropTo: 200,
   matchScoreThreshold: 0.10,
+  profileJoins: false,
 };
 
 export const defaultSettings: ISettings = {
@@ -17,6 +18,7 @@ export const defaultSettings: ISettings = {
 
 const isNumber = (n: any) => typeof n === 'number' && !isNaN(n);
 const isBetween = (n: number, min: number, max: number) => n > min && n < max;
+const isBoolean = (b: any) => typeof b === 'boolean';
 
 const ScrollshotSettingsValidate: Record<keyof ScrollshotSettings, (val: any) => boolean> = {
   rowsPrCrop: (n) => isNumber(n) && isBetween(n, 0, 1000),
@@ -27,6 +29,7 @@ const ScrollshotSettingsValidate: Record<keyof ScrollshotSettings, (val: any) =>
   rightCropFrom: (n) => isNumber(n) && isBetween(n, 0, 1000),
   rightCropTo: (n) => isNumber(n) && isBetween(n, 0, 1000),
   matchScoreThreshold: (n) => isNumber(n) && isBetween(n, 0, 1),
+  profileJoins: (b) => isBoolean(b),
 }
 
 
@@ -38,6 +38,8 @@ declare global {
     rightCropFrom: number;
     rightCropTo: number;
     matchScoreThreshold: number;
+    // log a profile of the time and memory of each join (for debugging)
+    profileJoins?: boolean;
   }
 
   interface ISettings {
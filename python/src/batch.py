@@ -0,0 +1,116 @@
+"""
+Batch mode of the chat joiner. Joins every scrollshot folder in an archive
+folder in one run, with a pool of worker processes that each join one folder
+at a time, so the startup of a process is paid once per worker instead of once
+per folder.
+
+Each subfolder of the archive folder is joined into
+<output_folder>/<subfolder>.<output_extension>. The response of each folder is
+written as a JSON line to stdout, in the format of server.py, with the name of
+the folder as id. Unknown arguments are passed on to the joiner of every
+folder, see main.py.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Tuple
+
+import main
+import server
+
+
+def find_scrollshot_folders(archive_folder: str) -> List[str]:
+    """
+    Find the names of the scrollshot folders in an archive folder, sorted.
+    """
+    return sorted(name for name in os.listdir(archive_folder)
+                  if os.path.isdir(os.path.join(archive_folder, name)))
+
+
+def create_job_argv(batch_args: argparse.Namespace,
+                    join_argv: List[str],
+                    name: str) -> List[str]:
+    """
+    Create the arguments of the join of the scrollshot folder of the given name.
+    """
+    output_filename = os.path.join(batch_args.output_folder,
+                                   f"{name}.{batch_args.output_extension}")
+    return [os.path.join(batch_args.archive_folder, name),
+            "-o", output_filename] + join_argv
+
+
+def run_folder(name: str, argv: List[str]) -> dict:
+    """
+    Join a single scrollshot folder and return its response.
+    """
+    return server.run_request(name, argv, main.run_job)
+
+
+def run_batch(batch_args: argparse.Namespace,
+              join_argv: List[str]) -> Iterator[dict]:
+    """
+    Join every scrollshot folder in the archive folder, and yield the response
+    of each folder in the order of the folders.
+    """
+    names = find_scrollshot_folders(batch_args.archive_folder)
+    jobs: List[Tuple[str, List[str]]] = [
+        (name, create_job_argv(batch_args, join_argv, name)) for name in names]
+    os.makedirs(batch_args.output_folder, exist_ok=True)
+    logging.info(f"Joining {len(jobs)} folders with "
+                 + f"{batch_args.batch_workers} workers")
+
+    if batch_args.batch_workers <= 1:
+        for name, argv in jobs:
+            yield run_folder(name, argv)
+        return
+
+    with ProcessPoolExecutor(max_workers=batch_args.batch_workers) as executor:
+        yield from executor.map(run_folder, *zip(*jobs))
+
+
+def parse_args() -> Tuple[argparse.Namespace, List[str]]:
+    parser = argparse.ArgumentParser(
+                prog="Chat-joiner batch",
+                allow_abbrev=False,
+                description="join every scrollshot folder in an archive folder. "
+                            + "Unknown arguments are passed on to the joiner, "
+                            + "see main.py.")
+    parser.add_argument("archive_folder",
+                        help="Folder of scrollshot folders, one per scrollshot.")
+    parser.add_argument("--output_folder", action="store", required=True,
+                        help="Folder to write the joined images to.")
+    parser.add_argument("--output_extension", action="store", default="png",
+                        help="Extension of the joined images, which sets their "
+                             + "format unless --output_format is given.")
+    parser.add_argument("--batch_workers", action="store", type=int,
+                        default=os.cpu_count(),
+                        help="How many folders to join at the same time, each in "
+                             + "its own process. Leave --workers at 1 when using "
+                             + "more than one batch worker.")
+    return parser.parse_known_args()
+
+
+def batch() -> int:
+    batch_args, join_argv = parse_args()
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d - %(levelname)s %(message)s',
+                        level=logging.WARNING,
+                        datefmt="%I:%M:%S")
+
+    n_failed = 0
+    for response in run_batch(batch_args, join_argv):
+        if response["status"] != "ok":
+            n_failed += 1
+        sys.stdout.write(json.dumps(response) + "\n")
+        sys.stdout.flush()
+
+    if n_failed:
+        logging.warning(f"{n_failed} folders failed to join")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(batch())
@@ -0,0 +1,439 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List, NamedTuple, Tuple
+
+import numpy as np
+import chat_joiner as cj
+import main
+import profiling
+import image_utils.image_features as ifeat
+import image_utils.image_io as iio
+import image_utils.image_matching as im
+import image_utils.image_matching_jit as imjit
+import image_utils.image_processing as ip
+
+
+class SyntheticScrollshot(NamedTuple):
+    """
+    Frames of a synthetic scrollshot, in capture order, and the offsets and
+    column shifts that joining them should recover, in joining order (top to
+    bottom).
+    """
+    frames: List[np.ndarray]
+    offsets: np.ndarray
+    direction: str
+    column_shifts: np.ndarray
+
+
+def generate_chat_image(height: int, width: int, rng: np.random.Generator
+                        ) -> np.ndarray:
+    """
+    Generate a tall chat-like image: message bubbles on alternating sides, each
+    holding lines of random glyph-like text.
+    """
+    image = np.full((height, width, 3), 245, dtype=np.uint8)
+    row = 0
+    side = 0
+    while row < height:
+        n_lines = int(rng.integers(1, 5))
+        bubble_height = 6 + n_lines * 14
+        bubble_width = int(rng.integers(width // 4, width * 3 // 4))
+        left = 10 if side == 0 else width - 10 - bubble_width
+        color = (220, 230, 250) if side == 0 else (200, 240, 200)
+        image[row:row + bubble_height, left:left + bubble_width] = color
+
+        for line in range(n_lines):
+            line_row = row + 6 + line * 14
+            line_width = int(rng.integers(bubble_width // 2, bubble_width - 10))
+            glyphs = rng.random((9, line_width)) < 0.35
+            text = image[line_row:line_row + 9, left + 5:left + 5 + line_width]
+            text[glyphs[:text.shape[0], :text.shape[1]]] = (30, 30, 30)
+
+        row += bubble_height + int(rng.integers(4, 10))
+        side = 1 - side
+    return image
+
+
+def generate_scrollshot(n_frames: int,
+                        frame_height: int,
+                        frame_width: int,
+                        scroll_step: int,
+                        scroll_jitter: int,
+                        border: int,
+                        direction: str,
+                        seed: int,
+                        noise: float = 0.0,
+                        column_jitter: int = 0
+                        ) -> SyntheticScrollshot:
+    """
+    Generate a deterministic synthetic scrollshot. A tall chat image is sliced into
+    n_frames overlapping frames of frame_height x frame_width pixels, each scrolled
+    scroll_step +- scroll_jitter rows from the one before, and framed by a fixed
+    window border of border pixels with a title bar at the top. If noise is set,
+    gaussian noise with that standard deviation is added to the content of each
+    frame, like the artifacts of a lossy capture. If column_jitter is set, the
+    content of each frame is also shifted sideways by up to column_jitter columns,
+    like a window that moved while it was captured.
+    """
+    rng = np.random.default_rng(seed)
+    steps = scroll_step + rng.integers(-scroll_jitter, scroll_jitter + 1,
+                                       n_frames - 1)
+    positions = np.concatenate(([0], np.cumsum(steps)))
+    content_height = frame_height - 2 * border
+    content_width = frame_width - 2 * border
+    chat_image = generate_chat_image(int(positions[-1]) + content_height,
+                                     content_width + 2 * column_jitter, rng)
+
+    window = np.full((frame_height, frame_width, 3), 60, dtype=np.uint8)
+    title_bar = rng.integers(0, 256, (border, content_width, 3), dtype=np.uint8)
+    window[:border, border:border + content_width] = title_bar
+    columns = np.full(n_frames, column_jitter)
+    if column_jitter > 0:
+        columns = rng.integers(0, 2 * column_jitter + 1, n_frames)
+
+    frames = []
+    for position, column in zip(positions, columns):
+        frame = window.copy()
+        content = chat_image[position:position + content_height,
+                             column:column + content_width]
+        if noise > 0:
+            content = content + rng.normal(0, noise, content.shape)
+            content = np.clip(np.rint(content), 0, 255).astype(np.uint8)
+        frame[border:border + content_height, border:border + content_width] = content
+        frames.append(frame)
+
+    if direction == "up":
+        frames = frames[::-1]
+    return SyntheticScrollshot(frames, steps, direction, np.diff(columns))
+
+
+def write_scrollshot(scrollshot: SyntheticScrollshot, folder: str):
+    """
+    Write the frames of a scrollshot to a folder, named in capture order.
+    """
+    for i, frame in enumerate(scrollshot.frames):
+        iio.write_npimage_to_file(frame, os.path.join(folder, f"frame_{i:04d}.png"))
+
+
+def run_stages(args: argparse.Namespace) -> Tuple[Dict[str, float], cj.MatchedSeries]:
+    """
+    Join args.input_folder with main.join_chats_series under a profiler, without
+    tracing memory. Returns the wall time of each stage in the order they were
+    run, and the matched series.
+    """
+    profiler = profiling.Profiler(True, trace_memory=False)
+    series, _ = main.join_chats_series(args, profiler)
+    timings = {}
+    for stage in profiler.report()["stages"]:
+        timings[stage["stage"]] = timings.get(stage["stage"], 0.0) + stage["wall_time"]
+    return timings, series
+
+
+def find_expected_shifts(scrollshot: SyntheticScrollshot,
+                         series: cj.MatchedSeries
+                         ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the offsets and column shifts that the pairs of a matched series of a
+    scrollshot should have. The series may have dropped frames, such as with
+    --decimate, in which case the shifts of a pair add up those of the frames
+    between them.
+    """
+    n_frames = len(scrollshot.frames)
+    joining_indices = series.frame_indices if scrollshot.direction == "down" \
+        else n_frames - 1 - series.frame_indices
+    row_positions = np.concatenate([[0], np.cumsum(scrollshot.offsets)])
+    column_positions = np.concatenate([[0], np.cumsum(scrollshot.column_shifts)])
+    return (np.diff(row_positions[joining_indices]),
+            np.diff(column_positions[joining_indices]))
+
+
+def run_benchmark(bench_args: argparse.Namespace, join_argv: List[str]) -> dict:
+    """
+    Generate a synthetic scrollshot, run the stages on it bench_args.repeat times
+    and check the recovered offsets. Returns the report of the run, holding the
+    best time of each stage over the repeats.
+    """
+    scrollshot = generate_scrollshot(bench_args.n_frames,
+                                     bench_args.frame_height,
+                                     bench_args.frame_width,
+                                     bench_args.scroll_step,
+                                     bench_args.scroll_jitter,
+                                     bench_args.border,
+                                     bench_args.direction,
+                                     bench_args.seed,
+                                     bench_args.noise,
+                                     bench_args.column_jitter)
+
+    with tempfile.TemporaryDirectory() as folder:
+        frames_folder = os.path.join(folder, "frames")
+        os.makedirs(frames_folder)
+        write_scrollshot(scrollshot, frames_folder)
+        args = main.parse_args([frames_folder, "-o", os.path.join(folder, "out.png")]
+                               + join_argv)
+
+        best_timings = {}
+        for _ in range(bench_args.repeat):
+            timings, series = run_stages(args)
+            for stage, seconds in timings.items():
+                best_timings[stage] = min(seconds, best_timings.get(stage, np.inf))
+
+    expected_offsets, expected_column_shifts = find_expected_shifts(scrollshot, series)
+    offsets_correct = np.array_equal(series.offsets, expected_offsets) \
+        and np.array_equal(series.column_shifts, expected_column_shifts)
+    return {
+        "scrollshot": {key: value for key, value in vars(bench_args).items()
+                       if key not in ("repeat", "json", "precision_study",
+                                      "study_seeds")},
+        "timings": {stage: round(seconds, 6) for stage, seconds in best_timings.items()},
+        "total": round(sum(best_timings.values()), 6),
+        "offsets_correct": bool(offsets_correct),
+        "expected_offsets": expected_offsets.tolist(),
+        "recovered_offsets": series.offsets.tolist(),
+        "expected_column_shifts": expected_column_shifts.tolist(),
+        "recovered_column_shifts": series.column_shifts.tolist(),
+    }
+
+
+def build_scrollshot_pyramid(args: argparse.Namespace,
+                             scrollshot: SyntheticScrollshot
+                             ) -> ifeat.FeaturePyramid:
+    """
+    Build the search pyramid of a scrollshot in memory, with the stages of
+    join_chats up to matching, in the scroll direction.
+    """
+    frames = scrollshot.frames
+    filter_frame = ip.create_npimage_filter(frames[-1], frames[0], args.denoising_factor)
+    crop_indices = ip.find_frame_boundary_of_npimage_filter(filter_frame)
+    crop_images = ip.crop_images_by_indices(frames, crop_indices)
+    crop_images = [crop_images[i]
+                   for i in ip.find_distinct_crop_images(crop_images,
+                                                         args.duplicate_threshold)]
+    features = ifeat.compute_frame_features(crop_images,
+                                            args.n_cols_in_crop,
+                                            args.left_crop_from,
+                                            args.left_crop_to,
+                                            args.right_crop_from,
+                                            args.right_crop_to,
+                                            args.precision)
+    pyramid = im.build_search_pyramid(args, features)
+    if im.get_crop_direction(args, pyramid) == "up":
+        pyramid = ifeat.reverse_feature_pyramid(pyramid)
+    return pyramid
+
+
+def compute_scrollshot_match_scores(args: argparse.Namespace,
+                                    scrollshot: SyntheticScrollshot
+                                    ) -> List[np.ndarray]:
+    """
+    Compute the match scores of every image pair of a scrollshot in memory, with
+    the stages of join_chats up to matching.
+    """
+    return im.compute_pairwise_match_scores(args, build_scrollshot_pyramid(args,
+                                                                           scrollshot))
+
+
+def generate_study_corpus(bench_args: argparse.Namespace) -> List[SyntheticScrollshot]:
+    """
+    Generate the corpus of the studies: synthetic scrollshots of
+    bench_args.study_seeds seeds, scrolled down and up, with and without noise.
+    """
+    return [generate_scrollshot(bench_args.n_frames, bench_args.frame_height,
+                                bench_args.frame_width, bench_args.scroll_step,
+                                bench_args.scroll_jitter, bench_args.border,
+                                direction, seed, noise)
+            for seed in range(bench_args.study_seeds)
+            for direction in ["down", "up"]
+            for noise in [0.0, max(bench_args.noise, 3.0)]]
+
+
+def run_precision_study(bench_args: argparse.Namespace, join_argv: List[str]) -> dict:
+    """
+    Compare the match scores of each precision to those of float64 on a corpus of
+    synthetic scrollshots of bench_args.study_seeds seeds, scrolled down and up,
+    with and without noise. The exact match fast path is disabled, so every
+    offset is scored. Returns, for each precision, how many of the best offsets
+    differ from float64 and from the generated offsets, and the largest
+    difference of a match score from float64.
+    """
+    corpus = generate_study_corpus(bench_args)
+
+    reference_scores = []
+    report = {}
+    for precision in ifeat.PRECISION_DTYPES:
+        args = main.parse_args(["synthetic", "--no-exact_match", "--precision", precision]
+                               + join_argv)
+        n_pairs = n_offsets_changed = n_offsets_wrong = 0
+        max_score_difference = 0.0
+        for i, scrollshot in enumerate(corpus):
+            match_scores = np.array(compute_scrollshot_match_scores(args, scrollshot))
+            if precision == "float64":
+                reference_scores.append(match_scores)
+            # Pyramid search may score different offsets in each precision
+            searched = np.isfinite(match_scores) & np.isfinite(reference_scores[i])
+
+            offsets = np.argmin(match_scores, axis=1)
+            n_pairs += len(offsets)
+            n_offsets_changed += np.count_nonzero(
+                offsets != np.argmin(reference_scores[i], axis=1))
+            n_offsets_wrong += np.count_nonzero(offsets != scrollshot.offsets)
+            max_score_difference = max(max_score_difference, float(np.max(
+                np.abs(match_scores[searched] - reference_scores[i][searched]))))
+
+        report[precision] = {
+            "pairs": n_pairs,
+            "offsets_changed": int(n_offsets_changed),
+            "offsets_wrong": int(n_offsets_wrong),
+            "max_score_difference": max_score_difference,
+        }
+    return report
+
+
+def run_kernel_study(bench_args: argparse.Namespace, join_argv: List[str]) -> dict:
+    """
+    Compare the match scores of the compiled kernels to those of the numpy
+    functions on the corpus of the precision study, in the search mode given in
+    join_argv. The exact match fast path is disabled, so every pair is scored.
+    Returns, for each kernel, how many of the best offsets differ from numpy, the
+    largest difference of a match score from numpy, and the best time of
+    matching all pairs of the corpus over bench_args.repeat runs.
+    """
+    corpus = generate_study_corpus(bench_args)
+    kernels = ["numpy", "numba"] if imjit.AVAILABLE else ["numpy"]
+
+    reference_scores = []
+    report = {}
+    for kernel in kernels:
+        args = main.parse_args(["synthetic", "--no-exact_match", "--kernel", kernel]
+                               + join_argv)
+        pyramids = [build_scrollshot_pyramid(args, scrollshot) for scrollshot in corpus]
+        # The first run also compiles the kernels
+        im.compute_pairwise_match_scores(args, pyramids[0])
+        matching_time = np.inf
+        for _ in range(bench_args.repeat):
+            begin_time = time.perf_counter()
+            corpus_scores = [np.array(im.compute_pairwise_match_scores(args, pyramid))
+                             for pyramid in pyramids]
+            matching_time = min(matching_time, time.perf_counter() - begin_time)
+        if kernel == "numpy":
+            reference_scores = corpus_scores
+
+        n_pairs = n_offsets_changed = 0
+        max_score_difference = 0.0
+        for match_scores, numpy_scores in zip(corpus_scores, reference_scores):
+            searched = np.isfinite(match_scores) & np.isfinite(numpy_scores)
+            n_pairs += len(match_scores)
+            n_offsets_changed += np.count_nonzero(np.argmin(match_scores, axis=1)
+                                                  != np.argmin(numpy_scores, axis=1))
+            max_score_difference = max(max_score_difference, float(np.max(
+                np.abs(match_scores[searched] - numpy_scores[searched]))))
+
+        report[kernel] = {
+            "pairs": n_pairs,
+            "offsets_changed": int(n_offsets_changed),
+            "max_score_difference": max_score_difference,
+            "matching_time": round(matching_time, 6),
+        }
+    return report
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+                prog="Chat-joiner benchmarks",
+                allow_abbrev=False,
+                description="time each stage of joining a synthetic scrollshot. "
+                            + "Unknown arguments are passed on to the joiner, "
+                            + "see main.py.")
+    parser.add_argument("--n_frames", action="store", type=int, default=30,
+                        help="How many frames to generate.")
+    parser.add_argument("--frame_height", action="store", type=int, default=900,
+                        help="Height of each frame, including the border.")
+    parser.add_argument("--frame_width", action="store", type=int, default=800,
+                        help="Width of each frame, including the border.")
+    parser.add_argument("--scroll_step", action="store", type=int, default=120,
+                        help="How many rows the content scrolls between frames.")
+    parser.add_argument("--scroll_jitter", action="store", type=int, default=20,
+                        help="How many rows the scroll step varies by at most.")
+    parser.add_argument("--border", action="store", type=int, default=40,
+                        help="Width of the fixed window border around the content.")
+    parser.add_argument("--direction", action="store", default="down",
+                        choices=["down", "up"], help="Scroll direction.")
+    parser.add_argument("--seed", action="store", type=int, default=0,
+                        help="Seed of the generator.")
+    parser.add_argument("--noise", action="store", type=float, default=0.0,
+                        help="Standard deviation of the noise added to the content "
+                             + "of each frame.")
+    parser.add_argument("--column_jitter", action="store", type=int, default=0,
+                        help="How many columns the content of each frame is "
+                             + "shifted sideways by at most. Only recovered with "
+                             + "--search_mode phase.")
+    parser.add_argument("--precision_study", action="store_true", default=False,
+                        help="Instead of timing the stages, compare the best offsets "
+                             + "and match scores of each --precision to float64.")
+    parser.add_argument("--kernel_study", action="store_true", default=False,
+                        help="Instead of timing the stages, compare the best offsets, "
+                             + "match scores and matching time of the compiled "
+                             + "kernels to the numpy functions.")
+    parser.add_argument("--study_seeds", action="store", type=int, default=5,
+                        help="In the precision and kernel studies, how many seeds "
+                             + "to generate scrollshots of.")
+    parser.add_argument("--repeat", action="store", type=int, default=3,
+                        help="How many times to run the stages. The best time of "
+                             + "each stage is reported.")
+    parser.add_argument("--json", action="store", default=None,
+                        help="Write the report as JSON to this file.")
+    return parser.parse_known_args()
+
+
+def benchmark():
+    bench_args, join_argv = parse_args()
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d - %(levelname)s %(message)s',
+                        level=logging.WARNING,
+                        datefmt="%I:%M:%S")
+
+    if bench_args.precision_study:
+        report = run_precision_study(bench_args, join_argv)
+        for precision, result in report.items():
+            print(f"{precision:<10} {result['pairs']} pairs, "
+                  + f"{result['offsets_changed']} offsets changed, "
+                  + f"{result['offsets_wrong']} offsets wrong, "
+                  + f"max score difference {result['max_score_difference']:.3g}")
+        if bench_args.json is not None:
+            with open(bench_args.json, "w") as json_file:
+                json.dump(report, json_file, indent=2)
+        return 0 if all(result["offsets_changed"] == 0
+                        for result in report.values()) else 1
+
+    if bench_args.kernel_study:
+        report = run_kernel_study(bench_args, join_argv)
+        for kernel, result in report.items():
+            print(f"{kernel:<10} {result['pairs']} pairs, "
+                  + f"{result['offsets_changed']} offsets changed, "
+                  + f"max score difference {result['max_score_difference']:.3g}, "
+                  + f"matching {result['matching_time'] * 1000:.2f} ms")
+        if bench_args.json is not None:
+            with open(bench_args.json, "w") as json_file:
+                json.dump(report, json_file, indent=2)
+        return 0 if all(result["offsets_changed"] == 0
+                        for result in report.values()) else 1
+
+    report = run_benchmark(bench_args, join_argv)
+
+    for stage, seconds in report["timings"].items():
+        print(f"{stage:<30} {seconds * 1000:10.2f} ms")
+    print(f"{'total':<30} {report['total'] * 1000:10.2f} ms")
+    print(f"offsets correct: {report['offsets_correct']}")
+
+    if bench_args.json is not None:
+        with open(bench_args.json, "w") as json_file:
+            json.dump(report, json_file, indent=2)
+
+    return 0 if report["offsets_correct"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(benchmark())
@@ -0,0 +1,320 @@
+"""
+Library API of the chat joiner, for joining frames that are already in memory
+without starting a process or writing images to a folder:
+
+    import chat_joiner
+
+    joiner = chat_joiner.ChatJoiner(chat_joiner.create_config(search_mode="pyramid"))
+    result = joiner.join(frames)
+    result.image, result.offsets, result.scores
+
+The config holds the options of the command line, see main.py, and a join that
+fails raises an exception instead of exiting: im.MatchScoreError when a pair of
+frames does not match, and ValueError when there is nothing to join.
+"""
+import argparse
+import logging
+import os
+from typing import Iterator, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import profiling
+from image_utils import boundary_cache as bc
+from image_utils import image_features as ifeat
+from image_utils import image_io as iio
+from image_utils import image_joining as ij
+from image_utils import image_matching as im
+from image_utils import image_matching_parallel as imp
+from image_utils import image_matching_phase as imph
+from image_utils import image_processing as ip
+from image_utils import raw_frames as rf
+
+
+class MatchedSeries(NamedTuple):
+    """
+    A series of frames matched for joining, with everything but the composite.
+    The frames and pairs are in joining order, from the top of the composite.
+    """
+    crop_indices: Tuple[int, int, int, int]
+    crop_direction: str
+    # Indices into the input frames of the frames that are joined
+    frame_indices: np.ndarray
+    crop_images: Sequence[np.ndarray]
+    # Offset and match score of each pair of consecutive crop images
+    offsets: np.ndarray
+    scores: np.ndarray
+    # Column shift of each pair, only found with --search_mode phase
+    column_shifts: np.ndarray
+    boundaries: Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+    height: int
+
+
+class JoinResult(NamedTuple):
+    """
+    The composite of a join, and how the frames were matched to build it.
+    """
+    image: np.ndarray
+    crop_indices: Tuple[int, int, int, int]
+    crop_direction: str
+    frame_indices: np.ndarray
+    offsets: np.ndarray
+    scores: np.ndarray
+    column_shifts: np.ndarray
+
+
+def create_config(**options) -> argparse.Namespace:
+    """
+    Create the config of a join: the defaults of the command line options, with
+    the given options overridden. Unknown options raise TypeError. The config is
+    the namespace of the parser of main.py itself, rather than a typed copy of
+    its options, so the options of the library cannot drift from those of the
+    command line, and every function that takes args takes a config.
+    """
+    # main imports this module
+    import main
+
+    config = main.create_parser().parse_args([])
+    for name, value in options.items():
+        if not hasattr(config, name):
+            raise TypeError(f"unknown option {name!r}")
+        setattr(config, name, value)
+    if config.match_score_threshold is None:
+        config.match_score_threshold = im.METRICS[config.metric].match_score_threshold
+    return config
+
+
+def crop_frames(frames: Sequence[np.ndarray],
+                crop_indices: Tuple[int, int, int, int]
+                ) -> Sequence[np.ndarray]:
+    """
+    Crop a sequence of frames, keeping frames that are loaded on demand lazy, and
+    raw frames as views. Other frames are stacked into one array, so they can be
+    indexed like lazy frames.
+    """
+    if isinstance(frames, (iio.LazyImages, rf.RawFrames)):
+        return frames.crop(crop_indices)
+    (left, right, top, bottom) = crop_indices
+    return np.asarray(frames)[:, top:bottom, left:right]
+
+
+def compute_features(args: argparse.Namespace,
+                     crop_images: Sequence[np.ndarray]) -> ifeat.FrameFeatures:
+    return ifeat.compute_frame_features(crop_images,
+                                        args.n_cols_in_crop,
+                                        args.left_crop_from,
+                                        args.left_crop_to,
+                                        args.right_crop_from,
+                                        args.right_crop_to,
+                                        args.precision)
+
+
+def frames_per_chunk(frame_nbytes: int, memory_budget: int) -> int:
+    """
+    Number of frames of frame_nbytes bytes each that fit in memory_budget
+    megabytes, and at least 2, so each chunk holds a pair.
+    """
+    return max(2, memory_budget * 1024 * 1024 // frame_nbytes)
+
+
+def match_series(args: argparse.Namespace,
+                 frames: Sequence[np.ndarray],
+                 profiler: profiling.Profiler,
+                 work_folder: Optional[str] = None) -> MatchedSeries:
+    """
+    Run the stages of a join up to the composite on a sequence of frames: find
+    the crop boundary, drop duplicate frames, find the scroll direction,
+    optionally drop the frames that other frames cover, and match each pair of
+    frames. With --search_mode phase, the direction and the shift of each pair,
+    in rows and columns, are found by phase correlation of the crop images.
+
+    With a work folder, the crop images and their features are written to
+    memmaps in it, and the pairs are matched in chunks of args.memory_budget
+    megabytes, so memory does not grow with the number of frames. The crop
+    images of the result are then read from the work folder.
+    """
+    with profiler.stage("create_npimage_filter"):
+        logging.info("Finding crop coordinates")
+        crop_indices = bc.find_crop_indices(frames,
+                                            args.denoising_factor,
+                                            args.boundary_scale,
+                                            args.boundary_cache)
+        # iio.write_npimage_to_file(filter_frame, "test/test_full/ex_image_filter.png")
+        logging.debug("crop_indices: %s", crop_indices)
+        logging.info("Extracting image boundaries from first the first image")
+        new_image_boundaries = ip.extract_image_boundaries_by_indices(frames[0],
+                                                                      crop_indices)
+
+    with profiler.stage("remove_duplicate_crop_images"):
+        logging.info("Cropping images by indices")
+        crop_images = crop_frames(frames, crop_indices)
+        if work_folder is not None:
+            crop_images = iio.write_images_to_memmap(
+                crop_images, os.path.join(work_folder, "crop_images.raw"))
+        logging.debug(f"Shape of cropped images: {crop_images[0].shape}")
+        n_crops_before = len(crop_images)
+        logging.debug(f"Number of crop images before removing duplicates: {n_crops_before}")
+
+        logging.info("Removing duplicate crop images")
+        distinct_indices = ip.find_distinct_crop_images(crop_images,
+                                                        args.duplicate_threshold)
+        crop_images = crop_images[distinct_indices]
+        frame_indices = np.array(distinct_indices)
+        # Indices into the features of the crop images that are joined
+        feature_indices = np.arange(len(crop_images))
+        n_crops_removed = n_crops_before - len(crop_images)
+        logging.debug(f"removed {n_crops_removed} duplicate crop images")
+        if len(crop_images) < 2:
+            raise ValueError("At least two different images are needed to join.")
+
+    with profiler.stage("compute_frame_features"):
+        logging.info("Computing frame features")
+        if work_folder is None:
+            features = compute_features(args, crop_images)
+        else:
+            chunk_size = frames_per_chunk(crop_images[0].nbytes, args.memory_budget)
+            features = ifeat.write_frame_features_to_memmap(
+                            (compute_features(args, crop_images[i:i + chunk_size])
+                             for i in range(0, len(crop_images), chunk_size)),
+                            len(crop_images), work_folder)
+
+    with profiler.stage("get_crop_direction"):
+        logging.info("Computing crop direction")
+        if args.search_mode == "phase":
+            crop_direction = imph.get_crop_direction(
+                                args,
+                                imph.compute_phase_frame(args, crop_images[0]),
+                                imph.compute_phase_frame(args, crop_images[1]))
+            pyramid = [features]
+        elif work_folder is None:
+            pyramid = im.build_search_pyramid(args, features)
+            crop_direction = im.get_crop_direction(args, pyramid)
+        else:
+            # The direction only needs the first pair. The pyramids of all pairs
+            # are built chunk by chunk when they are matched.
+            first_pair = ifeat.load_frame_features(work_folder, [0, 1])
+            crop_direction = im.get_crop_direction(
+                                args, im.build_search_pyramid(args, first_pair))
+            pyramid = [features]
+        if crop_direction == "up":
+            crop_images = crop_images[::-1]
+            frame_indices = frame_indices[::-1]
+            feature_indices = feature_indices[::-1]
+            pyramid = ifeat.reverse_feature_pyramid(pyramid)
+        logging.debug(f"crop_direction: {crop_direction}")
+
+    if args.decimate:
+        with profiler.stage("decimate"):
+            logging.info("Finding images that cover all content")
+            n_images = len(crop_images)
+            kept_indices = im.find_covering_images(
+                                pyramid[0],
+                                args.n_rows_in_crop,
+                                max(args.decimate_overlap, args.n_rows_in_crop))
+            crop_images = crop_images[kept_indices]
+            frame_indices = frame_indices[kept_indices]
+            feature_indices = feature_indices[kept_indices]
+            if work_folder is None:
+                pyramid = ifeat.select_feature_pyramid(pyramid, kept_indices)
+            logging.debug(f"kept {len(kept_indices)} of {n_images} images")
+    logging.debug(f"Number of comparisons: {len(crop_images) - 1}")
+
+    with profiler.stage("matching"):
+        logging.info("Computing match scores for all crops")
+        column_shifts = np.zeros(len(crop_images) - 1, dtype=np.int64)
+        if args.search_mode == "phase":
+            match_scores, column_shifts = imph.compute_pairwise_match_scores(args,
+                                                                             crop_images,
+                                                                             profiler)
+        elif work_folder is not None:
+            chunk_size = frames_per_chunk(ifeat.frame_features_nbytes(features),
+                                          args.memory_budget)
+            match_scores = im.compute_pairwise_match_scores_in_chunks(args,
+                                                                      work_folder,
+                                                                      feature_indices,
+                                                                      chunk_size - 1,
+                                                                      profiler)
+        elif args.workers > 1:
+            match_scores = imp.compute_pairwise_match_scores(args, pyramid, profiler)
+        else:
+            match_scores = im.compute_pairwise_match_scores(args, pyramid, profiler)
+
+        min_score_indices = []
+        min_scores = []
+        for match_score in match_scores:
+            min_match_score = np.min(match_score)
+            if min_match_score > args.match_score_threshold:
+                logging.warning(f"match score {min_match_score} is \
+                                above threshold {args.match_score_threshold}")
+                raise im.MatchScoreError("Error when computing best match for image: "
+                                         + "smallest match score above threshold.")
+
+            min_score_indices.append(np.argmin(match_score))
+            min_scores.append(min_match_score)
+
+        min_score_indices = np.array(min_score_indices)
+
+        logging.info("finished computing match scores for all crops")
+
+    new_image_h_dim = ij.compute_series_height(new_image_boundaries[0].shape[0],
+                                               min_score_indices)
+
+    return MatchedSeries(crop_indices, crop_direction, frame_indices, crop_images,
+                         min_score_indices, np.array(min_scores), column_shifts,
+                         new_image_boundaries, new_image_h_dim)
+
+
+def split_series_into_strips(series: MatchedSeries) -> Iterator[np.ndarray]:
+    """
+    Split a matched series into the strips of its composite, see
+    ij.split_series_into_strips. Images that were shifted sideways are placed in
+    the columns of the first captured frame, whose boundaries are placed around
+    the composite.
+    """
+    anchor_index = 0 if series.crop_direction == "down" else -1
+    return ij.split_series_into_strips(series.crop_images, series.offsets,
+                                       series.column_shifts, anchor_index)
+
+
+class ChatJoiner:
+    """
+    Joins sequences of frames in memory with a fixed config, see create_config.
+    If a profiler is given, each join is recorded in it.
+    """
+
+    def __init__(self,
+                 config: Optional[argparse.Namespace] = None,
+                 profiler: Optional[profiling.Profiler] = None):
+        self.config = config if config is not None else create_config()
+        self.profiler = profiler if profiler is not None else profiling.Profiler(False)
+
+    def match(self, frames: Sequence[np.ndarray]) -> MatchedSeries:
+        """
+        Match a sequence of frames of the same shape, in capture order, without
+        joining them. The crop images of the result are kept in memory, so the
+        work_dir of the config is not used.
+        """
+        return match_series(self.config, frames, self.profiler)
+
+    def join(self, frames: Sequence[np.ndarray]) -> JoinResult:
+        """
+        Join a sequence of frames of the same shape, in capture order, into one
+        image. With a work_dir in the config, the frames are matched out of
+        core, see match_series, and only the joined image is returned in memory.
+        """
+        with iio.create_work_folder(self.config.work_dir) as work_folder:
+            series = match_series(self.config, frames, self.profiler, work_folder)
+            with self.profiler.stage("joining"):
+                strips = split_series_into_strips(series)
+                image = ij.join_strips_with_boundaries(strips, series.boundaries,
+                                                       series.height)
+        return JoinResult(image, series.crop_indices, series.crop_direction,
+                          series.frame_indices, series.offsets, series.scores,
+                          series.column_shifts)
+
+
+def join_frames(frames: Sequence[np.ndarray], **options) -> JoinResult:
+    """
+    Join a sequence of frames into one image, with the given options of the
+    command line, see create_config.
+    """
+    return ChatJoiner(create_config(**options)).join(frames)
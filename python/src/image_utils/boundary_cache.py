@@ -0,0 +1,138 @@
+import hashlib
+import json
+import logging
+import os
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from image_utils import image_processing as ip
+
+# Every FINGERPRINT_STRIDE-th pixel of the boundaries is fingerprinted
+FINGERPRINT_STRIDE = 4
+
+
+def fingerprint_boundaries(image: np.ndarray,
+                           crop_indices: Tuple[int, int, int, int]
+                           ) -> str:
+    """
+    Fingerprint the boundaries outside the crop indices of an image, from every
+    FINGERPRINT_STRIDE-th pixel of them. The crop indices and the shape of the
+    image are part of the fingerprint.
+    """
+    fingerprint = hashlib.blake2b(digest_size=16)
+    fingerprint.update(np.array(image.shape + tuple(crop_indices), dtype=np.int64))
+    for boundary in ip.extract_image_boundaries_by_indices(image, crop_indices):
+        fingerprint.update(np.ascontiguousarray(boundary[::FINGERPRINT_STRIDE,
+                                                         ::FINGERPRINT_STRIDE]))
+    return fingerprint.hexdigest()
+
+
+def crop_indices_fit_image(image: np.ndarray,
+                           crop_indices: Tuple[int, int, int, int]
+                           ) -> bool:
+    """
+    Check that crop indices leave a non-empty crop image inside the image.
+    """
+    (left, right, top, bottom) = crop_indices
+    height, width = image.shape[:2]
+    return 0 <= left < right <= width and 0 <= top < bottom <= height
+
+
+class BoundaryCache:
+    """
+    Crop indices of earlier joins, stored as JSON in a file, so the filter frame
+    does not have to be recomputed for each join of the same window. Entries are
+    kept per image shape, most recently used first, and an entry is used for an
+    image if the image has the same boundaries as the image the entry was made
+    from, by their fingerprints.
+
+    The file holds {"<height>x<width>": [{"crop_indices": [left, right, top,
+    bottom], "fingerprint": "..."}, ...], ...}.
+    """
+
+    def __init__(self, file_path: str, max_entries: int = 16):
+        self.file_path = file_path
+        self.max_entries = max_entries
+        self.entries = {}
+        if not os.path.exists(file_path):
+            return
+        try:
+            with open(file_path) as cache_file:
+                self.entries = json.load(cache_file)
+        except (OSError, ValueError) as error:
+            logging.warning(f"Ignoring unreadable boundary cache {file_path}: {error}")
+
+    @staticmethod
+    def shape_key(image: np.ndarray) -> str:
+        return f"{image.shape[0]}x{image.shape[1]}"
+
+    def get(self, image: np.ndarray) -> Optional[Tuple[int, int, int, int]]:
+        """
+        Get the cached crop indices for an image, or None if no entry matches it.
+        """
+        shape_entries: List[dict] = self.entries.get(self.shape_key(image), [])
+        for i, entry in enumerate(shape_entries):
+            crop_indices = tuple(entry["crop_indices"])
+            if not crop_indices_fit_image(image, crop_indices):
+                continue
+            if fingerprint_boundaries(image, crop_indices) == entry["fingerprint"]:
+                shape_entries.insert(0, shape_entries.pop(i))
+                return crop_indices
+        return None
+
+    def put(self, image: np.ndarray, crop_indices: Tuple[int, int, int, int]):
+        """
+        Cache the crop indices found for an image.
+        """
+        crop_indices = tuple(int(index) for index in crop_indices)
+        if not crop_indices_fit_image(image, crop_indices):
+            return
+        fingerprint = fingerprint_boundaries(image, crop_indices)
+        shape_entries = [entry for entry in
+                         self.entries.get(self.shape_key(image), [])
+                         if entry["fingerprint"] != fingerprint]
+        shape_entries.insert(0, {"crop_indices": list(crop_indices),
+                                 "fingerprint": fingerprint})
+        self.entries[self.shape_key(image)] = shape_entries[:self.max_entries]
+
+    def save(self):
+        """
+        Write the cache to its file. The file is replaced, never partially
+        written.
+        """
+        temp_path = self.file_path + ".tmp"
+        with open(temp_path, "w") as cache_file:
+            json.dump(self.entries, cache_file)
+        os.replace(temp_path, self.file_path)
+
+
+def find_crop_indices(images: Sequence[np.ndarray],
+                      denoising_factor: float,
+                      boundary_scale: int,
+                      cache_path: Optional[str]
+                      ) -> Tuple[int, int, int, int]:
+    """
+    Find the crop indices of a sequence of images from its first and last image.
+    With a cache path, the crop indices are looked up in the boundary cache
+    first, which only needs the first image. Otherwise, or if they are not in
+    the cache, they are searched at reduced resolution, see
+    ip.find_frame_boundary_at_reduced_resolution, and added to the cache.
+    """
+    cache = BoundaryCache(cache_path) if cache_path else None
+    if cache is not None:
+        crop_indices = cache.get(images[0])
+        if crop_indices is not None:
+            logging.debug("crop_indices found in boundary cache")
+            return crop_indices
+
+    crop_indices = ip.find_frame_boundary_at_reduced_resolution(images[-1],
+                                                                images[0],
+                                                                denoising_factor,
+                                                                boundary_scale)
+    if cache is not None:
+        cache.put(images[0], crop_indices)
+        try:
+            cache.save()
+        except OSError as error:
+            logging.warning(f"Could not write boundary cache {cache_path}: {error}")
+    return crop_indices
@@ -0,0 +1,246 @@
+import os
+from typing import Dict, Iterable, List, NamedTuple, Sequence
+
+import numpy as np
+from image_utils import image_processing as ip
+
+
+class FrameFeatures(NamedTuple):
+    """
+    Precomputed features of a series of cropped images, shared by all matching
+    stages. Index i of each array belongs to crop image i.
+
+    grayscale holds the grayscale plane of the columns kept by
+    crop_image_reference, with shape (n_images, n_rows, n_columns), and the dtype
+    of the precision it was computed with.
+    row_squared_norms holds the squared norm of each row of those planes, with
+    shape (n_images, n_rows).
+    row_hashes holds the hash of the pixels of each row of the kept columns, with
+    shape (n_images, n_rows), such that equal rows have equal hashes. Rows are
+    only compared exactly at full resolution, so downsampled features hold no row
+    hashes, with shape (n_images, 0).
+    """
+    grayscale: np.ndarray
+    row_squared_norms: np.ndarray
+    row_hashes: np.ndarray
+
+
+# Features at decreasing resolutions. Level l is downsampled by a factor 2 ** l.
+FeaturePyramid = List[FrameFeatures]
+
+# dtype of the grayscale planes of each precision. int planes hold the
+# fixed-point LUMA transform. They only save memory: they are multiplied as
+# floats, in which the sums of their products are exact, see row_product_dtype.
+PRECISION_DTYPES: Dict[str, type] = {
+    "float64": np.float64,
+    "float32": np.float32,
+    "int": np.uint8,
+}
+
+
+def reference_column_indices(image_width: int,
+                             width: int,
+                             left_from_col: int,
+                             left_to_col: int,
+                             right_from_col: int,
+                             right_to_col: int
+                             ) -> np.ndarray:
+    """
+    Find the indices of the columns kept by crop_image_reference in an image of
+    the given width. This is done by running the crop on a row of column indices,
+    so the indices always follow the crop functions.
+    """
+    columns = np.arange(image_width).reshape(1, -1)
+    return ip.crop_image_reference(columns, width,
+                                   left_from_col, left_to_col,
+                                   right_from_col, right_to_col)[0]
+
+
+def product_dtype(grayscale: np.ndarray) -> type:
+    """
+    Get the dtype to multiply grayscale planes in. Integer planes are multiplied as
+    float64, which is exact for the sums of their products and much faster than
+    integer matrix products, while float planes keep their own precision.
+    """
+    if np.issubdtype(grayscale.dtype, np.integer):
+        return np.float64
+    return grayscale.dtype.type
+
+
+def row_product_dtype(grayscale: np.ndarray) -> type:
+    """
+    Get the dtype to multiply single rows of grayscale planes in, before the
+    products are summed over windows in product_dtype. Rows of integer planes are
+    multiplied as float32 if the product of two rows is at most 2 ** 24, below
+    which float32 holds every integer, so the products are exact at half the cost
+    of float64.
+    """
+    if np.issubdtype(grayscale.dtype, np.integer) \
+            and grayscale.shape[-1] * np.iinfo(grayscale.dtype).max ** 2 <= 2 ** 24:
+        return np.float32
+    return product_dtype(grayscale)
+
+
+def convert_to_grayscale(image: np.ndarray, precision: str) -> np.ndarray:
+    """
+    Convert an image to a grayscale plane of the given precision.
+    """
+    if precision == "int":
+        return ip.convert_to_grayscale_fixed_point(image)
+    return ip.convert_to_grayscale(image)
+
+
+def compute_row_squared_norms(grayscale: np.ndarray) -> np.ndarray:
+    """
+    Compute the squared norm of each row in the last two axes of a grayscale plane.
+    The squared norms of integer planes are exact int64s.
+    """
+    if np.issubdtype(grayscale.dtype, np.integer):
+        return np.einsum("...ij,...ij->...i", grayscale, grayscale, dtype=np.int64)
+    return np.einsum("...ij,...ij->...i", grayscale, grayscale)
+
+
+def compute_frame_features(crop_images: List[np.ndarray],
+                           width: int,
+                           left_from_col: int,
+                           left_to_col: int,
+                           right_from_col: int,
+                           right_to_col: int,
+                           precision: str = "float64"
+                           ) -> FrameFeatures:
+    """
+    Compute the features of a list of crop images of the same shape. Each image is
+    column-masked and converted to grayscale exactly once, in the given precision
+    (see PRECISION_DTYPES).
+    """
+    image_height, image_width = crop_images[0].shape[:2]
+    column_indices = reference_column_indices(image_width, width,
+                                              left_from_col, left_to_col,
+                                              right_from_col, right_to_col)
+
+    grayscale = np.empty((len(crop_images), image_height, len(column_indices)),
+                         dtype=PRECISION_DTYPES[precision])
+    row_hashes = np.empty((len(crop_images), image_height), dtype=np.uint64)
+    for i, crop_image in enumerate(crop_images):
+        reference_image = crop_image[:, column_indices]
+        grayscale[i] = convert_to_grayscale(reference_image, precision)
+        row_hashes[i] = ip.compute_row_hashes(reference_image)
+
+    return FrameFeatures(grayscale, compute_row_squared_norms(grayscale), row_hashes)
+
+
+def downsample_frame_features(features: FrameFeatures) -> FrameFeatures:
+    """
+    Downsample the grayscale planes by a factor 2 along both axes, by averaging
+    blocks of 2x2 pixels, rounded for integer planes so the dtype is kept. A
+    trailing odd row or column is dropped. The downsampled features hold no row
+    hashes, see FrameFeatures.
+    """
+    n_images, n_rows, n_cols = features.grayscale.shape
+    grayscale = features.grayscale[:, :n_rows // 2 * 2, :n_cols // 2 * 2]
+    grayscale = grayscale.reshape(n_images, n_rows // 2, 2, n_cols // 2, 2)
+    if np.issubdtype(grayscale.dtype, np.integer):
+        grayscale = ((grayscale.sum(axis=(2, 4), dtype=np.uint16) + 2) // 4)
+        grayscale = grayscale.astype(features.grayscale.dtype)
+    else:
+        grayscale = grayscale.mean(axis=(2, 4))
+    row_hashes = np.empty((n_images, 0), dtype=features.row_hashes.dtype)
+    return FrameFeatures(grayscale, compute_row_squared_norms(grayscale), row_hashes)
+
+
+def build_feature_pyramid(features: FrameFeatures, n_levels: int) -> FeaturePyramid:
+    """
+    Build a pyramid of the full resolution features and n_levels downsampled
+    versions of them.
+    """
+    pyramid = [features]
+    for _ in range(n_levels):
+        pyramid.append(downsample_frame_features(pyramid[-1]))
+    return pyramid
+
+
+def reverse_frame_features(features: FrameFeatures) -> FrameFeatures:
+    """
+    Reverse the order of the images in the features. Returns views, not copies.
+    """
+    return FrameFeatures(features.grayscale[::-1],
+                         features.row_squared_norms[::-1],
+                         features.row_hashes[::-1])
+
+
+def reverse_feature_pyramid(pyramid: FeaturePyramid) -> FeaturePyramid:
+    """
+    Reverse the order of the images in every level of the pyramid.
+    """
+    return [reverse_frame_features(features) for features in pyramid]
+
+
+def select_frame_features(features: FrameFeatures, indices: List[int]) -> FrameFeatures:
+    """
+    Select the features of the images at the given indices, in that order.
+    """
+    return FrameFeatures(features.grayscale[indices],
+                         features.row_squared_norms[indices],
+                         features.row_hashes[indices])
+
+
+def select_feature_pyramid(pyramid: FeaturePyramid, indices: List[int]) -> FeaturePyramid:
+    """
+    Select the images at the given indices in every level of the pyramid.
+    """
+    return [select_frame_features(features, indices) for features in pyramid]
+
+
+def frame_features_nbytes(features: FrameFeatures) -> int:
+    """
+    Number of bytes of the features of a single image.
+    """
+    return sum(array[0].nbytes for array in features)
+
+
+def write_frame_features_to_memmap(chunks: Iterable[FrameFeatures],
+                                   n_images: int,
+                                   folder: str
+                                   ) -> FrameFeatures:
+    """
+    Write the features of a series of images, given in consecutive chunks of
+    images, to .npy files in a folder. Each chunk is written through its own
+    memmap of the files, so only one chunk is mapped at a time. Returns the
+    features as read-only memmaps of the files, which are paged in from the files
+    when they are read.
+    """
+    file_paths = [os.path.join(folder, f"{name}.npy") for name in FrameFeatures._fields]
+    at_image = 0
+    for chunk in chunks:
+        n_chunk_images = chunk.grayscale.shape[0]
+        for file_path, array in zip(file_paths, chunk):
+            if at_image == 0:
+                memmap = np.lib.format.open_memmap(file_path, mode="w+",
+                                                   dtype=array.dtype,
+                                                   shape=(n_images,) + array.shape[1:])
+            else:
+                memmap = np.lib.format.open_memmap(file_path, mode="r+")
+            memmap[at_image:at_image + n_chunk_images] = array
+            del memmap
+        at_image += n_chunk_images
+    return FrameFeatures(*(np.load(file_path, mmap_mode="r") for file_path in file_paths))
+
+
+def load_frame_features(folder: str, indices: Sequence[int]) -> FrameFeatures:
+    """
+    Load the features of the images at the given indices, in that order, from the
+    files written by write_frame_features_to_memmap. The files are only mapped
+    while the features are copied, so no pages of them stay in memory.
+    """
+    return FrameFeatures(*(np.load(os.path.join(folder, f"{name}.npy"),
+                                   mmap_mode="r")[indices]
+                           for name in FrameFeatures._fields))
+
+
+def concatenate_frame_features(features: List[FrameFeatures]) -> FrameFeatures:
+    """
+    Concatenate the features of several series of crop images into one.
+    """
+    return FrameFeatures(np.concatenate([f.grayscale for f in features]),
+                         np.concatenate([f.row_squared_norms for f in features]),
+                         np.concatenate([f.row_hashes for f in features]))
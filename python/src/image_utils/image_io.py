@@ -1,6 +1,15 @@
+import logging
 import os
+import struct
+import tempfile
+import time
+import zlib
+from collections import OrderedDict, deque
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from os import path
-from typing import List
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
 
 import numpy as np
 from PIL import Image
@@ -24,6 +33,230 @@ def load_images(folder_path: str) -> List[Image.Image]:
     return [load_image(img_path) for img_path in img_paths]
 
 
+class ImageCache:
+    """
+    Least recently used cache of decoded images, which holds at most
+    memory_budget bytes of images.
+    """
+
+    def __init__(self, memory_budget: int):
+        self.memory_budget = memory_budget
+        self.n_bytes = 0
+        self.images = OrderedDict()
+
+    def get(self, key) -> Optional[np.ndarray]:
+        image = self.images.get(key)
+        if image is not None:
+            self.images.move_to_end(key)
+        return image
+
+    def put(self, key, image: np.ndarray):
+        self.images[key] = image
+        self.n_bytes += image.nbytes
+        while self.n_bytes > self.memory_budget and self.images:
+            _, evicted_image = self.images.popitem(last=False)
+            self.n_bytes -= evicted_image.nbytes
+
+
+class LazyImages(Sequence):
+    """
+    A sequence of images that are only decoded when they are accessed. Decoded
+    images are kept in a cache with a memory budget, so the images do not all
+    have to fit in memory at once.
+
+    If crop_indices is set, only that region of each image is kept after
+    decoding. Indexing with a slice or a list of indices returns a LazyImages of
+    the selected images, sharing the same cache.
+    """
+
+    def __init__(self,
+                 img_paths: List[str],
+                 cache: ImageCache,
+                 crop_indices: Optional[Tuple[int, int, int, int]] = None):
+        self.img_paths = img_paths
+        self.cache = cache
+        self.crop_indices = crop_indices
+
+    def __len__(self) -> int:
+        return len(self.img_paths)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return LazyImages(self.img_paths[index], self.cache, self.crop_indices)
+        if isinstance(index, list):
+            return LazyImages([self.img_paths[i] for i in index], self.cache,
+                              self.crop_indices)
+
+        key = (self.img_paths[index], self.crop_indices)
+        image = self.cache.get(key)
+        if image is None:
+            image = self.decode(self.img_paths[index])
+            self.cache.put(key, image)
+        return image
+
+    def decode(self, img_path: str) -> np.ndarray:
+        """
+        Decode an image, keeping only the crop region if crop_indices is set.
+        """
+        with Image.open(img_path) as img:
+            if self.crop_indices is None:
+                return image_to_np(img)
+            (left, right, top, bottom) = self.crop_indices
+            return image_to_np(img.crop((left, top, right, bottom)))
+
+    def crop(self, crop_indices: Tuple[int, int, int, int]) -> "LazyImages":
+        """
+        Get the same images, cropped by crop_indices when they are decoded.
+        """
+        return LazyImages(self.img_paths, self.cache, crop_indices)
+
+
+def load_images_lazily(folder_path: str, memory_budget: int) -> LazyImages:
+    """
+    Load all images from a path as a LazyImages, which decodes them on demand and
+    keeps at most memory_budget bytes of decoded images.
+    """
+    img_paths = [path.join(folder_path, img) for img in os.listdir(folder_path)]
+    img_paths = sorted(img_paths)
+
+    return LazyImages(img_paths, ImageCache(memory_budget))
+
+
+@contextmanager
+def create_work_folder(work_dir: Optional[str]) -> Iterator[Optional[str]]:
+    """
+    Create a temporary folder for the files of a single join inside work_dir, and
+    remove it with its files when the join is done. Yields None if work_dir is
+    not set.
+    """
+    if work_dir is None:
+        yield None
+        return
+    os.makedirs(work_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix="join-", dir=work_dir) as work_folder:
+        yield work_folder
+
+
+class MemmapImages(Sequence):
+    """
+    A sequence of images of the same shape, stored back to back in a raw file.
+    Each access maps only the accessed image with np.memmap, so it is paged in
+    from the file when it is read, and unmapped once the returned array is
+    dropped. The images do not take memory while they are not being used.
+
+    Indexing with a slice or a list of indices returns a MemmapImages of the
+    selected images, in the same file.
+    """
+
+    def __init__(self,
+                 file_path: str,
+                 image_shape: Tuple[int, ...],
+                 indices: Sequence[int]):
+        self.file_path = file_path
+        self.image_shape = image_shape
+        self.indices = indices
+        self.image_nbytes = int(np.prod(image_shape))
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return MemmapImages(self.file_path, self.image_shape, self.indices[index])
+        if isinstance(index, list):
+            return MemmapImages(self.file_path, self.image_shape,
+                                [self.indices[i] for i in index])
+
+        return np.memmap(self.file_path, dtype=np.uint8, mode="r",
+                         offset=self.indices[index] * self.image_nbytes,
+                         shape=self.image_shape)
+
+
+def write_images_to_memmap(images: Sequence[np.ndarray], file_path: str
+                           ) -> MemmapImages:
+    """
+    Write a sequence of uint8 images of the same shape to a raw file, one at a
+    time, and return them as a MemmapImages.
+    """
+    with open(file_path, "wb") as images_file:
+        for image in images:
+            np.ascontiguousarray(image, dtype=np.uint8).tofile(images_file)
+    return MemmapImages(file_path, images[0].shape, range(len(images)))
+
+
+class MemmapStrips(Sequence):
+    """
+    A growing sequence of strips of rows of the same width, appended to a raw
+    file, such as the composite of a join while it is being built. Each access
+    maps only the accessed strip with np.memmap, as MemmapImages.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.row_shape: Optional[Tuple[int, ...]] = None
+        # First row and number of rows of each strip in the file
+        self.strip_rows: List[Tuple[int, int]] = []
+        self.n_rows = 0
+        open(file_path, "wb").close()
+
+    def __len__(self) -> int:
+        return len(self.strip_rows)
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        first_row, n_rows = self.strip_rows[index]
+        if n_rows == 0:
+            return np.empty((0,) + self.row_shape, dtype=np.uint8)
+        return np.memmap(self.file_path, dtype=np.uint8, mode="r",
+                         offset=first_row * int(np.prod(self.row_shape)),
+                         shape=(n_rows,) + self.row_shape)
+
+    def append(self, strip: np.ndarray):
+        """
+        Append a strip of rows to the end of the file.
+        """
+        if self.row_shape is None:
+            self.row_shape = strip.shape[1:]
+        with open(self.file_path, "ab") as strips_file:
+            np.ascontiguousarray(strip, dtype=np.uint8).tofile(strips_file)
+        self.strip_rows.append((self.n_rows, strip.shape[0]))
+        self.n_rows += strip.shape[0]
+
+
+def watch_image_paths(folder_path: str,
+                      done_marker: str,
+                      timeout: float,
+                      poll_interval: float = 0.05
+                      ) -> Iterator[str]:
+    """
+    Yield the paths of the images in a folder in sorted order, while they are
+    being written. An image is only yielded once a later image or the done marker
+    exists, so images that are still being written are never yielded. Stops when
+    the done marker exists, or when no new image has appeared for timeout seconds.
+    """
+    yielded = set()
+    last_change_time = time.monotonic()
+    while True:
+        done = path.exists(path.join(folder_path, done_marker))
+        img_names = os.listdir(folder_path) if path.isdir(folder_path) else []
+        pending = sorted(set(img_names) - yielded - {done_marker})
+
+        timed_out = time.monotonic() - last_change_time > timeout
+        if timed_out:
+            logging.warning(f"no new images for {timeout} seconds, stopping watch")
+
+        # The last image may still be written, unless we are stopping
+        complete = pending if done or timed_out else pending[:-1]
+        for img_name in complete:
+            yielded.add(img_name)
+            yield path.join(folder_path, img_name)
+
+        if done or timed_out:
+            return
+        if complete:
+            last_change_time = time.monotonic()
+        time.sleep(poll_interval)
+
+
 def image_to_np(image: Image.Image) -> np.ndarray:
     """
     Convert an Image.Image to a numpy array.
@@ -45,3 +278,287 @@ def write_npimage_to_file(image: np.ndarray, file_path: str):
     """
     img = Image.fromarray(image)
     img.save(file_path)
+
+
+# Output formats, by file extension
+OUTPUT_FORMATS = {".png": "PNG", ".webp": "WEBP", ".jpg": "JPEG", ".jpeg": "JPEG"}
+
+# PNG color type of images with 1, 2, 3 and 4 channels
+PNG_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+# PNG filter type that stores each row as its difference to the row above
+PNG_FILTER_UP = 2
+
+# Size of the deflate window, and of the data each parallel segment is primed with
+DEFLATE_WINDOW_SIZE = 32768
+
+
+def find_output_format(file_path: str, output_format: Optional[str]) -> Optional[str]:
+    """
+    Find the format to write an image in: output_format if it is set, and else the
+    format of the file extension. Returns None if the extension is unknown, in
+    which case Pillow decides.
+    """
+    if output_format is not None:
+        return output_format.upper()
+    return OUTPUT_FORMATS.get(path.splitext(file_path)[1].lower())
+
+
+def create_save_options(output_format: Optional[str],
+                        compress_level: int,
+                        quality: Optional[int],
+                        effort: int
+                        ) -> dict:
+    """
+    Create the options to save an image of the output format with. compress_level
+    is the zlib level of PNG, quality the quality of JPEG and WebP, and effort
+    the method of WebP. Unset options are left to the defaults of Pillow.
+    """
+    if output_format == "PNG":
+        return {"compress_level": compress_level}
+    save_options = {}
+    if quality is not None and output_format in ("JPEG", "WEBP"):
+        save_options["quality"] = quality
+    if output_format == "WEBP":
+        save_options["method"] = effort
+    return save_options
+
+
+def write_png_chunk(png_file: BinaryIO, chunk_type: bytes, data: bytes):
+    """
+    Write a chunk to a PNG file: its length, type, data and CRC.
+    """
+    png_file.write(struct.pack(">I", len(data)))
+    png_file.write(chunk_type)
+    png_file.write(data)
+    png_file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type))))
+
+
+def filter_png_rows(band: np.ndarray, row_above: np.ndarray) -> bytes:
+    """
+    Filter the rows of a band of an image with the PNG Up filter, given the last
+    row of the band above it. Each row is prefixed by its filter type.
+    """
+    rows = band.reshape(band.shape[0], -1)
+    filtered_rows = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+    filtered_rows[:, 0] = PNG_FILTER_UP
+    np.subtract(rows[:1], row_above, out=filtered_rows[:1, 1:])
+    np.subtract(rows[1:], rows[:-1], out=filtered_rows[1:, 1:])
+    return filtered_rows.tobytes()
+
+
+def compress_deflate_segment(data: bytes, dictionary: bytes, compress_level: int
+                             ) -> bytes:
+    """
+    Compress data to a raw deflate segment that ends on a byte boundary without
+    ending the stream, so segments compressed independently can be concatenated.
+    The segment is primed with the data before it as dictionary, so little
+    compression is lost.
+    """
+    if dictionary:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15,
+                                      zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class PngWriter:
+    """
+    Writes a PNG file from bands of its rows, from the top. Each band is filtered
+    and compressed as soon as it is written, so the whole image is never held in
+    memory.
+
+    With n_workers > 1, the bands are compressed in parallel by a pool of threads,
+    as raw deflate segments that are joined into a single zlib stream, in the way
+    of pigz. The checksum of the stream is computed as the bands are written.
+    """
+
+    def __init__(self,
+                 file_path: str,
+                 shape: Tuple[int, ...],
+                 compress_level: int = 6,
+                 n_workers: int = 1):
+        self.shape = shape
+        self.compress_level = compress_level
+        n_channels = shape[2] if len(shape) == 3 else 1
+        self.row_above = np.zeros(shape[1] * n_channels, dtype=np.uint8)
+        self.n_rows = 0
+
+        self.png_file = open(file_path, "wb")
+        self.png_file.write(b"\x89PNG\r\n\x1a\n")
+        write_png_chunk(self.png_file, b"IHDR",
+                        struct.pack(">IIBBBBB", shape[1], shape[0], 8,
+                                    PNG_COLOR_TYPES[n_channels], 0, 0, 0))
+
+        self.executor = None
+        if n_workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=n_workers)
+            self.max_pending = 2 * n_workers
+            self.pending = deque()
+            self.dictionary = b""
+            self.checksum = zlib.adler32(b"")
+            # zlib header of a deflate stream with a 32 KiB window
+            write_png_chunk(self.png_file, b"IDAT", b"\x78\x9c")
+        else:
+            self.compressor = zlib.compressobj(compress_level)
+
+    def write_band(self, band: np.ndarray):
+        """
+        Write the next band of rows.
+        """
+        if band.shape[0] == 0:
+            return
+        data = filter_png_rows(band, self.row_above)
+        self.row_above = band[-1].reshape(-1).copy()
+        self.n_rows += band.shape[0]
+
+        if self.executor is None:
+            compressed = self.compressor.compress(data)
+            if compressed:
+                write_png_chunk(self.png_file, b"IDAT", compressed)
+            return
+
+        self.checksum = zlib.adler32(data, self.checksum)
+        self.pending.append(self.executor.submit(compress_deflate_segment, data,
+                                                 self.dictionary, self.compress_level))
+        self.dictionary = data[-DEFLATE_WINDOW_SIZE:]
+        while len(self.pending) > self.max_pending:
+            write_png_chunk(self.png_file, b"IDAT", self.pending.popleft().result())
+
+    def close(self):
+        """
+        Finish the compressed stream and close the file.
+        """
+        if self.executor is None:
+            write_png_chunk(self.png_file, b"IDAT", self.compressor.flush())
+        else:
+            while self.pending:
+                write_png_chunk(self.png_file, b"IDAT", self.pending.popleft().result())
+            self.executor.shutdown()
+            # An empty final deflate block, followed by the zlib checksum
+            final_block = zlib.compressobj(self.compress_level, zlib.DEFLATED,
+                                           -15).flush(zlib.Z_FINISH)
+            write_png_chunk(self.png_file, b"IDAT",
+                            final_block + struct.pack(">I", self.checksum))
+        write_png_chunk(self.png_file, b"IEND", b"")
+        self.png_file.close()
+
+        if self.n_rows != self.shape[0]:
+            raise ValueError(f"PNG bands hold {self.n_rows} rows, "
+                             + f"not the {self.shape[0]} of the image.")
+
+
+class PillowWriter:
+    """
+    Writes an image file with Pillow from bands of its rows, from the top. The
+    bands are gathered into the whole image, which is saved when closed. A single
+    band holding the whole image is saved without copying it. JPEG has no alpha
+    channel, so the alpha channel of an image is dropped when saved as JPEG.
+    """
+
+    def __init__(self,
+                 file_path: str,
+                 shape: Tuple[int, ...],
+                 output_format: Optional[str],
+                 save_options: dict):
+        self.file_path = file_path
+        self.shape = shape
+        self.output_format = output_format
+        self.save_options = save_options
+        self.image: Optional[np.ndarray] = None
+        self.n_rows = 0
+
+    def write_band(self, band: np.ndarray):
+        """
+        Write the next band of rows.
+        """
+        if self.image is None and band.shape[0] == self.shape[0]:
+            self.image = band
+        else:
+            if self.image is None:
+                self.image = np.empty(self.shape, dtype=np.uint8)
+            self.image[self.n_rows:self.n_rows + band.shape[0]] = band
+        self.n_rows += band.shape[0]
+
+    def close(self):
+        """
+        Save the image.
+        """
+        img = Image.fromarray(self.image)
+        if self.output_format == "JPEG" and img.mode in ("LA", "RGBA"):
+            img = img.convert(img.mode[:-1])
+        img.save(self.file_path, format=self.output_format, **self.save_options)
+
+
+def page_file_paths(file_path: str, n_pages: int) -> List[str]:
+    """
+    Get the file paths of n_pages pages of an image. A single page is written to
+    file_path itself, and several pages are numbered from 1 before the extension.
+    """
+    if n_pages == 1:
+        return [file_path]
+    stem, extension = path.splitext(file_path)
+    return [f"{stem}_{i + 1}{extension}" for i in range(n_pages)]
+
+
+def iterate_page_bands(bands: Iterable[np.ndarray],
+                       page_height: int
+                       ) -> Iterator[Tuple[int, np.ndarray]]:
+    """
+    Split bands of rows of an image at every page_height rows, and yield the index
+    of the page of each part together with it.
+    """
+    at_row = 0
+    for band in bands:
+        while band.shape[0] > 0:
+            page_index = at_row // page_height
+            n_rows = min(band.shape[0], (page_index + 1) * page_height - at_row)
+            yield page_index, band[:n_rows]
+            band = band[n_rows:]
+            at_row += n_rows
+
+
+def write_npimage_bands_to_file(bands: Iterable[np.ndarray],
+                                shape: Tuple[int, ...],
+                                file_path: str,
+                                output_format: Optional[str],
+                                save_options: dict,
+                                stream: bool = False,
+                                page_height: int = 0,
+                                n_workers: int = 1
+                                ) -> List[str]:
+    """
+    Write an image of the given shape to a file from bands of its rows, from the
+    top. If stream is set, PNG images are written by PngWriter as the bands are
+    given, compressed by n_workers threads. Otherwise, and for other formats, the
+    image is saved with Pillow when all bands are given.
+
+    If page_height is set, the image is split into pages of at most page_height
+    rows, each written to its own file (see page_file_paths). Returns the paths
+    of the written files.
+    """
+    if page_height <= 0:
+        page_height = shape[0]
+    n_pages = -(-shape[0] // page_height)
+    file_paths = page_file_paths(file_path, n_pages)
+
+    writer = None
+    writer_page_index = -1
+    for page_index, band in iterate_page_bands(bands, page_height):
+        if page_index != writer_page_index:
+            if writer is not None:
+                writer.close()
+            page_shape = (min(page_height, shape[0] - page_index * page_height),) \
+                + tuple(shape[1:])
+            if stream and output_format == "PNG":
+                writer = PngWriter(file_paths[page_index], page_shape,
+                                   save_options["compress_level"], n_workers)
+            else:
+                writer = PillowWriter(file_paths[page_index], page_shape,
+                                      output_format, save_options)
+            writer_page_index = page_index
+        writer.write_band(band)
+    writer.close()
+
+    return file_paths
@@ -1,7 +1,14 @@
 import logging
-from typing import List, Tuple
+import os
+from contextlib import nullcontext
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
 
 import numpy as np
+from image_utils import image_io as iio
+
+
+# Rows in each band when streaming an image whose band height is not set
+DEFAULT_BAND_HEIGHT = 1024
 
 
 def join_images_vertically_top_wise(image_from: np.ndarray, 
@@ -25,29 +32,269 @@ def join_images_vertically_top_wise(image_from: np.ndarray,
     return new_image
 
 
+def shift_columns(image: np.ndarray, column_shift: int) -> np.ndarray:
+    """
+    Shift the columns of an image by column_shift, such that column x of the
+    result is column x - column_shift of the image. Columns shifted in from
+    outside of the image repeat its edge column. An image that is not shifted is
+    returned as is.
+    """
+    if column_shift == 0:
+        return image
+    columns = np.clip(np.arange(image.shape[1]) - column_shift, 0, image.shape[1] - 1)
+    return image[:, columns]
+
+
+def split_series_into_strips(crop_images: Sequence[np.ndarray],
+                             min_score_indices: np.ndarray,
+                             column_shifts: Optional[np.ndarray] = None,
+                             anchor_index: int = 0
+                             ) -> Iterator[np.ndarray]:
+    """
+    Split a series of images into the strips of rows each image contributes when
+    the series is joined vertically top wise. Each image contributes the rows
+    above the image after it, which starts at its min_score_index, and the last
+    image contributes all of its rows. The strips are views, not copies.
+
+    If column_shifts is given, image i + 1 is shifted column_shifts[i] columns
+    from image i, such that its column x shows column x + column_shifts[i] of
+    image i. Each strip is then shifted back into the columns of the image at
+    anchor_index, see shift_columns, which copies it.
+
+    The strips are yielded one at a time, so images that are decoded on demand
+    are only accessed when their strip is written.
+    """
+    if column_shifts is None:
+        column_shifts = np.zeros(len(min_score_indices), dtype=np.int64)
+    # Shift of each image from the anchor image
+    image_shifts = np.concatenate(([0], np.cumsum(column_shifts)))
+    image_shifts -= image_shifts[anchor_index]
+    for i, min_score_index in enumerate(min_score_indices):
+        yield shift_columns(crop_images[i][:min_score_index], int(image_shifts[i]))
+    yield shift_columns(crop_images[len(min_score_indices)], int(image_shifts[-1]))
+
+
+def compute_series_height(crop_height: int, min_score_indices: np.ndarray) -> int:
+    """
+    Compute the height of a series of images of height crop_height, joined
+    vertically top wise.
+    """
+    return int(np.sum(min_score_indices)) + crop_height
+
+
+def write_strips_vertically(image: np.ndarray, strips: Iterable[np.ndarray]):
+    """
+    Write strips of rows into an image from the top, one after the other.
+    """
+    at_row = 0
+    for strip in strips:
+        image[at_row:at_row + strip.shape[0]] = strip
+        at_row += strip.shape[0]
+
+
+def join_strips_vertically(strips: List[np.ndarray]) -> np.ndarray:
+    """
+    Join strips of rows vertically into a new image, allocated once.
+    """
+    height = sum(strip.shape[0] for strip in strips)
+    new_image = np.empty((height,) + strips[0].shape[1:], dtype=np.uint8)
+    write_strips_vertically(new_image, strips)
+    return new_image
+
+
 def join_series_vertically_top_wise(crop_images: List[np.ndarray],
-                                    min_score_indices: np.ndarray
+                                    min_score_indices: np.ndarray,
+                                    column_shifts: Optional[np.ndarray] = None
                                     ) -> np.ndarray:
     """
     Join a series of images vertically, such that the image at index 0 is placed
     at the top of the new image, and the image at index -1 is placed at the bottom
-    of the new image.
-    """
-    logging.info("joining images. Starting with image 0 as new_image")
-    new_image = crop_images[0]
-
-    logging.debug(f"new_image.shape: {new_image.shape}")
-    for i, (crop_image, min_score_index) in enumerate(zip(crop_images[1:],
-                                                          min_score_indices)):
-        new_image = join_images_vertically_top_wise(crop_image,
-                                                    new_image,
-                                                    min_score_index)
-        logging.info(f"joined image {i + 1} to new_image")
+    of the new image. If column_shifts is given, the images are also placed by
+    their column shifts, see split_series_into_strips.
+
+    The height of the new image is known from the min_score_indices up front, so
+    it is allocated once and each image is written straight into its rows. This
+    gives the same image as joining the images pairwise with
+    join_images_vertically_top_wise.
+    """
+    logging.info("joining images")
+    new_image = join_strips_vertically(list(split_series_into_strips(crop_images,
+                                                                     min_score_indices,
+                                                                     column_shifts)))
     logging.info("joined all images")
 
     return new_image
 
 
+def write_extended_boundary(image: np.ndarray, boundary: np.ndarray):
+    """
+    Write a boundary into the top of an image, and fill the remaining rows by
+    repeating the last row of the boundary. Same result as writing the output of
+    ip.extend_array_vertically, without allocating it.
+    """
+    image[:boundary.shape[0]] = boundary
+    image[boundary.shape[0]:] = boundary[-1]
+
+
+def compute_joined_shape(boundaries: Tuple[np.ndarray, np.ndarray,
+                                           np.ndarray, np.ndarray],
+                         new_image_h_dim: int
+                         ) -> Tuple[int, ...]:
+    """
+    Compute the shape of new_image_h_dim rows of strips joined with boundaries.
+    """
+    left_b, right_b, top_b, bottom_b = boundaries
+    return (new_image_h_dim + top_b.shape[0] + bottom_b.shape[0],) + top_b.shape[1:]
+
+
+def join_strips_with_boundaries(strips: Iterable[np.ndarray],
+                                boundaries: Tuple[np.ndarray, np.ndarray,
+                                                  np.ndarray, np.ndarray],
+                                new_image_h_dim: int,
+                                out: Optional[np.ndarray] = None
+                                ) -> np.ndarray:
+    """
+    Join strips of rows vertically and place the boundaries of the original images
+    around them, in a single new image. The strips must add up to new_image_h_dim
+    rows. The left and right boundaries are extended to the height of the strips
+    by repeating their last row, as done by ip.extend_boundaries_to_new_image_shape.
+
+    If out is given, such as a memmap, the image is written into it instead.
+    """
+    left_b, right_b, top_b, bottom_b = boundaries
+
+    if out is None:
+        out = np.empty(compute_joined_shape(boundaries, new_image_h_dim),
+                       dtype=np.uint8)
+    final_new_image = out
+
+    top_b_dim = top_b.shape[0]
+    left_b_dim = left_b.shape[1]
+    right_b_from = final_new_image.shape[1] - right_b.shape[1]
+    content_rows = final_new_image[top_b_dim:top_b_dim + new_image_h_dim]
+
+    write_strips_vertically(content_rows[:, left_b_dim:right_b_from], strips)
+    write_extended_boundary(content_rows[:, :left_b_dim], left_b)
+    write_extended_boundary(content_rows[:, right_b_from:], right_b)
+    final_new_image[:top_b_dim] = top_b
+    final_new_image[top_b_dim + new_image_h_dim:] = bottom_b
+
+    return final_new_image
+
+
+def extended_boundary_rows(boundary: np.ndarray, start: int, stop: int) -> np.ndarray:
+    """
+    Get the rows start to stop of a boundary extended by repeating its last row.
+    """
+    return boundary[np.minimum(np.arange(start, stop), boundary.shape[0] - 1)]
+
+
+def iterate_strips_with_boundaries(strips: Iterable[np.ndarray],
+                                   boundaries: Tuple[np.ndarray, np.ndarray,
+                                                     np.ndarray, np.ndarray],
+                                   band_height: int
+                                   ) -> Iterator[np.ndarray]:
+    """
+    Yield the rows of join_strips_with_boundaries from the top, in bands of at
+    most band_height rows, without building the whole image. Each band combines
+    the rows of the strips with the rows of the extended left and right
+    boundaries, so memory stays bounded however tall the image is.
+
+    The band buffer is reused, so each band must be consumed before the next one
+    is requested.
+    """
+    left_b, right_b, top_b, bottom_b = boundaries
+    left_b_dim = left_b.shape[1]
+    right_b_from = top_b.shape[1] - right_b.shape[1]
+
+    yield top_b
+
+    band = np.empty((band_height,) + top_b.shape[1:], dtype=np.uint8)
+    band_from_row = 0
+    n_band_rows = 0
+    for strip in strips:
+        while strip.shape[0] > 0:
+            n_rows = min(band_height - n_band_rows, strip.shape[0])
+            band[n_band_rows:n_band_rows + n_rows, left_b_dim:right_b_from] = \
+                strip[:n_rows]
+            strip = strip[n_rows:]
+            n_band_rows += n_rows
+            if n_band_rows < band_height:
+                continue
+
+            band[:, :left_b_dim] = extended_boundary_rows(
+                left_b, band_from_row, band_from_row + band_height)
+            band[:, right_b_from:] = extended_boundary_rows(
+                right_b, band_from_row, band_from_row + band_height)
+            yield band
+            band_from_row += band_height
+            n_band_rows = 0
+
+    if n_band_rows > 0:
+        band[:n_band_rows, :left_b_dim] = extended_boundary_rows(
+            left_b, band_from_row, band_from_row + n_band_rows)
+        band[:n_band_rows, right_b_from:] = extended_boundary_rows(
+            right_b, band_from_row, band_from_row + n_band_rows)
+        yield band[:n_band_rows]
+
+    yield bottom_b
+
+
+def write_strips_with_boundaries(args,
+                                 strips: Iterable[np.ndarray],
+                                 boundaries: Tuple[np.ndarray, np.ndarray,
+                                                   np.ndarray, np.ndarray],
+                                 new_image_h_dim: int,
+                                 work_folder: Optional[str] = None,
+                                 profiler=None
+                                 ) -> List[str]:
+    """
+    Join strips of rows with boundaries, as join_strips_with_boundaries, and write
+    the image to args.output_filename with the output options in args. Returns
+    the paths of the written files, of which there are several if the image is
+    split into pages.
+
+    PNG images are streamed to the file in bands of args.output_strip_height rows,
+    without building the whole image, if it is set, if they are compressed by
+    several args.encode_workers or if there is a work folder. Otherwise the whole
+    image is built and written, in a memmap in the work folder if there is one.
+
+    If a profiler (see profiling.py) is given, the joining of the strips is
+    recorded in it as the joining stage, also when the bands are joined while
+    they are written.
+    """
+    shape = compute_joined_shape(boundaries, new_image_h_dim)
+    logging.debug(f"new image with boundaries shape: {shape}")
+
+    output_format = iio.find_output_format(args.output_filename, args.output_format)
+    save_options = iio.create_save_options(output_format, args.compress_level,
+                                           args.quality, args.effort)
+    stream = output_format == "PNG" \
+        and (args.output_strip_height > 0 or args.encode_workers > 1
+             or work_folder is not None)
+
+    if stream:
+        band_height = args.output_strip_height or DEFAULT_BAND_HEIGHT
+        logging.debug(f"streaming image to file in bands of {band_height} rows")
+        bands = iterate_strips_with_boundaries(strips, boundaries, band_height)
+        if profiler is not None:
+            bands = profiler.stage_items("joining", bands)
+    else:
+        if args.output_strip_height > 0:
+            logging.warning("only PNG images can be streamed, building the whole image")
+        out = None
+        if work_folder is not None:
+            out = np.lib.format.open_memmap(os.path.join(work_folder, "composite.npy"),
+                                            mode="w+", dtype=np.uint8, shape=shape)
+        with profiler.stage("joining") if profiler is not None else nullcontext():
+            bands = [join_strips_with_boundaries(strips, boundaries, new_image_h_dim,
+                                                 out)]
+
+    return iio.write_npimage_bands_to_file(bands, shape, args.output_filename,
+                                           output_format, save_options, stream,
+                                           args.page_height, args.encode_workers)
+
+
 def join_image_with_boundaries(image: np.ndarray,
                                boundaries: Tuple[np.ndarray, np.ndarray,
                                                  np.ndarray, np.ndarray]
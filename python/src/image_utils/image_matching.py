@@ -1,17 +1,33 @@
 import logging
+import time
+from typing import Callable, List, NamedTuple, Optional, Sequence, Tuple
 
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from image_utils import image_features as ifeat
+from image_utils import image_matching_jit as imjit
 from image_utils import image_processing as ip
 
 
+# Scoring kernels, see use_jit_kernel
+KERNELS = ["auto", "numpy", "numba"]
+
+
+class MatchScoreError(Exception):
+    """
+    Raised when the smallest match score of an image pair is above the match
+    score threshold, meaning no good match was found between the two images.
+    """
+
+
 def score_function(arr1: np.ndarray, arr2: np.ndarray) -> float:
     """
     Compute the score of two one-dimensional arrays.
     Our score is the cosine similarity between the two image arrays.
     Can be customized to other similarity functions.
 
-    NOTE: If this function is changed, adjust the match_score_threshold
-    command line argument in src/main.py
+    NOTE: This is the cosine metric of METRICS, one offset at a time. The
+    match scores of the search are computed with the metric in args.
     """
     norm = np.linalg.norm
     return 1 - np.dot(arr1, arr2) / (norm(arr1) * norm(arr2))
@@ -35,66 +51,676 @@ def compute_match_score_of_slice(image_slice: np.ndarray,
     return score
 
 
+def compute_sliding_dot_products(grayscale_slice: np.ndarray,
+                                 grayscale_reference: np.ndarray
+                                 ) -> np.ndarray:
+    """
+    Compute the dot product of the flattened grayscale slice with the flattened
+    window of the grayscale reference at every row offset, in one batched pass.
+
+    The row-by-row products are computed with a single matrix product, after
+    which the dot product of the window at offset k is the sum of the k-th
+    diagonal of that matrix.
+    """
+    n_rows = grayscale_slice.shape[0]
+    dtype = ifeat.row_product_dtype(grayscale_slice)
+    row_products = grayscale_reference.astype(dtype, copy=False) \
+        @ grayscale_slice.T.astype(dtype, copy=False)
+    windows = sliding_window_view(row_products, n_rows, axis=0)
+    return np.einsum("kii->k", windows, dtype=ifeat.product_dtype(grayscale_slice))
+
+
+def compute_sliding_norms(row_squared_norms: np.ndarray,
+                          n_rows: int
+                          ) -> np.ndarray:
+    """
+    Compute the norm of the flattened window of a grayscale reference at every
+    row offset, using the squared norms of each row of the reference.
+    """
+    windows = sliding_window_view(row_squared_norms, n_rows)
+    return np.sqrt(windows.sum(axis=1))
+
+
+def compute_window_dot_products(grayscale_slice: np.ndarray,
+                                grayscale_reference: np.ndarray,
+                                offsets: Optional[np.ndarray] = None
+                                ) -> np.ndarray:
+    """
+    Compute the dot product of the flattened grayscale slice with the flattened
+    window of the grayscale reference at every row offset, or only at the given
+    row offsets, whose windows are gathered instead.
+    """
+    if offsets is None:
+        return compute_sliding_dot_products(grayscale_slice, grayscale_reference)
+    windows = sliding_window_view(grayscale_reference,
+                                  grayscale_slice.shape[0], axis=0)[offsets]
+    return np.einsum("kci,ic->k", windows, grayscale_slice,
+                     dtype=ifeat.product_dtype(grayscale_slice))
+
+
+def compute_window_sums(row_values: np.ndarray,
+                        n_rows: int,
+                        offsets: Optional[np.ndarray] = None
+                        ) -> np.ndarray:
+    """
+    Compute the sum of a value of each row, like its squared norm, over the
+    window at every row offset, or only at the given row offsets.
+    """
+    window_sums = sliding_window_view(row_values, n_rows).sum(axis=1)
+    return window_sums if offsets is None else window_sums[offsets]
+
+
+def compute_row_sums(grayscale: np.ndarray) -> np.ndarray:
+    """
+    Compute the sum of the values of each row of a grayscale image, exactly for
+    integer images.
+    """
+    dtype = np.int64 if np.issubdtype(grayscale.dtype, np.integer) else np.float64
+    return grayscale.sum(axis=-1, dtype=dtype)
+
+
+def compute_absolute_difference(array_0: np.ndarray, array_1: np.ndarray
+                                ) -> np.ndarray:
+    """
+    Compute the element-wise absolute difference of two arrays, in their own
+    dtype, such that uint8 arrays are not widened.
+    """
+    return np.maximum(array_0, array_1) - np.minimum(array_0, array_1)
+
+
+def compute_window_absolute_differences(grayscale_slice: np.ndarray,
+                                        grayscale_reference: np.ndarray,
+                                        offsets: Optional[np.ndarray] = None
+                                        ) -> np.ndarray:
+    """
+    Compute the sum of the absolute differences of the grayscale slice and the
+    window of the grayscale reference at every row offset, or only at the given
+    row offsets. Like compute_sliding_dot_products, the sums of every pair of a
+    reference row and a slice row are computed first, after which the sum of the
+    window at offset k is the sum of the k-th diagonal.
+    """
+    n_rows = grayscale_slice.shape[0]
+    dtype = compute_row_sums(grayscale_slice[:1, :1]).dtype
+    if offsets is not None:
+        windows = sliding_window_view(grayscale_reference, n_rows, axis=0)[offsets]
+        return compute_absolute_difference(windows, grayscale_slice.T
+                                           ).sum(axis=(1, 2), dtype=dtype)
+
+    # The row sums of uint8 differences fit in uint32, which is faster to sum in
+    row_sum_dtype = np.uint32 if dtype == np.int64 else dtype
+    row_differences = np.empty((grayscale_reference.shape[0], n_rows), dtype=dtype)
+    larger = np.empty_like(grayscale_reference)
+    smaller = np.empty_like(grayscale_reference)
+    for i in range(n_rows):
+        np.maximum(grayscale_reference, grayscale_slice[i], out=larger)
+        np.minimum(grayscale_reference, grayscale_slice[i], out=smaller)
+        larger -= smaller
+        row_differences[:, i] = larger.sum(axis=1, dtype=row_sum_dtype)
+    windows = sliding_window_view(row_differences, n_rows, axis=0)
+    return np.einsum("kii->k", windows)
+
+
+def cosine_match_scores(grayscale_slice: np.ndarray,
+                        grayscale_reference: np.ndarray,
+                        slice_row_squared_norms: np.ndarray,
+                        reference_row_squared_norms: np.ndarray,
+                        offsets: Optional[np.ndarray] = None
+                        ) -> np.ndarray:
+    """
+    One minus the cosine similarity of the flattened slice and window.
+    """
+    n_rows = grayscale_slice.shape[0]
+    dot_products = compute_window_dot_products(grayscale_slice, grayscale_reference,
+                                               offsets)
+    slice_norm = np.sqrt(np.sum(slice_row_squared_norms))
+    reference_norms = compute_sliding_norms(reference_row_squared_norms, n_rows)
+    if offsets is not None:
+        reference_norms = reference_norms[offsets]
+    return 1 - dot_products / (slice_norm * reference_norms)
+
+
+# Largest variance per value of a slice or window that counts as constant
+CONSTANT_VARIANCE = 1e-6
+
+
+def ncc_match_scores(grayscale_slice: np.ndarray,
+                     grayscale_reference: np.ndarray,
+                     slice_row_squared_norms: np.ndarray,
+                     reference_row_squared_norms: np.ndarray,
+                     offsets: Optional[np.ndarray] = None
+                     ) -> np.ndarray:
+    """
+    One minus the normalized cross-correlation of the flattened slice and window,
+    which is the cosine similarity after subtracting the mean of each. Where the
+    slice or the window is constant, it is undefined, and a window scores 0 if
+    both are the same constant and 1, as uncorrelated, otherwise.
+    """
+    n_rows = grayscale_slice.shape[0]
+    n_values = grayscale_slice.size
+    dot_products = compute_window_dot_products(grayscale_slice, grayscale_reference,
+                                               offsets)
+    slice_sum = np.float64(np.sum(compute_row_sums(grayscale_slice)))
+    reference_sums = compute_window_sums(compute_row_sums(grayscale_reference),
+                                         n_rows, offsets).astype(np.float64)
+    slice_squared_norm = np.sum(slice_row_squared_norms)
+    reference_squared_norms = compute_window_sums(reference_row_squared_norms,
+                                                  n_rows, offsets)
+
+    covariances = dot_products - slice_sum * reference_sums / n_values
+    slice_variance = slice_squared_norm - slice_sum ** 2 / n_values
+    reference_variances = reference_squared_norms - reference_sums ** 2 / n_values
+    # Variances of constant float images are only zero up to rounding
+    is_constant_slice = slice_variance <= n_values * CONSTANT_VARIANCE
+    is_constant_reference = reference_variances <= n_values * CONSTANT_VARIANCE
+    with np.errstate(divide="ignore", invalid="ignore"):
+        match_scores = 1 - covariances / np.sqrt(slice_variance * reference_variances)
+    is_equal_constant = is_constant_slice & is_constant_reference \
+        & np.isclose(slice_sum, reference_sums)
+    return np.where(is_constant_slice | is_constant_reference,
+                    np.where(is_equal_constant, 0.0, 1.0), match_scores)
+
+
+def ssd_match_scores(grayscale_slice: np.ndarray,
+                     grayscale_reference: np.ndarray,
+                     slice_row_squared_norms: np.ndarray,
+                     reference_row_squared_norms: np.ndarray,
+                     offsets: Optional[np.ndarray] = None
+                     ) -> np.ndarray:
+    """
+    The sum of squared differences of the slice and window, from their norms and
+    dot product, as a fraction of the largest possible sum.
+    """
+    n_rows = grayscale_slice.shape[0]
+    dot_products = compute_window_dot_products(grayscale_slice, grayscale_reference,
+                                               offsets)
+    reference_squared_norms = compute_window_sums(reference_row_squared_norms,
+                                                  n_rows, offsets)
+    squared_differences = np.sum(slice_row_squared_norms) + reference_squared_norms \
+        - 2 * dot_products
+    return np.maximum(squared_differences, 0) / (grayscale_slice.size * 255 ** 2)
+
+
+def sad_match_scores(grayscale_slice: np.ndarray,
+                     grayscale_reference: np.ndarray,
+                     slice_row_squared_norms: np.ndarray,
+                     reference_row_squared_norms: np.ndarray,
+                     offsets: Optional[np.ndarray] = None
+                     ) -> np.ndarray:
+    """
+    The sum of absolute differences of the slice and window, as a fraction of the
+    largest possible sum. Computed in integers on uint8 images.
+    """
+    absolute_differences = compute_window_absolute_differences(grayscale_slice,
+                                                               grayscale_reference,
+                                                               offsets)
+    return absolute_differences / (grayscale_slice.size * 255)
+
+
+class Metric(NamedTuple):
+    """
+    A similarity metric of the search. The match scores are computed from the
+    grayscale slice, the grayscale reference, the squared norms of the rows of
+    both, and optionally the offsets to score, and lower scores are better.
+    """
+    match_scores: Callable[..., np.ndarray]
+    # Default of the match_score_threshold command line argument
+    match_score_threshold: float
+
+
+METRICS = {
+    "cosine": Metric(cosine_match_scores, 0.10),
+    "ncc": Metric(ncc_match_scores, 0.25),
+    "ssd": Metric(ssd_match_scores, 0.01),
+    "sad": Metric(sad_match_scores, 0.05),
+}
+
+
+def batched_score_function(grayscale_slice: np.ndarray,
+                           grayscale_reference: np.ndarray,
+                           slice_row_squared_norms: np.ndarray,
+                           reference_row_squared_norms: np.ndarray,
+                           metric: str = "cosine"
+                           ) -> np.ndarray:
+    """
+    Batched version of score_function. Computes the score of the grayscale slice
+    against every row offset of the grayscale reference at once, with the metric
+    of the given name in METRICS.
+    """
+    return METRICS[metric].match_scores(grayscale_slice, grayscale_reference,
+                                        slice_row_squared_norms,
+                                        reference_row_squared_norms)
+
+
 def compute_match_scores(image_slice: np.ndarray,
                          image_reference: np.ndarray,
                          ) -> np.ndarray:
     """
-    Compute the match scores of an image slice and an image reference.
+    Compute the match scores of an image slice and an image reference. The score
+    at index k is the match score of the image slice and the rows k to
+    k + len(image_slice) of the image reference.
     """
-    slice_size = image_slice.shape[0]
-    crop_slices = ip.create_list_of_crop_slices(image_reference, slice_size)
+    grayscale_image_slice = ip.convert_to_grayscale(image_slice)
+    grayscale_image_ref = ip.convert_to_grayscale(image_reference)
 
-    scores = [compute_match_score_of_slice(image_slice, crop_slice)
-              for crop_slice in crop_slices]
-    return np.array(scores)
+    return batched_score_function(grayscale_image_slice,
+                                  grayscale_image_ref,
+                                  ifeat.compute_row_squared_norms(grayscale_image_slice),
+                                  ifeat.compute_row_squared_norms(grayscale_image_ref))
 
 
-def get_crop_direction(args, crop_images):
+def use_jit_kernel(kernel: str, scattered_offsets: bool, metric: str) -> bool:
+    """
+    Check if the compiled kernel of image_matching_jit is used to score offsets,
+    which is only implemented for the cosine metric. With the "auto" kernel, it is
+    used when numba is installed and the offsets are scattered, as the batched
+    numpy functions are faster for full curves.
+    """
+    if metric != "cosine":
+        return False
+    if kernel == "numba":
+        return True
+    return kernel == "auto" and scattered_offsets and imjit.AVAILABLE
+
+
+def compute_match_scores_of_features(features: ifeat.FrameFeatures,
+                                     slice_index: int,
+                                     reference_index: int,
+                                     n_rows: int,
+                                     kernel: str = "numpy",
+                                     metric: str = "cosine"
+                                     ) -> np.ndarray:
+    """
+    Compute the match scores of the top n_rows of image slice_index against
+    image reference_index, reading the precomputed features of both images.
+    """
+    if use_jit_kernel(kernel, False, metric):
+        n_offsets = features.grayscale.shape[1] - n_rows + 1
+        return compute_match_scores_at_offsets(features, slice_index, reference_index,
+                                               n_rows, np.arange(n_offsets), kernel)
+    return batched_score_function(features.grayscale[slice_index, :n_rows],
+                                  features.grayscale[reference_index],
+                                  features.row_squared_norms[slice_index, :n_rows],
+                                  features.row_squared_norms[reference_index],
+                                  metric)
+
+
+def compute_match_scores_at_offsets(features: ifeat.FrameFeatures,
+                                    slice_index: int,
+                                    reference_index: int,
+                                    n_rows: int,
+                                    offsets: np.ndarray,
+                                    kernel: str = "numpy",
+                                    metric: str = "cosine"
+                                    ) -> np.ndarray:
+    """
+    Compute the match scores of the top n_rows of image slice_index against
+    image reference_index, only at the given row offsets of the reference.
+    """
+    if use_jit_kernel(kernel, True, metric):
+        return imjit.compute_match_scores_at_offsets(
+            features.grayscale[slice_index, :n_rows],
+            features.grayscale[reference_index],
+            features.row_squared_norms[slice_index, :n_rows],
+            features.row_squared_norms[reference_index],
+            offsets)
+
+    return METRICS[metric].match_scores(features.grayscale[slice_index, :n_rows],
+                                        features.grayscale[reference_index],
+                                        features.row_squared_norms[slice_index, :n_rows],
+                                        features.row_squared_norms[reference_index],
+                                        offsets)
+
+
+def find_best_offsets(match_scores: np.ndarray, n_offsets: int) -> np.ndarray:
+    """
+    Find the offsets of the n_offsets lowest local minima of the match scores,
+    such that the offsets are not all taken from around a single minimum.
+    Offsets with an undefined score are never chosen.
+    """
+    match_scores = np.where(np.isnan(match_scores), np.inf, match_scores)
+    padded_scores = np.pad(match_scores, 1, constant_values=np.inf)
+    is_local_minimum = ((match_scores <= padded_scores[:-2])
+                        & (match_scores <= padded_scores[2:]))
+    local_minima = np.flatnonzero(is_local_minimum)
+
+    n_offsets = min(n_offsets, len(local_minima))
+    best = np.argpartition(match_scores[local_minima], n_offsets - 1)[:n_offsets]
+    return local_minima[best]
+
+
+def compute_pyramid_match_scores(pyramid: ifeat.FeaturePyramid,
+                                 slice_index: int,
+                                 reference_index: int,
+                                 n_rows: int,
+                                 n_candidates: int,
+                                 kernel: str = "numpy",
+                                 metric: str = "cosine"
+                                 ) -> np.ndarray:
+    """
+    Compute the match scores of image slice_index against image reference_index
+    with a coarse to fine search. All offsets are searched at the lowest
+    resolution of the pyramid. At each higher resolution, only the neighbourhood
+    of the n_candidates best offsets of the level below is searched.
+
+    Returns the match scores at full resolution, with np.inf at every offset
+    that was not searched, such that min and argmin match an exhaustive search
+    when the best offset is among the candidates.
+    """
+    level = len(pyramid) - 1
+    # Never downsample the slice to less than a single row
+    while level > 0 and n_rows >> level == 0:
+        level -= 1
+
+    match_scores = compute_match_scores_of_features(pyramid[level],
+                                                    slice_index, reference_index,
+                                                    n_rows >> level, kernel, metric)
+    for level in range(level - 1, -1, -1):
+        level_n_rows = n_rows >> level
+        n_offsets = pyramid[level].grayscale.shape[1] - level_n_rows + 1
+
+        # Each offset of the level below covers two offsets of this level.
+        # Search two offsets around them to allow for the rounding of both.
+        candidates = find_best_offsets(match_scores, n_candidates) * 2
+        offsets = (candidates[:, None] + np.arange(-2, 4)).reshape(-1)
+        offsets = np.unique(np.clip(offsets, 0, n_offsets - 1))
+
+        match_scores = np.full(n_offsets, np.inf)
+        match_scores[offsets] = compute_match_scores_at_offsets(pyramid[level],
+                                                                slice_index,
+                                                                reference_index,
+                                                                level_n_rows,
+                                                                offsets, kernel, metric)
+    return match_scores
+
+
+def build_search_pyramid(args, features: ifeat.FrameFeatures) -> ifeat.FeaturePyramid:
+    """
+    Build the feature pyramid needed by the search mode in args.
+    """
+    n_levels = args.pyramid_levels if args.search_mode == "pyramid" else 0
+    return ifeat.build_feature_pyramid(features, n_levels)
+
+
+def compute_match_scores_in_window(features: ifeat.FrameFeatures,
+                                   slice_index: int,
+                                   reference_index: int,
+                                   n_rows: int,
+                                   low_offset: int,
+                                   high_offset: int,
+                                   kernel: str = "numpy",
+                                   metric: str = "cosine"
+                                   ) -> np.ndarray:
+    """
+    Compute the match scores of the top n_rows of image slice_index against
+    image reference_index, only at the row offsets from low_offset to high_offset
+    (both included). Returns the scores of all offsets, with np.inf at every
+    offset outside of the window.
+    """
+    n_offsets = features.grayscale.shape[1] - n_rows + 1
+    low_offset = max(low_offset, 0)
+    high_offset = min(high_offset, n_offsets - 1)
+
+    match_scores = np.full(n_offsets, np.inf)
+    if low_offset > high_offset:
+        return match_scores
+    if use_jit_kernel(kernel, False, metric):
+        offsets = np.arange(low_offset, high_offset + 1)
+        match_scores[offsets] = compute_match_scores_at_offsets(
+            features, slice_index, reference_index, n_rows, offsets, kernel)
+        return match_scores
+
+    reference_rows = slice(low_offset, high_offset + n_rows)
+    match_scores[low_offset:high_offset + 1] = batched_score_function(
+        features.grayscale[slice_index, :n_rows],
+        features.grayscale[reference_index, reference_rows],
+        features.row_squared_norms[slice_index, :n_rows],
+        features.row_squared_norms[reference_index, reference_rows],
+        metric)
+    return match_scores
+
+
+def find_exact_offsets(features: ifeat.FrameFeatures,
+                       slice_index: int,
+                       reference_index: int,
+                       n_rows: int
+                       ) -> np.ndarray:
+    """
+    Find the row offsets at which the top n_rows of image slice_index are exactly
+    equal to the window of image reference_index, by their row hashes. The offsets
+    where the first row matches are found first, and only those are checked
+    against the remaining rows.
+    """
+    slice_hashes = features.row_hashes[slice_index, :n_rows]
+    reference_windows = sliding_window_view(features.row_hashes[reference_index],
+                                            n_rows)
+    candidates = np.flatnonzero(reference_windows[:, 0] == slice_hashes[0])
+    is_exact = np.all(reference_windows[candidates] == slice_hashes, axis=1)
+    return candidates[is_exact]
+
+
+def find_covering_images(features: ifeat.FrameFeatures,
+                         n_rows: int,
+                         min_overlap: int
+                         ) -> List[int]:
+    """
+    Find the indices of a subset of a series of images, joined vertically top
+    wise, that still covers all of its rows, so only the subset has to be matched
+    and joined. From each kept image, the furthest image is kept next whose top
+    n_rows have a single exact match in the kept image, by their row hashes, that
+    overlaps it by at least min_overlap rows. If there is none, the next image is
+    kept. The first and last images are always kept.
+    """
+    n_images, height = features.row_hashes.shape
+    max_offset = height - min_overlap
+    kept_indices = [0]
+    while kept_indices[-1] < n_images - 1:
+        kept_index = kept_indices[-1]
+        next_index = kept_index + 1
+        while next_index + 1 < n_images:
+            exact_offsets = find_exact_offsets(features, next_index + 1, kept_index,
+                                               n_rows)
+            if len(exact_offsets) != 1 or exact_offsets[0] > max_offset:
+                break
+            next_index += 1
+        kept_indices.append(next_index)
+    return kept_indices
+
+
+def compute_exact_match_scores(features: ifeat.FrameFeatures,
+                               slice_index: int,
+                               reference_index: int,
+                               n_rows: int,
+                               match_score_threshold: float,
+                               metric: str = "cosine"
+                               ) -> Optional[np.ndarray]:
+    """
+    Find the match scores of the top n_rows of image slice_index against image
+    reference_index from an exact match of their row hashes. The offset is
+    confirmed by scoring it alone with the metric.
+
+    Returns the scores of all offsets, with np.inf at every offset but the exact
+    match, or None if there is no single exact match that is below the match
+    score threshold. Then the offsets must be searched by their match scores.
+    """
+    exact_offsets = find_exact_offsets(features, slice_index, reference_index, n_rows)
+    if len(exact_offsets) != 1:
+        return None
+
+    offset = exact_offsets[0]
+    score = compute_match_scores_at_offsets(features, slice_index, reference_index,
+                                            n_rows, exact_offsets, metric=metric)[0]
+    if not score <= match_score_threshold:
+        return None
+
+    match_scores = np.full(features.grayscale.shape[1] - n_rows + 1, np.inf)
+    match_scores[offset] = score
+    return match_scores
+
+
+# Fraction of the match score threshold that the best match in a search window
+# must be below to be used without searching all offsets. Offsets near the true
+# one, and content that repeats further away, score well below the threshold too,
+# so only a nearly exact match is taken as the true one.
+WINDOW_SCORE_FRACTION = 0.01
+
+
+def window_match_is_unambiguous(match_scores: np.ndarray,
+                                match_score_threshold: float) -> bool:
+    """
+    Check if the best match of the scores of a search window, with np.inf outside
+    of the window, can be used without searching all offsets: it scores below
+    WINDOW_SCORE_FRACTION of the threshold, and it is not on an edge of the
+    window, beyond which a better match could be.
+    """
+    searched = np.flatnonzero(np.isfinite(match_scores))
+    if len(searched) == 0:
+        return False
+    best_offset = np.argmin(match_scores)
+    on_edge = (best_offset == searched[0] and best_offset > 0) \
+        or (best_offset == searched[-1] and best_offset < len(match_scores) - 1)
+    return not on_edge \
+        and match_scores[best_offset] <= match_score_threshold * WINDOW_SCORE_FRACTION
+
+
+def find_search_window(args, predicted_offset: Optional[int]
+                       ) -> Optional[Tuple[int, int]]:
+    """
+    Find the window of row offsets to search first, from the offset predicted by
+    the previous pair and the maximum scroll per image in args. Returns None if
+    all offsets should be searched.
+    """
+    low_offset, high_offset = 0, np.iinfo(np.int64).max
+    if predicted_offset is not None and args.search_window > 0:
+        low_offset = predicted_offset - args.search_window
+        high_offset = predicted_offset + args.search_window
+    if args.max_scroll_per_frame > 0:
+        high_offset = min(high_offset, args.max_scroll_per_frame)
+        # A prediction beyond the maximum scroll is ignored
+        low_offset = min(low_offset, max(high_offset - 2 * args.search_window, 0))
+
+    if low_offset <= 0 and high_offset == np.iinfo(np.int64).max:
+        return None
+    return low_offset, high_offset
+
+
+def search_match_scores(args,
+                        pyramid: ifeat.FeaturePyramid,
+                        slice_index: int,
+                        reference_index: int,
+                        predicted_offset: Optional[int] = None
+                        ) -> np.ndarray:
+    """
+    Compute the match scores of image slice_index against image reference_index
+    with the search mode and metric in args.
+
+    Unless disabled in args, a single exact match of the row hashes is used
+    without searching. If a search window is set in args, only the offsets in the
+    window are searched first. Unless the best match in the window is
+    unambiguous, see window_match_is_unambiguous, the search is widened to all
+    offsets.
+    """
+    if args.exact_match:
+        match_scores = compute_exact_match_scores(pyramid[0],
+                                                  slice_index, reference_index,
+                                                  args.n_rows_in_crop,
+                                                  args.match_score_threshold,
+                                                  args.metric)
+        if match_scores is not None:
+            return match_scores
+        logging.debug("no single exact match, searching match scores")
+
+    window = find_search_window(args, predicted_offset)
+    if window is not None:
+        match_scores = compute_match_scores_in_window(pyramid[0],
+                                                      slice_index, reference_index,
+                                                      args.n_rows_in_crop, *window,
+                                                      args.kernel, args.metric)
+        if window_match_is_unambiguous(match_scores, args.match_score_threshold):
+            return match_scores
+        logging.debug(f"no unambiguous match in search window {window}, "
+                      + "searching all offsets")
+
+    if args.search_mode == "pyramid":
+        return compute_pyramid_match_scores(pyramid, slice_index, reference_index,
+                                            args.n_rows_in_crop,
+                                            args.pyramid_candidates,
+                                            args.kernel, args.metric)
+    return compute_match_scores_of_features(pyramid[0], slice_index, reference_index,
+                                            args.n_rows_in_crop, args.kernel,
+                                            args.metric)
+
+
+def compute_pairwise_match_scores(args,
+                                  pyramid: ifeat.FeaturePyramid,
+                                  profiler=None,
+                                  first_pair_index: int = 0,
+                                  predicted_offset: Optional[int] = None
+                                  ) -> List[np.ndarray]:
+    """
+    Compute the match scores of every adjacent pair of images, such that index i
+    holds the match scores of image i + 1 against image i. The best offset of
+    each pair is used to predict the search window of the next pair, and
+    predicted_offset that of the first pair.
+
+    If a profiler (see profiling.py) is given, the search of each pair is
+    recorded in it, numbered from first_pair_index.
+    """
+    match_scores = []
+    for i in range(pyramid[0].grayscale.shape[0] - 1):
+        pair_index = first_pair_index + i
+        logging.info(f"computing match scores for crop {pair_index}")
+        begin_wall_time = time.perf_counter()
+        begin_cpu_time = time.process_time()
+        match_scores.append(search_match_scores(args, pyramid, i + 1, i,
+                                                predicted_offset))
+        if profiler is not None:
+            profiler.add_pair(pair_index, match_scores[-1],
+                              time.perf_counter() - begin_wall_time,
+                              time.process_time() - begin_cpu_time)
+        predicted_offset = int(np.argmin(match_scores[-1]))
+    return match_scores
+
+
+def compute_pairwise_match_scores_in_chunks(args,
+                                            features_folder: str,
+                                            indices: Sequence[int],
+                                            n_pairs_per_chunk: int,
+                                            profiler=None
+                                            ) -> List[np.ndarray]:
+    """
+    Compute the match scores of every adjacent pair of the images at the given
+    indices of the features written to features_folder by
+    ifeat.write_frame_features_to_memmap, as compute_pairwise_match_scores,
+    n_pairs_per_chunk pairs at a time. Only the features of the images of one
+    chunk, and their pyramid, are in memory at a time. Gives the same match
+    scores as matching all pairs at once.
+    """
+    match_scores = []
+    predicted_offset = None
+    n_pairs = len(indices) - 1
+    for first_pair_index in range(0, n_pairs, n_pairs_per_chunk):
+        stop = min(first_pair_index + n_pairs_per_chunk, n_pairs) + 1
+        chunk = ifeat.load_frame_features(features_folder,
+                                          indices[first_pair_index:stop])
+        pyramid = build_search_pyramid(args, chunk)
+        match_scores += compute_pairwise_match_scores(args, pyramid, profiler,
+                                                      first_pair_index,
+                                                      predicted_offset)
+        predicted_offset = int(np.argmin(match_scores[-1]))
+    return match_scores
+
+
+def get_crop_direction(args, pyramid: ifeat.FeaturePyramid) -> str:
     """
     Get the direction of the crop. This is done by comparing the match scores
     of the top slice of the crop and the reference image, and the bottom slice
     of the crop and the reference image. The direction of the crop is the
     direction with the lowest match score.
     """
-    logging.debug("Getting crop function")
-    scroll_crop_0 = crop_images[0]
-    scroll_crop_1 = crop_images[1]
-
-    logging.debug("Computing top slice crop 0")
-    top_left_crop_0 = ip.crop_image_slice(scroll_crop_0,
-                                          args.n_rows_in_crop,
-                                          args.n_cols_in_crop,
-                                          args.left_crop_from,
-                                          args.left_crop_to,
-                                          args.right_crop_from,
-                                          args.right_crop_to)
-    logging.debug("Computing top slice crop 1")
-    top_left_crop_1 = ip.crop_image_slice(scroll_crop_1,
-                                          args.n_rows_in_crop,
-                                          args.n_cols_in_crop,
-                                          args.left_crop_from,
-                                          args.left_crop_to,
-                                          args.right_crop_from,
-                                          args.right_crop_to)
-    logging.debug("Computing reference crop 0")
-    left_crop_0 = ip.crop_image_reference(scroll_crop_0,
-                                          args.n_cols_in_crop,
-                                          args.left_crop_from,
-                                          args.left_crop_to,
-                                          args.right_crop_from,
-                                          args.right_crop_to)
-    logging.debug("Computing reference crop 1")
-    left_crop_1 = ip.crop_image_reference(scroll_crop_1,
-                                          args.n_cols_in_crop,
-                                          args.left_crop_from,
-                                          args.left_crop_to,
-                                          args.right_crop_from,
-                                          args.right_crop_to)
-
     logging.debug("Computing top match scores")
-    top_match_scores = compute_match_scores(top_left_crop_1, left_crop_0)
+    top_match_scores = search_match_scores(args, pyramid, 1, 0)
     logging.debug("Computing bottom match scores")
-    bottom_match_scores = compute_match_scores(top_left_crop_0, left_crop_1)
+    bottom_match_scores = search_match_scores(args, pyramid, 0, 1)
 
     logging.debug("Finding min scores")
     top_min_score = np.min(top_match_scores)
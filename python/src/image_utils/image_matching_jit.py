@@ -0,0 +1,111 @@
+"""
+Compiled scoring kernels of the matcher, used when numba is installed. They
+compute the cosine match scores of image_matching.batched_score_function with
+fused loops, without building the windows or row products as temporary arrays.
+The numpy functions in image_matching are the reference, and the kernels must be
+kept in line with them.
+
+Full curves of match scores are faster with the matrix product of numpy, so the
+kernels are used by default only for scores at scattered offsets, which numpy
+has to gather the windows of. The kernels are compiled on their first call, and
+cached on disk by numba for later processes.
+"""
+import os
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+AVAILABLE = numba is not None
+
+# Most columns whose uint8 products fit in the int32 sum of a row
+MAX_INT32_ROW_LENGTH = np.iinfo(np.int32).max // (255 * 255)
+
+
+def float_scores_at_offsets(grayscale_slice: np.ndarray,
+                            grayscale_reference: np.ndarray,
+                            slice_row_squared_norms: np.ndarray,
+                            reference_row_squared_norms: np.ndarray,
+                            offsets: np.ndarray
+                            ) -> np.ndarray:
+    """
+    Compute the cosine match scores of the grayscale slice against the window of
+    the grayscale reference at each of the row offsets, summing in float64.
+    """
+    n_rows, n_cols = grayscale_slice.shape
+    slice_norm = np.sqrt(np.sum(slice_row_squared_norms))
+    match_scores = np.empty(len(offsets))
+    for j in range(len(offsets)):
+        offset = offsets[j]
+        dot_product = 0.0
+        reference_squared_norm = 0.0
+        for i in range(n_rows):
+            reference_squared_norm += reference_row_squared_norms[offset + i]
+            for c in range(n_cols):
+                dot_product += grayscale_reference[offset + i, c] * grayscale_slice[i, c]
+        match_scores[j] = 1 - dot_product / (slice_norm
+                                             * np.sqrt(reference_squared_norm))
+    return match_scores
+
+
+def integer_scores_at_offsets(grayscale_slice: np.ndarray,
+                              grayscale_reference: np.ndarray,
+                              slice_row_squared_norms: np.ndarray,
+                              reference_row_squared_norms: np.ndarray,
+                              offsets: np.ndarray
+                              ) -> np.ndarray:
+    """
+    Compute the cosine match scores of the uint8 grayscale slice against the
+    window of the grayscale reference at each of the row offsets, with exact
+    integer dot products. Rows must have at most MAX_INT32_ROW_LENGTH columns.
+    """
+    n_rows, n_cols = grayscale_slice.shape
+    slice_norm = np.sqrt(np.sum(slice_row_squared_norms))
+    match_scores = np.empty(len(offsets))
+    for j in range(len(offsets)):
+        offset = offsets[j]
+        dot_product = 0
+        reference_squared_norm = 0
+        for i in range(n_rows):
+            reference_squared_norm += reference_row_squared_norms[offset + i]
+            row_dot_product = np.int32(0)
+            for c in range(n_cols):
+                row_dot_product += (np.int32(grayscale_reference[offset + i, c])
+                                    * np.int32(grayscale_slice[i, c]))
+            dot_product += row_dot_product
+        match_scores[j] = 1 - dot_product / (slice_norm
+                                             * np.sqrt(reference_squared_norm))
+    return match_scores
+
+
+if AVAILABLE:
+    # Frozen builds have no source file for numba to cache the kernels next to
+    cache = os.path.exists(__file__)
+    float_scores_at_offsets = numba.njit(cache=cache, fastmath=True)(
+        float_scores_at_offsets)
+    integer_scores_at_offsets = numba.njit(cache=cache, fastmath=True)(
+        integer_scores_at_offsets)
+
+
+def compute_match_scores_at_offsets(grayscale_slice: np.ndarray,
+                                    grayscale_reference: np.ndarray,
+                                    slice_row_squared_norms: np.ndarray,
+                                    reference_row_squared_norms: np.ndarray,
+                                    offsets: np.ndarray
+                                    ) -> np.ndarray:
+    """
+    Compute the match scores of the grayscale slice against the grayscale
+    reference at the given row offsets, with the kernel for their dtype.
+    """
+    if grayscale_slice.dtype == np.uint8 \
+            and grayscale_slice.shape[1] <= MAX_INT32_ROW_LENGTH:
+        kernel = integer_scores_at_offsets
+    else:
+        kernel = float_scores_at_offsets
+    return kernel(grayscale_slice, grayscale_reference,
+                  slice_row_squared_norms, reference_row_squared_norms,
+                  np.asarray(offsets, dtype=np.int64))
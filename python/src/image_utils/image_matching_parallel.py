@@ -0,0 +1,150 @@
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import List, Tuple
+
+import numpy as np
+from image_utils import image_features as ifeat
+from image_utils import image_matching as im
+
+
+# (shared memory name, shape, dtype) of an array in shared memory
+SharedArrayDescriptor = Tuple[str, Tuple[int, ...], str]
+
+# Descriptors of the arrays of each FrameFeatures in a FeaturePyramid
+PyramidDescriptor = List[List[SharedArrayDescriptor]]
+
+# The pool of worker processes, kept alive between calls by get_executor
+_executor = None
+_executor_workers = 0
+
+# Set in each worker process by attach_shared_frame_features
+_worker_pyramid = None
+_worker_shared_memories = []
+_worker_descriptors = None
+
+
+def get_executor(n_workers: int) -> ProcessPoolExecutor:
+    """
+    Get a pool of n_workers worker processes. The pool is reused between calls,
+    such that a long running process (see server.py) only starts its workers once.
+    """
+    global _executor, _executor_workers
+    if _executor is not None and _executor_workers != n_workers:
+        shutdown_executor()
+    if _executor is None:
+        logging.debug(f"Starting pool of {n_workers} workers")
+        _executor = ProcessPoolExecutor(max_workers=n_workers)
+        _executor_workers = n_workers
+    return _executor
+
+
+def shutdown_executor():
+    """
+    Shut down the pool of worker processes, if it is running.
+    """
+    global _executor, _executor_workers
+    if _executor is not None:
+        _executor.shutdown()
+    _executor = None
+    _executor_workers = 0
+
+
+def share_array(array: np.ndarray
+                ) -> Tuple[shared_memory.SharedMemory, SharedArrayDescriptor]:
+    """
+    Copy an array into a new block of shared memory. Returns the shared memory,
+    which the caller must close and unlink, and a descriptor that workers can
+    use to attach to it.
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    np.copyto(shared_array, array)
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def attach_shared_array(descriptor: SharedArrayDescriptor
+                        ) -> Tuple[shared_memory.SharedMemory, np.ndarray]:
+    """
+    Attach to an array shared by share_array, without copying it.
+    """
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def attach_shared_feature_pyramid(descriptors: PyramidDescriptor):
+    """
+    Attach a worker process to the shared feature pyramid. Stays attached until
+    the worker is handed the pyramid of another call.
+    """
+    global _worker_pyramid, _worker_shared_memories, _worker_descriptors
+    if descriptors == _worker_descriptors:
+        return
+
+    _worker_pyramid = None
+    for shm in _worker_shared_memories:
+        shm.close()
+
+    _worker_shared_memories = []
+    _worker_pyramid = []
+    for level_descriptors in descriptors:
+        attached = [attach_shared_array(descriptor) for descriptor in level_descriptors]
+        _worker_shared_memories.extend(shm for shm, _ in attached)
+        _worker_pyramid.append(ifeat.FrameFeatures(*[array for _, array in attached]))
+    _worker_descriptors = descriptors
+
+
+def compute_match_scores_of_pair(descriptors: PyramidDescriptor,
+                                 args,
+                                 pair_index: int
+                                 ) -> Tuple[np.ndarray, float, float]:
+    """
+    Compute the match scores of image pair_index + 1 against image pair_index,
+    in a worker process. Returns the match scores, and the wall time and CPU time
+    the worker spent on them.
+    """
+    begin_wall_time = time.perf_counter()
+    begin_cpu_time = time.process_time()
+    attach_shared_feature_pyramid(descriptors)
+    match_scores = im.search_match_scores(args, _worker_pyramid,
+                                          pair_index + 1, pair_index)
+    return (match_scores,
+            time.perf_counter() - begin_wall_time,
+            time.process_time() - begin_cpu_time)
+
+
+def compute_pairwise_match_scores(args,
+                                  pyramid: ifeat.FeaturePyramid,
+                                  profiler=None
+                                  ) -> List[np.ndarray]:
+    """
+    Compute the match scores of every adjacent pair of images, spread across a
+    pool of args.workers processes. The feature pyramid is handed to the workers
+    through shared memory, and the scores are returned in pair order.
+
+    If a profiler (see profiling.py) is given, the search of each pair is
+    recorded in it.
+    """
+    n_pairs = pyramid[0].grayscale.shape[0] - 1
+    shared = [[share_array(array) for array in features] for features in pyramid]
+    try:
+        descriptors = [[descriptor for _, descriptor in level] for level in shared]
+        logging.debug(f"Matching {n_pairs} pairs across {args.workers} workers")
+        executor = get_executor(args.workers)
+        match_scores = []
+        for i, (pair_match_scores, wall_time, cpu_time) in enumerate(
+                executor.map(compute_match_scores_of_pair,
+                             [descriptors] * n_pairs,
+                             [args] * n_pairs,
+                             range(n_pairs))):
+            if profiler is not None:
+                profiler.add_pair(i, pair_match_scores, wall_time, cpu_time)
+            match_scores.append(pair_match_scores)
+        return match_scores
+    finally:
+        for level in shared:
+            for shm, _ in level:
+                shm.close()
+                shm.unlink()
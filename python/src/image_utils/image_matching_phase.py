@@ -0,0 +1,251 @@
+"""
+Phase correlation matcher, used with --search_mode phase. The shift between two
+crop images is found from the peak of the inverse Fourier transform of their
+normalized cross-power spectrum, in both rows and columns at once, so frames
+that also moved sideways, such as in a window that was nudged while scrolling,
+are matched too. The spectrum of each crop image is computed once, so each pair
+costs one inverse transform instead of scoring every row offset, and the sign
+of the row shift of the first pair gives the scroll direction.
+
+The planes are correlated at a resolution reduced by PHASE_SCALE, and the
+shift is refined by the match scores of the shifts around it at full resolution,
+with the metric in args, as in image_matching. The score of a shift only covers
+the top rows of a frame, which many wrong shifts of bright content match below
+the match score threshold, so a shift is only used if it matches nearly
+exactly, as a match in a search window (see im.window_match_is_unambiguous).
+Other pairs are searched by their match scores instead.
+"""
+import logging
+import time
+from functools import lru_cache
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+from image_utils import image_features as ifeat
+from image_utils import image_matching as im
+
+# Factor the planes are downsampled by before they are correlated
+PHASE_SCALE = 2
+
+
+class PhaseFrame(NamedTuple):
+    """
+    A crop image prepared for phase correlation: its grayscale plane over all
+    columns, in the precision of args, and the spectrum of that plane,
+    downsampled by PHASE_SCALE.
+    """
+    crop_image: np.ndarray
+    grayscale: np.ndarray
+    spectrum: np.ndarray
+
+
+@lru_cache(maxsize=4)
+def hann_window(shape: Tuple[int, int]) -> np.ndarray:
+    """
+    Get a 2D Hann window of the given shape, which fades the edges of a plane to
+    zero, so they do not wrap around in its spectrum.
+    """
+    return np.outer(np.hanning(shape[0]), np.hanning(shape[1]))
+
+
+def compute_phase_frame(args, crop_image: np.ndarray) -> PhaseFrame:
+    """
+    Convert a crop image to grayscale, and compute the spectrum of the zero-mean
+    grayscale plane under a Hann window, after averaging blocks of PHASE_SCALE
+    pixels. Trailing rows and columns that do not fill a block are dropped.
+    """
+    grayscale = ifeat.convert_to_grayscale(crop_image, args.precision)
+    height = grayscale.shape[0] // PHASE_SCALE
+    width = grayscale.shape[1] // PHASE_SCALE
+    plane = grayscale[:height * PHASE_SCALE, :width * PHASE_SCALE] \
+        .reshape(height, PHASE_SCALE, width, PHASE_SCALE).mean(axis=(1, 3))
+    plane -= plane.mean()
+    plane *= hann_window(plane.shape)
+    return PhaseFrame(crop_image, grayscale, np.fft.rfft2(plane))
+
+
+def find_peak_shift(reference: PhaseFrame, image_slice: PhaseFrame) -> Tuple[int, int]:
+    """
+    Find the shift (row, column) of the peak of the phase correlation of two
+    frames, such that image_slice[y, x] is about reference[y + row, x + column],
+    at full resolution. The row is in [0, height), so a negative row shift is
+    found as height plus the shift, and the column is the signed shift closest
+    to zero.
+    """
+    cross_power = reference.spectrum * np.conj(image_slice.spectrum)
+    cross_power /= np.maximum(np.abs(cross_power), np.finfo(np.float64).tiny)
+    shape = tuple(np.array(reference.grayscale.shape) // PHASE_SCALE)
+    correlation = np.fft.irfft2(cross_power, s=shape)
+    row, column = np.unravel_index(np.argmax(correlation), correlation.shape)
+    if column > shape[1] // 2:
+        column -= shape[1]
+    return int(row) * PHASE_SCALE, int(column) * PHASE_SCALE
+
+
+def score_shift(args,
+                reference: PhaseFrame,
+                image_slice: PhaseFrame,
+                offset: int,
+                column_shift: int
+                ) -> float:
+    """
+    Compute the match score of the top args.n_rows_in_crop rows of image_slice
+    against the rows of reference from offset, shifted by column_shift columns,
+    over the columns both frames hold. Returns np.inf if the shifted slice is not
+    within the reference.
+    """
+    height, width = reference.grayscale.shape
+    n_rows = args.n_rows_in_crop
+    if not 0 <= offset <= height - n_rows or abs(column_shift) >= width:
+        return np.inf
+
+    n_columns = width - abs(column_shift)
+    slice_from = max(-column_shift, 0)
+    reference_from = max(column_shift, 0)
+    grayscale_slice = image_slice.grayscale[:n_rows, slice_from:slice_from + n_columns]
+    grayscale_reference = reference.grayscale[offset:offset + n_rows,
+                                              reference_from:reference_from + n_columns]
+    return float(im.METRICS[args.metric].match_scores(
+        grayscale_slice, grayscale_reference,
+        ifeat.compute_row_squared_norms(grayscale_slice),
+        ifeat.compute_row_squared_norms(grayscale_reference),
+        np.array([0]))[0])
+
+
+def refine_shift(args,
+                 reference: PhaseFrame,
+                 image_slice: PhaseFrame,
+                 offset: int,
+                 column_shift: int
+                 ) -> Tuple[int, int, float]:
+    """
+    Refine a shift found at the resolution of the phase correlation, by scoring
+    the shifts within PHASE_SCALE - 1 rows and columns of it at full resolution,
+    see score_shift. Returns the offset, column shift and match score of the
+    best of them.
+    """
+    best_shift = (offset, column_shift, np.inf)
+    for row_step in range(1 - PHASE_SCALE, PHASE_SCALE):
+        for column_step in range(1 - PHASE_SCALE, PHASE_SCALE):
+            score = score_shift(args, reference, image_slice, offset + row_step,
+                                column_shift + column_step)
+            if score < best_shift[2]:
+                best_shift = (offset + row_step, column_shift + column_step, score)
+    return best_shift
+
+
+def shift_is_exact(args, score: float) -> bool:
+    """
+    Check if the match score of a shift is low enough to use the shift without
+    searching the match scores of all offsets.
+    """
+    return score <= args.match_score_threshold * im.WINDOW_SCORE_FRACTION
+
+
+def build_pair_pyramid(args, reference: PhaseFrame, image_slice: PhaseFrame
+                       ) -> ifeat.FeaturePyramid:
+    """
+    Build the search pyramid of the crop images of two frames, to search their
+    match scores with image_matching.
+    """
+    features = ifeat.compute_frame_features([reference.crop_image,
+                                             image_slice.crop_image],
+                                            args.n_cols_in_crop,
+                                            args.left_crop_from,
+                                            args.left_crop_to,
+                                            args.right_crop_from,
+                                            args.right_crop_to,
+                                            args.precision)
+    return im.build_search_pyramid(args, features)
+
+
+def search_match_scores(args,
+                        reference: PhaseFrame,
+                        image_slice: PhaseFrame,
+                        predicted_offset: Optional[int] = None
+                        ) -> Tuple[np.ndarray, int]:
+    """
+    Find the shift of image_slice below reference by phase correlation. Returns
+    the match scores of all row offsets, with np.inf at every offset but the
+    shift, and the column shift, such that image_slice[y, x] is
+    reference[y + offset, x + column_shift].
+
+    If the shift does not match nearly exactly (see shift_is_exact), the offsets
+    are searched by their match scores instead, with im.search_match_scores, and
+    the column shift is 0.
+    """
+    offset, column_shift = find_peak_shift(reference, image_slice)
+    offset, column_shift, score = refine_shift(args, reference, image_slice,
+                                               offset, column_shift)
+    if shift_is_exact(args, score):
+        match_scores = np.full(reference.grayscale.shape[0] - args.n_rows_in_crop + 1,
+                               np.inf)
+        match_scores[offset] = score
+        return match_scores, column_shift
+
+    logging.debug(f"phase shift ({offset}, {column_shift}) scores {score}, "
+                  + "searching match scores")
+    pyramid = build_pair_pyramid(args, reference, image_slice)
+    return im.search_match_scores(args, pyramid, 1, 0, predicted_offset), 0
+
+
+def get_crop_direction(args, first: PhaseFrame, second: PhaseFrame) -> str:
+    """
+    Get the direction of the crop from the phase correlation of the first two
+    frames. The peak row gives the scroll in both directions, modulo the height:
+    the second frame below the first, scrolling down, or the first frame below
+    the second, scrolling up. The direction is the one with the lowest match
+    score, as in im.get_crop_direction. If neither matches nearly exactly (see
+    shift_is_exact), the direction is found by im.get_crop_direction instead.
+    """
+    row, column_shift = find_peak_shift(first, second)
+    height = first.grayscale.shape[0]
+    top_min_score = refine_shift(args, first, second, row, column_shift)[2]
+    bottom_min_score = refine_shift(args, second, first, (height - row) % height,
+                                    -column_shift)[2]
+
+    logging.debug(f"phase shift: ({row}, {column_shift}), "
+                  + f"top_min_score: {top_min_score}, "
+                  + f"bottom_min_score: {bottom_min_score}")
+    if not shift_is_exact(args, min(top_min_score, bottom_min_score)):
+        logging.debug("no exact phase shift, searching match scores for direction")
+        return im.get_crop_direction(args, build_pair_pyramid(args, first, second))
+    if top_min_score < bottom_min_score:
+        return "down"
+    return "up"
+
+
+def compute_pairwise_match_scores(args,
+                                  crop_images: Sequence[np.ndarray],
+                                  profiler=None
+                                  ) -> Tuple[List[np.ndarray], np.ndarray]:
+    """
+    Find the shift of every adjacent pair of crop images by phase correlation,
+    such that index i holds the match scores of image i + 1 against image i, as
+    im.compute_pairwise_match_scores, and the column shift of image i + 1
+    against image i. Only the frames of one pair are prepared at a time.
+
+    If a profiler (see profiling.py) is given, the search of each pair is
+    recorded in it.
+    """
+    match_scores = []
+    column_shifts = []
+    predicted_offset = None
+    reference = compute_phase_frame(args, crop_images[0])
+    for i in range(len(crop_images) - 1):
+        logging.info(f"computing phase shift for crop {i}")
+        begin_wall_time = time.perf_counter()
+        begin_cpu_time = time.process_time()
+        image_slice = compute_phase_frame(args, crop_images[i + 1])
+        pair_match_scores, column_shift = search_match_scores(args, reference,
+                                                              image_slice,
+                                                              predicted_offset)
+        if profiler is not None:
+            profiler.add_pair(i, pair_match_scores,
+                              time.perf_counter() - begin_wall_time,
+                              time.process_time() - begin_cpu_time)
+        match_scores.append(pair_match_scores)
+        column_shifts.append(column_shift)
+        predicted_offset = int(np.argmin(pair_match_scores))
+        reference = image_slice
+    return match_scores, np.array(column_shifts, dtype=np.int64)
@@ -1,3 +1,5 @@
+import logging
+from functools import lru_cache
 from typing import List, Tuple
 from collections.abc import Iterable
 
@@ -102,6 +104,98 @@ def find_frame_boundary_of_npimage_filter(filter_frame: np.ndarray
     return left_bound, right_bound, top_bound, bottom_bound
 
 
+def find_content_lines(base_image: np.ndarray,
+                       other_image: np.ndarray,
+                       denoising_factor: float,
+                       axis: int,
+                       lines: np.ndarray,
+                       span: slice
+                       ) -> np.ndarray:
+    """
+    Find which of the given lines (rows for axis 0, columns for axis 1) of the
+    base image hold content at full resolution: more than denoising_factor of
+    their pixels differ from the other image, as in denoise_filter_by_factor, and
+    some of those pixels lie in the span of the other axis.
+    """
+    base_lines = np.take(base_image, lines, axis=axis)
+    other_lines = np.take(other_image, lines, axis=axis)
+    filter_lines = ((base_lines - other_lines) >= 10).any(axis=2)
+    is_dense = np.mean(filter_lines, axis=1 - axis) > denoising_factor
+    in_span = filter_lines[span].any(axis=0) if axis == 1 \
+        else filter_lines[:, span].any(axis=1)
+    return is_dense & in_span
+
+
+def refine_bound(base_image: np.ndarray,
+                 other_image: np.ndarray,
+                 denoising_factor: float,
+                 axis: int,
+                 lines: np.ndarray,
+                 span: slice,
+                 first: bool,
+                 default: int
+                 ) -> int:
+    """
+    Find the first (or last) of the given lines that holds content at full
+    resolution, see find_content_lines. Returns default if none of them do.
+    """
+    lines = lines[(lines >= 0) & (lines < base_image.shape[axis])]
+    is_content = find_content_lines(base_image, other_image, denoising_factor,
+                                    axis, lines, span)
+    if not is_content.any():
+        return default
+    return int(lines[is_content][0 if first else -1])
+
+
+def find_frame_boundary_at_reduced_resolution(base_image: np.ndarray,
+                                              other_image: np.ndarray,
+                                              denoising_factor: float,
+                                              scale: int
+                                              ) -> Tuple[int, int, int, int]:
+    """
+    Find the frame boundary of the base image, using the other image as
+    reference, without building the filter frame at full resolution. The bounds
+    are searched in a filter frame of every scale-th pixel first, after which
+    each bound is refined at full resolution between it and the edge of the
+    image, which only covers the boundaries of the image. The coordinates are
+    returned as (left, right, top, bottom), like
+    find_frame_boundary_of_npimage_filter, of which they are an estimate.
+    """
+    if scale <= 1:
+        filter_frame = create_npimage_filter(base_image, other_image, denoising_factor)
+        return find_frame_boundary_of_npimage_filter(filter_frame)
+
+    filter_frame = create_npimage_filter(base_image[::scale, ::scale],
+                                         other_image[::scale, ::scale],
+                                         denoising_factor)
+    if not filter_frame.any():
+        logging.debug("no content at reduced resolution, searching full resolution")
+        return find_frame_boundary_at_reduced_resolution(base_image, other_image,
+                                                         denoising_factor, 1)
+
+    (left, right, top, bottom) = find_frame_boundary_of_npimage_filter(filter_frame)
+    rows = slice(max(0, (top - 1) * scale), bottom * scale)
+    cols = slice(max(0, (left - 1) * scale), right * scale)
+
+    # Sparse content, like text, can be missed by the sampled lines, so each
+    # bound is refined in all lines from the edge of the image to one sample
+    # inside the bound found
+    height, width = base_image.shape[:2]
+    left = refine_bound(base_image, other_image, denoising_factor, 1,
+                        np.arange(0, (left + 1) * scale), rows,
+                        True, left * scale)
+    right = refine_bound(base_image, other_image, denoising_factor, 1,
+                         np.arange((right - 2) * scale, width), rows,
+                         False, (right - 1) * scale) + 1
+    top = refine_bound(base_image, other_image, denoising_factor, 0,
+                       np.arange(0, (top + 1) * scale), cols,
+                       True, top * scale)
+    bottom = refine_bound(base_image, other_image, denoising_factor, 0,
+                          np.arange((bottom - 2) * scale, height), cols,
+                          False, (bottom - 1) * scale) + 1
+    return left, right, top, bottom
+
+
 def create_content_boundary(base_image: np.ndarray,
                             reference_image: np.ndarray,
                             denoising_factor: float
@@ -312,25 +406,64 @@ def convert_to_grayscale(image: np.ndarray) -> np.ndarray:
     return np.dot(image[..., :3], [0.2989, 0.5870, 0.1140])
 
 
-def remove_initial_identical_crop_images(crop_images):
+# LUMA weights in fixed point, scaled by 2 ** 16, as used by Pillow
+LUMA_FIXED_POINT_WEIGHTS = np.array([19595, 38470, 7471], dtype=np.uint32)
+
+
+def convert_to_grayscale_fixed_point(image: np.ndarray) -> np.ndarray:
     """
-    Remove initial identical crop images from the list of crop images.
-    Two images are deemed identical if >90% of their pixels are the same.
+    Convert an image to 8-bit grayscale with the fixed-point LUMA transform of
+    Pillow, using integer arithmetic only.
     """
-    similarity = np.mean(crop_images[0] == crop_images[1])
+    luma = image[..., :3] @ LUMA_FIXED_POINT_WEIGHTS
+    return ((luma + 0x8000) >> 16).astype(np.uint8)
 
-    while similarity >= 0.90:
-        crop_images.pop(0)
-        similarity = np.mean(crop_images[0] == crop_images[1])
 
-    return crop_images
+@lru_cache(maxsize=None)
+def row_hash_weights(row_length: int) -> np.ndarray:
+    """
+    Get the fixed random weights of the row hashes of rows of row_length values.
+    The weights are odd, so every value of a row changes its hash.
+    """
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 2 ** 63, row_length, dtype=np.uint64) | np.uint64(1)
+
+
+def compute_row_hashes(image: np.ndarray) -> np.ndarray:
+    """
+    Hash each row of an image to a uint64, as the weighted sum of the values of
+    the row with wraparound. Equal rows always get equal hashes, and different
+    rows almost never do.
+    """
+    rows = image.reshape(image.shape[0], -1)
+    return rows @ row_hash_weights(rows.shape[1])
+
+
+def row_hashes_are_duplicates(row_hashes_0: np.ndarray,
+                              row_hashes_1: np.ndarray,
+                              threshold: float
+                              ) -> bool:
+    """
+    Two crop images are deemed duplicates if at least a threshold fraction of
+    their rows are the same, by their row hashes.
+    """
+    return np.mean(row_hashes_0 == row_hashes_1) >= threshold
 
 
-def remove_identical_crop_images(crop_images):
+def find_distinct_crop_images(crop_images, threshold: float) -> List[int]:
     """
-    Remove identical crop images from the list of crop images from the start
-    and end of list.
+    Find the indices of the crop images to keep when duplicates are removed
+    anywhere in the sequence, such as when scrolling paused in the middle of a
+    capture. Each crop image is hashed once. A run of crop images that are
+    duplicates of the first image of the run is reduced to the last image of the
+    run, which is the closest to the image after it.
     """
-    crop_images = remove_initial_identical_crop_images(crop_images)
-    crop_images = remove_initial_identical_crop_images(crop_images[::-1])
-    return crop_images[::-1]
+    run_row_hashes = compute_row_hashes(crop_images[0])
+    distinct_indices = []
+    for i in range(1, len(crop_images)):
+        row_hashes = compute_row_hashes(crop_images[i])
+        if not row_hashes_are_duplicates(run_row_hashes, row_hashes, threshold):
+            distinct_indices.append(i - 1)
+            run_row_hashes = row_hashes
+    distinct_indices.append(len(crop_images) - 1)
+    return distinct_indices
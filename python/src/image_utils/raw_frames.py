@@ -0,0 +1,194 @@
+"""
+Frames given as raw pixels instead of image files, so they are joined without
+being encoded to files and decoded again.
+
+Each frame is a header of five little-endian fields, followed by its rows:
+
+    magic     4 bytes, b"RAWF"
+    width     uint32, pixels per row
+    height    uint32, number of rows
+    stride    uint32, bytes per row, at least width * channels
+    channels  uint32, 3 for RGB or 4 for RGBA
+
+    height rows of stride bytes, of which the first width * channels bytes of
+    each row are the 8-bit pixels of the row
+
+Frames are read from a stream, such as stdin, until the end of the stream, or
+from a block of shared memory holding frames back to back, until a header with a
+height of 0 or the end of the block. The pixels are wrapped as numpy arrays
+without copying them, so the padding of each row is skipped by the strides of
+the array.
+"""
+import logging
+import os
+import struct
+import sys
+from collections.abc import Sequence
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+FRAME_MAGIC = b"RAWF"
+FRAME_HEADER = struct.Struct("<4sIIII")
+CHANNELS = (3, 4)
+
+# Source of --raw_frames that reads the frames from stdin
+STDIN_SOURCE = "-"
+
+
+def parse_frame_header(header: bytes) -> Tuple[int, int, int, int]:
+    """
+    Parse a frame header into the width, height, stride and channels of the
+    frame. Raises ValueError if the header is not a valid frame header.
+    """
+    magic, width, height, stride, channels = FRAME_HEADER.unpack(header)
+    if magic != FRAME_MAGIC:
+        raise ValueError(f"invalid raw frame magic {magic!r}")
+    if channels not in CHANNELS:
+        raise ValueError(f"raw frames must have 3 or 4 channels, not {channels}")
+    if stride < width * channels:
+        raise ValueError(f"raw frame stride {stride} is shorter than its rows of "
+                         + f"{width} pixels of {channels} channels")
+    return width, height, stride, channels
+
+
+def wrap_frame(buffer,
+               offset: int,
+               width: int,
+               height: int,
+               stride: int,
+               channels: int) -> np.ndarray:
+    """
+    Wrap the pixels of a frame at the offset of a buffer as an array of shape
+    (height, width, channels), without copying them.
+    """
+    rows = np.frombuffer(buffer, dtype=np.uint8, count=height * stride,
+                         offset=offset).reshape(height, stride)
+    return rows[:, :width * channels].reshape(height, width, channels)
+
+
+def read_buffer(stream: BinaryIO, n_bytes: int) -> Optional[bytearray]:
+    """
+    Read exactly n_bytes bytes of a stream straight into a new buffer. Returns
+    None if the stream has ended, and raises ValueError if it ends inside the
+    buffer.
+    """
+    buffer = bytearray(n_bytes)
+    view = memoryview(buffer)
+    n_read = 0
+    while n_read < n_bytes:
+        n_chunk_bytes = stream.readinto(view[n_read:])
+        if not n_chunk_bytes:
+            if n_read == 0:
+                return None
+            raise ValueError("raw frame stream ended inside a frame")
+        n_read += n_chunk_bytes
+    return buffer
+
+
+def read_frames(stream: BinaryIO) -> Iterator[np.ndarray]:
+    """
+    Read frames from a stream until it ends, and yield each frame as soon as it
+    has been read. Each frame is read straight into its own buffer.
+    """
+    while True:
+        header = stream.read(FRAME_HEADER.size)
+        if not header:
+            return
+        if len(header) < FRAME_HEADER.size:
+            raise ValueError("raw frame stream ended inside a frame header")
+        width, height, stride, channels = parse_frame_header(header)
+        buffer = read_buffer(stream, height * stride)
+        if buffer is None:
+            raise ValueError("raw frame stream ended inside a frame")
+        yield wrap_frame(buffer, 0, width, height, stride, channels)
+
+
+def read_shared_memory_frames(buffer) -> Iterator[np.ndarray]:
+    """
+    Yield the frames held back to back in a block of shared memory, until a
+    header with a height of 0 or the end of the block.
+    """
+    offset = 0
+    while offset + FRAME_HEADER.size <= len(buffer):
+        header = bytes(buffer[offset:offset + FRAME_HEADER.size])
+        if FRAME_HEADER.unpack(header)[2] == 0:
+            return
+        width, height, stride, channels = parse_frame_header(header)
+        offset += FRAME_HEADER.size
+        if offset + height * stride > len(buffer):
+            raise ValueError("raw frame extends past the end of the shared memory")
+        yield wrap_frame(buffer, offset, width, height, stride, channels)
+        offset += height * stride
+
+
+def attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    """
+    Attach to a block of shared memory created by another process, which stays
+    its owner.
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    if os.name == "posix":
+        # The resource tracker would otherwise unlink the block when this
+        # process exits, as if this process had created it
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+@contextmanager
+def open_raw_frames(source: str) -> Iterator[Iterator[np.ndarray]]:
+    """
+    Open the frames of a --raw_frames source: stdin if it is STDIN_SOURCE, and
+    otherwise the block of shared memory of that name. Frames in shared memory
+    are views of it, and it is detached when the with block is left.
+    """
+    if source == STDIN_SOURCE:
+        yield read_frames(sys.stdin.buffer)
+        return
+
+    shm = attach_shared_memory(source)
+    try:
+        yield read_shared_memory_frames(shm.buf)
+    finally:
+        try:
+            shm.close()
+        except BufferError:
+            # Frames are still referenced, the block is detached once they are freed
+            logging.debug(f"Shared memory {source} is still in use")
+
+
+class RawFrames(Sequence):
+    """
+    A sequence of frames that were read as raw pixels. If crop_indices is set,
+    each frame is cropped to that region, as a view. Indexing with a slice or a
+    list of indices returns a RawFrames of the selected frames, as LazyImages.
+    """
+
+    def __init__(self,
+                 frames: List[np.ndarray],
+                 crop_indices: Optional[Tuple[int, int, int, int]] = None):
+        self.frames = frames
+        self.crop_indices = crop_indices
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return RawFrames(self.frames[index], self.crop_indices)
+        if isinstance(index, list):
+            return RawFrames([self.frames[i] for i in index], self.crop_indices)
+
+        frame = self.frames[index]
+        if self.crop_indices is None:
+            return frame
+        (left, right, top, bottom) = self.crop_indices
+        return frame[top:bottom, left:right]
+
+    def crop(self, crop_indices: Tuple[int, int, int, int]) -> "RawFrames":
+        """
+        Get the same frames, cropped by crop_indices.
+        """
+        return RawFrames(self.frames, crop_indices)
@@ -0,0 +1,98 @@
+"""
+Frames of a screen recording, decoded by ffmpeg and streamed through a pipe as
+raw RGB frames, so a video is joined while it is decoded, without writing its
+frames to image files.
+
+Most frames of a recording show the same content as the frame before them, while
+the user is not scrolling. Frames that do not differ from the last kept frame by
+more than the noise of the video codec are dropped before they are matched.
+"""
+import logging
+import re
+import subprocess
+from typing import BinaryIO, Iterable, Iterator, Tuple
+
+import numpy as np
+from image_utils import raw_frames as rf
+
+# Size of the first video stream, in the stream info ffmpeg prints to stderr
+VIDEO_SIZE_PATTERN = re.compile(r"Stream #\S+.*: Video: .*?(\d{2,5})x(\d{2,5})")
+
+# Every CHANGE_STRIDE-th row and column of frames is compared for changes
+CHANGE_STRIDE = 4
+
+
+def probe_video_size(ffmpeg: str, video_path: str) -> Tuple[int, int]:
+    """
+    Find the width and height of the first video stream of a video file, from
+    the stream info printed by ffmpeg.
+    """
+    result = subprocess.run([ffmpeg, "-hide_banner", "-i", video_path],
+                            stdin=subprocess.DEVNULL, capture_output=True, text=True)
+    match = VIDEO_SIZE_PATTERN.search(result.stderr)
+    if match is None:
+        raise ValueError(f"no video stream found in {video_path}")
+    return int(match.group(1)), int(match.group(2))
+
+
+def read_rawvideo_frames(stream: BinaryIO,
+                         width: int,
+                         height: int) -> Iterator[np.ndarray]:
+    """
+    Read RGB frames of the given size from a rawvideo stream until it ends. Each
+    frame is read straight into its own buffer.
+    """
+    while True:
+        buffer = rf.read_buffer(stream, height * width * 3)
+        if buffer is None:
+            return
+        yield rf.wrap_frame(buffer, 0, width, height, width * 3, 3)
+
+
+def decode_video_frames(ffmpeg: str,
+                        video_path: str,
+                        fps: float = 0) -> Iterator[np.ndarray]:
+    """
+    Decode the frames of a video file with ffmpeg, and yield each frame as soon
+    as it has been decoded. If fps is set, the video is resampled to that many
+    frames per second first. ffmpeg is stopped if the frames are not all read.
+    """
+    width, height = probe_video_size(ffmpeg, video_path)
+    logging.debug(f"Decoding {width}x{height} video {video_path}")
+    command = [ffmpeg, "-v", "error", "-i", video_path]
+    if fps > 0:
+        command += ["-vf", f"fps={fps}"]
+    command += ["-f", "rawvideo", "-pix_fmt", "rgb24", "-"]
+
+    # stdout carries the frames, errors go to the stderr of this process
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE)
+    try:
+        yield from read_rawvideo_frames(process.stdout, width, height)
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        return_code = process.wait()
+    if return_code != 0:
+        raise ValueError(f"ffmpeg could not decode {video_path}")
+
+
+def skip_unchanged_frames(frames: Iterable[np.ndarray],
+                          change_threshold: float) -> Iterator[np.ndarray]:
+    """
+    Yield only the frames whose mean absolute difference to the last yielded
+    frame is above change_threshold, on a scale of 0 to 255, compared on every
+    CHANGE_STRIDE-th row and column. The first frame is always yielded.
+    """
+    last_sample = None
+    n_skipped = 0
+    for frame in frames:
+        sample = frame[::CHANGE_STRIDE, ::CHANGE_STRIDE].astype(np.int16)
+        if last_sample is not None and \
+                np.mean(np.abs(sample - last_sample)) <= change_threshold:
+            n_skipped += 1
+            continue
+        last_sample = sample
+        yield frame
+    logging.debug(f"Skipped {n_skipped} unchanged frames")
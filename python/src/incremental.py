@@ -0,0 +1,335 @@
+import argparse
+import itertools
+import logging
+import os
+import time
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import profiling
+from image_utils import boundary_cache as bc
+from image_utils import image_features as ifeat
+from image_utils import image_io as iio
+from image_utils import image_joining as ij
+from image_utils import image_matching as im
+from image_utils import image_matching_phase as imph
+from image_utils import image_processing as ip
+
+
+class IncrementalJoiner:
+    """
+    Joins images one at a time, while they are being captured.
+
+    The crop boundary is taken from the boundary cache if it holds the first
+    image, and otherwise fixed from the first args.boundary_frames images. The
+    scroll direction is fixed from the first two crop images that are not identical. After
+    that, each new image is matched against the image before it, and the rows it
+    contributes are added to the growing composite. As in chat_joiner, a run of
+    images that are duplicates of the first image of the run is reduced to the
+    last image of the run, so each image is matched when the image after it is
+    added, or when adding images is finished. With
+    --search_mode phase, the images are matched by phase correlation, and the
+    rows are also shifted into the columns of the first image.
+
+    If a profiler is given, the search of each image pair is recorded in it. If a
+    work folder is given, the growing composite is kept in a memmap file in it
+    instead of in memory.
+    """
+
+    def __init__(self,
+                 args: argparse.Namespace,
+                 profiler: Optional[profiling.Profiler] = None,
+                 work_folder: Optional[str] = None):
+        self.args = args
+        self.profiler = profiler
+        self.first_image: Optional[np.ndarray] = None
+        self.pending_images: List[np.ndarray] = []
+        self.crop_indices: Optional[Tuple[int, int, int, int]] = None
+        self.crop_direction: Optional[str] = None
+        self.first_crop_image: Optional[np.ndarray] = None
+        self.previous_crop_image: Optional[np.ndarray] = None
+        # Last crop image of the current run of duplicates, not matched yet, and
+        # the row hashes of the first crop image of the run
+        self.run_crop_image: Optional[np.ndarray] = None
+        self.run_row_hashes: Optional[np.ndarray] = None
+        self.previous_features: Optional[ifeat.FrameFeatures] = None
+        self.previous_offset: Optional[int] = None
+        self.previous_phase_frame: Optional[imph.PhaseFrame] = None
+        # Column shift of the previous crop image from the first one
+        self.previous_column_shift = 0
+        # Rows each matched image contributes to the composite, in capture order
+        self.strips: Sequence[np.ndarray] = []
+        if work_folder is not None:
+            self.strips = iio.MemmapStrips(os.path.join(work_folder, "composite.raw"))
+        self.n_strip_rows = 0
+
+    def add_image(self, image: np.ndarray):
+        """
+        Add the next captured image.
+        """
+        if self.first_image is None:
+            self.first_image = image
+            if self.args.boundary_cache:
+                self.crop_indices = bc.BoundaryCache(self.args.boundary_cache).get(image)
+                logging.debug("crop_indices from boundary cache: %s", self.crop_indices)
+
+        if self.crop_indices is not None:
+            self.add_crop_image(ip.crop_image_by_indices(image, self.crop_indices))
+            return
+
+        self.pending_images.append(image)
+        if len(self.pending_images) >= self.args.boundary_frames:
+            self.fix_crop_indices(force=False)
+
+    def fix_crop_indices(self, force: bool):
+        """
+        Fix the crop boundary from the pending images, and add them as crop
+        images. Unless forced, the boundary is not fixed while the pending images
+        do not differ.
+        """
+        # Checked at the resolution the boundary is searched at
+        scale = self.args.boundary_scale
+        filter_frame = ip.create_npimage_filter(self.pending_images[-1][::scale, ::scale],
+                                                self.pending_images[0][::scale, ::scale],
+                                                self.args.denoising_factor)
+        if not force and not filter_frame.any():
+            logging.debug("Pending images do not differ yet, waiting for more")
+            return
+
+        self.crop_indices = bc.find_crop_indices(self.pending_images,
+                                                 self.args.denoising_factor,
+                                                 self.args.boundary_scale,
+                                                 self.args.boundary_cache)
+        logging.debug("crop_indices: %s", self.crop_indices)
+
+        pending_images, self.pending_images = self.pending_images, []
+        for image in pending_images:
+            self.add_crop_image(ip.crop_image_by_indices(image, self.crop_indices))
+
+    def add_crop_image(self, crop_image: np.ndarray):
+        """
+        Add a crop image to the current run of duplicates if it is a duplicate of
+        the first crop image of the run, replacing the one before it. Otherwise,
+        match the last crop image of the run, and start a new run.
+        """
+        row_hashes = ip.compute_row_hashes(crop_image)
+        if self.run_row_hashes is not None and \
+                ip.row_hashes_are_duplicates(self.run_row_hashes, row_hashes,
+                                             self.args.duplicate_threshold):
+            logging.debug("Replacing crop image duplicate of the previous one")
+            self.run_crop_image = crop_image
+            return
+
+        self.finish_run()
+        self.run_crop_image = crop_image
+        self.run_row_hashes = row_hashes
+
+    def finish_run(self):
+        """
+        Match the last crop image of the current run of duplicates, if any.
+        """
+        if self.run_crop_image is not None:
+            self.match_crop_image(self.run_crop_image)
+            self.run_crop_image = None
+
+    def match_crop_image(self, crop_image: np.ndarray):
+        """
+        Match a crop image against the previous crop image and add its rows to
+        the composite.
+        """
+        args = self.args
+        if args.search_mode == "phase":
+            self.add_phase_frame(crop_image)
+            return
+
+        features = ifeat.compute_frame_features([crop_image],
+                                                args.n_cols_in_crop,
+                                                args.left_crop_from,
+                                                args.left_crop_to,
+                                                args.right_crop_from,
+                                                args.right_crop_to,
+                                                args.precision)
+        if self.previous_crop_image is None:
+            self.first_crop_image = crop_image
+            self.previous_crop_image = crop_image
+            self.previous_features = features
+            return
+
+        # Index 0 is the previous crop image, index 1 the new one
+        pair_features = ifeat.concatenate_frame_features([self.previous_features,
+                                                          features])
+        pair_pyramid = im.build_search_pyramid(args, pair_features)
+        if self.crop_direction is None:
+            self.crop_direction = im.get_crop_direction(args, pair_pyramid)
+            logging.debug(f"crop_direction: {self.crop_direction}")
+
+        logging.info(f"computing match scores for crop {len(self.strips)}")
+        begin_wall_time = time.perf_counter()
+        begin_cpu_time = time.process_time()
+        if self.crop_direction == "down":
+            match_score = im.search_match_scores(args, pair_pyramid, 1, 0,
+                                                 self.previous_offset)
+        else:
+            match_score = im.search_match_scores(args, pair_pyramid, 0, 1,
+                                                 self.previous_offset)
+        self.add_strip(crop_image, match_score, 0, begin_wall_time, begin_cpu_time)
+        self.previous_features = features
+
+    def add_phase_frame(self, crop_image: np.ndarray):
+        """
+        Match a crop image against the previous crop image by phase correlation,
+        see image_matching_phase, and add its rows to the composite.
+        """
+        args = self.args
+        phase_frame = imph.compute_phase_frame(args, crop_image)
+        if self.previous_crop_image is None:
+            self.first_crop_image = crop_image
+            self.previous_crop_image = crop_image
+            self.previous_phase_frame = phase_frame
+            return
+
+        if self.crop_direction is None:
+            self.crop_direction = imph.get_crop_direction(args,
+                                                          self.previous_phase_frame,
+                                                          phase_frame)
+            logging.debug(f"crop_direction: {self.crop_direction}")
+
+        logging.info(f"computing phase shift for crop {len(self.strips)}")
+        begin_wall_time = time.perf_counter()
+        begin_cpu_time = time.process_time()
+        # The column shift is that of the new crop image from the previous one
+        if self.crop_direction == "down":
+            match_score, column_shift = imph.search_match_scores(
+                                            args, self.previous_phase_frame,
+                                            phase_frame, self.previous_offset)
+        else:
+            match_score, column_shift = imph.search_match_scores(
+                                            args, phase_frame,
+                                            self.previous_phase_frame,
+                                            self.previous_offset)
+            column_shift = -column_shift
+        self.add_strip(crop_image, match_score, column_shift,
+                       begin_wall_time, begin_cpu_time)
+        self.previous_phase_frame = phase_frame
+
+    def add_strip(self,
+                  crop_image: np.ndarray,
+                  match_score: np.ndarray,
+                  column_shift: int,
+                  begin_wall_time: float,
+                  begin_cpu_time: float):
+        """
+        Add the rows a crop image and the previous crop image contribute to the
+        composite, from the match scores of the pair and the column shift of the
+        crop image from the previous one, and make it the previous crop image.
+        """
+        args = self.args
+        if self.profiler is not None:
+            self.profiler.add_pair(len(self.strips), match_score,
+                                   time.perf_counter() - begin_wall_time,
+                                   time.process_time() - begin_cpu_time)
+
+        min_match_score = np.min(match_score)
+        if min_match_score > args.match_score_threshold:
+            logging.warning(f"match score {min_match_score} is "
+                            + f"above threshold {args.match_score_threshold}")
+            raise im.MatchScoreError("Error when computing best match for image: "
+                                     + "smallest match score above threshold.")
+
+        min_score_index = np.argmin(match_score)
+        self.previous_offset = int(min_score_index)
+        column_shift += self.previous_column_shift
+        # Scrolling down, the previous image contributes the rows above the new
+        # image. Scrolling up, the new image contributes the rows above the
+        # previous image. Copy the rows, so the full images can be freed.
+        if self.crop_direction == "down":
+            self.strips.append(ij.shift_columns(
+                self.previous_crop_image[:min_score_index],
+                self.previous_column_shift).copy())
+        else:
+            self.strips.append(ij.shift_columns(crop_image[:min_score_index],
+                                                column_shift).copy())
+        self.n_strip_rows += int(min_score_index)
+
+        self.previous_crop_image = crop_image
+        self.previous_column_shift = column_shift
+
+    def finish_strips(self) -> Tuple[Iterable[np.ndarray],
+                                     Tuple[np.ndarray, np.ndarray,
+                                           np.ndarray, np.ndarray],
+                                     int]:
+        """
+        Finish adding images. Returns the strips of the composite of all added
+        images from the top, the boundaries of the first image, and the height of
+        the composite, to be joined by ij.join_strips_with_boundaries.
+        """
+        if self.crop_indices is None and len(self.pending_images) >= 2:
+            self.fix_crop_indices(force=True)
+        self.finish_run()
+        if not self.strips:
+            raise ValueError("At least two different images are needed to join.")
+
+        if self.crop_direction == "down":
+            strips = itertools.chain(self.strips,
+                                     [ij.shift_columns(self.previous_crop_image,
+                                                       self.previous_column_shift)])
+        else:
+            strips = itertools.chain(reversed(self.strips), [self.first_crop_image])
+
+        new_image_boundaries = ip.extract_image_boundaries_by_indices(self.first_image,
+                                                                      self.crop_indices)
+        new_image_h_dim = self.n_strip_rows + self.first_crop_image.shape[0]
+        return strips, new_image_boundaries, new_image_h_dim
+
+    def finish(self) -> np.ndarray:
+        """
+        Join the composite of all added images with the boundaries of the first
+        image and return it.
+        """
+        return ij.join_strips_with_boundaries(*self.finish_strips())
+
+
+def watch_images(args: argparse.Namespace) -> Iterator[np.ndarray]:
+    """
+    Yield the images in args.input_folder while they are being written, until the
+    done marker appears in the folder.
+    """
+    logging.info(f"Watching {args.input_folder} for images")
+    for img_path in iio.watch_image_paths(args.input_folder,
+                                          args.done_marker,
+                                          args.watch_timeout):
+        logging.debug(f"Adding image {img_path}")
+        yield iio.image_to_np(iio.load_image(img_path))
+
+
+def join_chats_incremental(args: argparse.Namespace,
+                           profiler: profiling.Profiler,
+                           images: Optional[Iterable[np.ndarray]] = None
+                           ) -> List[str]:
+    """
+    Join images while they are being captured: the given images, such as raw
+    frames read from a pipe, as they arrive, or else the images in
+    args.input_folder while they are being written, until the done marker appears
+    in the folder.
+    """
+    if images is None:
+        images = watch_images(args)
+
+    with iio.create_work_folder(args.work_dir) as work_folder:
+        joiner = IncrementalJoiner(args, profiler, work_folder)
+
+        # Includes the time spent waiting for the images to be captured
+        with profiler.stage("watch"):
+            for image in images:
+                joiner.add_image(image)
+            strips, new_image_boundaries, new_image_h_dim = joiner.finish_strips()
+
+        with profiler.stage("encode"):
+            logging.info("Joining images with boundaries and writing to file")
+            output_filenames = ij.write_strips_with_boundaries(args, strips,
+                                                               new_image_boundaries,
+                                                               new_image_h_dim,
+                                                               work_folder, profiler)
+            logging.debug(f"wrote {output_filenames}")
+    logging.info("Successfully joined images.")
+    return output_filenames
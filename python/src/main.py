@@ -1,14 +1,24 @@
 import argparse
 import logging
+import multiprocessing
 from pprint import pformat
-import numpy as np
 import sys
+from contextlib import closing
+from typing import Iterable, List, Optional, Tuple
 
+import chat_joiner as cj
+import incremental
+import numpy as np
+import profiling
+import server
 import tests
 from image_utils import image_io as iio
-from image_utils import image_processing as ip
 from image_utils import image_matching as im
+from image_utils import image_matching_jit as imjit
+from image_utils import image_matching_parallel as imp
 from image_utils import image_joining as ij
+from image_utils import raw_frames as rf
+from image_utils import video_frames as vf
 
 
 LOGGING_MODES = {
@@ -19,12 +29,32 @@ LOGGING_MODES = {
 }
 
 
-def parse_args() -> argparse.Namespace:
-    parser = argparse.ArgumentParser(
-                prog="Chat-joiner",
-                description="join sequences of chat images into one image")
+class RequestArgumentParser(argparse.ArgumentParser):
+    """
+    Parser of the arguments of a server request. It has no --help, and raises
+    argparse.ArgumentError on invalid arguments instead of printing the usage and
+    exiting, so nothing but the responses is written to stdout.
+    """
+
+    def error(self, message: str):
+        raise argparse.ArgumentError(None, message)
+
 
-    parser.add_argument("input_folder", help="input folder")
+def create_parser(request: bool = False) -> argparse.ArgumentParser:
+    parser_class = RequestArgumentParser if request else argparse.ArgumentParser
+    parser = parser_class(
+                prog="Chat-joiner",
+                description="join sequences of chat images into one image",
+                add_help=not request)
+
+    parser.add_argument("input_folder", nargs="?", help="input folder")
+    parser.add_argument("--raw_frames", action="store", default=None,
+                        help="Read the images as raw RGB or RGBA frames instead of "
+                             + "from the input folder: from stdin if '-', and "
+                             + "otherwise from the block of shared memory of this "
+                             + "name. The format is described in "
+                             + "image_utils/raw_frames.py. With --watch, frames "
+                             + "from stdin are joined as they arrive.")
     parser.add_argument("-o", "--output_filename", action="store",
                         default="out.jpg", help="output filename")
     parser.add_argument("--test", action="store_true", default=False,
@@ -49,14 +79,191 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--right_crop_to", action="store", type=int, default=200,
                         help="When cropping out centers on the right side, where "
                              + "should this crop end?")
+    parser.add_argument("--boundary_scale", action="store", type=int, default=1,
+                        help="Search the crop boundary in every boundary_scale-th "
+                             + "pixel of the first and last image, and refine it at "
+                             + "full resolution near the bounds found. 1 searches "
+                             + "all pixels.")
+    parser.add_argument("--boundary_cache", action="store", default=None,
+                        help="JSON file of the crop boundaries of earlier joins. An "
+                             + "image with the same size and boundaries as an "
+                             + "earlier one reuses its crop boundary.")
+    parser.add_argument("--metric", action="store", default="cosine",
+                        choices=list(im.METRICS),
+                        help="Similarity metric of the match scores: cosine, "
+                             + "zero-mean normalized cross-correlation (ncc), or the "
+                             + "sum of squared (ssd) or absolute (sad) differences. "
+                             + "sad cannot use a matrix product, so it takes 5 to 7 "
+                             + "times as long as cosine, even in integers with "
+                             + "--precision int.")
     parser.add_argument("--match_score_threshold", action="store", type=float, 
-                        default=0.10, help="How high the maximum match score can be "
+                        default=None, help="How high the maximum match score can be "
                                            + " before we determine an error has "
-                                           + "occurred when matching images.")
+                                           + "occurred when matching images. "
+                                           + "Defaults to the threshold of the "
+                                           + "metric, which is 0.10 for cosine.")
+    parser.add_argument("--duplicate_threshold", action="store", type=float,
+                        default=0.90,
+                        help="Crop images are dropped before matching if at least "
+                             + "this fraction of their rows are the same as in the "
+                             + "image before them. 1.0 only drops exact duplicates.")
+    parser.add_argument("--decimate", action="store_true", default=False,
+                        help="Only match and join the fewest images that still "
+                             + "cover all content, by the offsets of images whose "
+                             + "rows are exactly equal. Speeds up slow scrolling, "
+                             + "where each image adds only a few rows. Not used "
+                             + "with --watch.")
+    parser.add_argument("--decimate_overlap", action="store", type=int, default=100,
+                        help="With --decimate, how many rows each kept image must "
+                             + "overlap the image before it by at least. At least "
+                             + "--n_rows_in_crop rows are kept.")
+    parser.add_argument("--exact_match", action=argparse.BooleanOptionalAction,
+                        default=True,
+                        help="Use the offset where the rows of two images are "
+                             + "exactly equal, when there is a single one, before "
+                             + "searching the match scores of all offsets.")
+    parser.add_argument("--precision", action="store", default="float64",
+                        choices=["float64", "float32", "int"],
+                        help="Precision of the grayscale images that are matched. "
+                             + "float32 halves the memory of the matcher. int uses "
+                             + "8-bit fixed-point grayscale, which is an eighth of "
+                             + "the memory, and exact dot products.")
+    parser.add_argument("--kernel", action="store", default="auto",
+                        choices=im.KERNELS,
+                        help="How to compute match scores. numba uses compiled "
+                             + "kernels, which needs numba to be installed, and "
+                             + "numpy the batched numpy functions. auto uses the "
+                             + "compiled kernels if numba is installed, where they "
+                             + "are faster: for the scattered offsets of a "
+                             + "pyramid search.")
+    parser.add_argument("--search_mode", action="store", default="exhaustive",
+                        choices=["exhaustive", "pyramid", "phase"],
+                        help="How to search for the best match. exhaustive scores "
+                             + "every row offset at full resolution. pyramid scores "
+                             + "every offset at a lower resolution first, and only "
+                             + "refines the best candidates at full resolution. "
+                             + "phase finds the shift of each pair in rows and "
+                             + "columns by phase correlation, and places the images "
+                             + "by both, so images that also moved sideways are "
+                             + "joined. --workers is not used with phase.")
+    parser.add_argument("--pyramid_levels", action="store", type=int, default=1,
+                        help="In pyramid search mode, how many times to halve the "
+                             + "resolution for the first search.")
+    parser.add_argument("--pyramid_candidates", action="store", type=int, default=16,
+                        help="In pyramid search mode, how many of the best offsets "
+                             + "to refine at each higher resolution.")
+    parser.add_argument("--search_window", action="store", type=int, default=0,
+                        help="Search this many row offsets to either side of the "
+                             + "offset of the previous image pair first, and only "
+                             + "search all offsets if the best match there is not "
+                             + "well below the threshold or is on its edge. 0 "
+                             + "searches all offsets of every pair. Not used with "
+                             + "--workers, as each pair needs the pair before it.")
+    parser.add_argument("--max_scroll_per_frame", action="store", type=int, default=0,
+                        help="How many rows the content can scroll between two "
+                             + "images at most. Larger offsets are only searched if "
+                             + "no clear match is found below it, as with "
+                             + "--search_window. 0 means no limit.")
+    parser.add_argument("--memory_budget", action="store", type=int, default=1024,
+                        help="How many megabytes of decoded images to keep in memory. "
+                             + "Images are decoded when needed, and decoded again "
+                             + "if they were dropped to stay within the budget.")
+    parser.add_argument("--work_dir", action="store", default=None,
+                        help="Out-of-core mode. Keep the crop images, their "
+                             + "features and the composite in memmap files in a "
+                             + "temporary folder in this directory, and match the "
+                             + "image pairs in chunks of --memory_budget megabytes, "
+                             + "so memory does not grow with the number of images. "
+                             + "--workers is not used.")
+    parser.add_argument("--workers", action="store", type=int, default=1,
+                        help="How many processes to spread the matching of image "
+                             + "pairs across. 1 matches all pairs in this process.")
+    parser.add_argument("--output_format", action="store", default=None,
+                        choices=["png", "webp", "jpeg"],
+                        help="Format of the output image. By default the format is "
+                             + "found from the extension of the output filename. "
+                             + "jpeg drops the alpha channel of RGBA images.")
+    parser.add_argument("--compress_level", action="store", type=int, default=6,
+                        help="zlib compression level of PNG output, from 0 (fastest, "
+                             + "largest) to 9 (slowest, smallest).")
+    parser.add_argument("--quality", action="store", type=int, default=None,
+                        help="Quality of JPEG and WebP output, from 0 to 100. By "
+                             + "default the quality of Pillow is used.")
+    parser.add_argument("--effort", action="store", type=int, default=4,
+                        help="Compression effort of WebP output, from 0 (fastest, "
+                             + "largest) to 6 (slowest, smallest).")
+    parser.add_argument("--output_strip_height", action="store", type=int, default=0,
+                        help="Write a PNG output image in strips of this many rows, "
+                             + "without building the whole image in memory. 0 "
+                             + "builds the whole image before writing it.")
+    parser.add_argument("--encode_workers", action="store", type=int, default=1,
+                        help="How many threads to compress the strips of a PNG "
+                             + "output image with. More than 1 writes the image in "
+                             + "strips, as --output_strip_height.")
+    parser.add_argument("--page_height", action="store", type=int, default=0,
+                        help="Split output images taller than this many rows into "
+                             + "pages, written to files numbered from 1 after the "
+                             + "output filename. 0 never splits the output image.")
     parser.add_argument("--logging_mode", action="store", default="warning",
                         choices=LOGGING_MODES.keys(), help="logging mode")
-
-    args = parser.parse_args()
+    parser.add_argument("--watch", action="store_true", default=False,
+                        help="incremental mode. Join the images in the input folder "
+                             + "while they are being written, until the done marker "
+                             + "is written to the folder.")
+    parser.add_argument("--done_marker", action="store", default="done",
+                        help="In incremental mode, the name of the file that marks "
+                             + "that all images have been written.")
+    parser.add_argument("--watch_timeout", action="store", type=float, default=60.0,
+                        help="In incremental mode, how many seconds to wait for a new "
+                             + "image before giving up on the done marker.")
+    parser.add_argument("--video", action="store", default=None,
+                        help="Join the frames of a screen recording instead of the "
+                             + "images in the input folder. The video is decoded "
+                             + "by ffmpeg while its frames are matched, as in "
+                             + "incremental mode.")
+    parser.add_argument("--ffmpeg", action="store", default="ffmpeg",
+                        help="Path of the ffmpeg executable that decodes --video.")
+    parser.add_argument("--video_fps", action="store", type=float, default=0,
+                        help="Resample --video to this many frames per second "
+                             + "before matching. 0 keeps all frames.")
+    parser.add_argument("--video_change_threshold", action="store", type=float,
+                        default=1.0,
+                        help="Frames of --video are only matched if their mean "
+                             + "absolute difference to the last matched frame, from "
+                             + "0 to 255, is above this, so frames in which the "
+                             + "content did not move are skipped.")
+    parser.add_argument("--boundary_frames", action="store", type=int, default=3,
+                        help="In incremental mode, how many images to use when "
+                             + "finding the crop boundary.")
+    parser.add_argument("--profile", action="store", nargs="?", const="-",
+                        default=None,
+                        help="Write a JSON report of the wall time, CPU time and "
+                             + "peak memory of each stage and image pair to this "
+                             + "file, or to stdout if no file is given. In server "
+                             + "mode, the report is added to the response instead "
+                             + "of stdout. See profiling.py for the format.")
+    parser.add_argument("--serve", action="store_true", default=False,
+                        help="server mode. Read one JSON request per line from stdin "
+                             + "and write one JSON response per line to stdout, until "
+                             + "stdin is closed. See server.py for the protocol.")
+
+    return parser
+
+
+def parse_args(argv: Optional[List[str]] = None,
+               request: bool = False) -> argparse.Namespace:
+    parser = create_parser(request)
+    args = parser.parse_args(argv)
+
+    if args.input_folder is None and args.raw_frames is None and args.video is None \
+            and not args.serve:
+        parser.error("the following arguments are required: input_folder")
+    if args.kernel == "numba" and not imjit.AVAILABLE:
+        parser.error("--kernel numba needs numba to be installed")
+    if args.kernel == "numba" and args.metric != "cosine":
+        parser.error("--kernel numba only computes the cosine metric")
+    if args.match_score_threshold is None:
+        args.match_score_threshold = im.METRICS[args.metric].match_score_threshold
 
     return args
 
@@ -66,108 +273,112 @@ def test(args):
     return
 
 
-def join_chats(args):
-    logging.info("Reading images")
-    images = iio.load_images(args.input_folder)
-    logging.info("Converting images to numpy arrays")
-    np_images = iio.images_to_np(images)
-
-    logging.debug("original image shape: %s", np_images[0].shape)
-
-    logging.info("Creating filter frame")
-    filter_frame = ip.create_npimage_filter(np_images[-1],
-                                            np_images[0],
-                                            args.denoising_factor)
-    logging.info("Finding crop coordinates")
-    crop_indices = ip.find_frame_boundary_of_npimage_filter(filter_frame)
-    # iio.write_npimage_to_file(filter_frame, "test/test_full/ex_image_filter.png")
-    logging.debug("crop_indices: %s", crop_indices)
-
-    logging.info("Cropping images by indices")
-    crop_images = ip.crop_images_by_indices(np_images, crop_indices)
-    logging.debug(f"Shape of cropped images: {crop_images[0].shape}")
-    n_crops_before = len(crop_images)
-    logging.debug(f"Number of crop images before removing duplicates: {n_crops_before}")
-
-    logging.info("Removing initial identical crop images")
-    crop_images = ip.remove_identical_crop_images(crop_images)
-    n_crops_removed = n_crops_before - len(crop_images)
-    logging.debug(f"removed initial {n_crops_removed} identical crop images")
-
-    logging.info("Computing crop direction")
-    crop_direction = im.get_crop_direction(args, crop_images)
-    crop_images = crop_images[::-1] if crop_direction == "up" else crop_images
-    logging.debug(f"crop_direction: {crop_direction}")
-    logging.debug("Computing slice crops")
-    image_slice_crops = [ip.crop_image_slice(crop_image,
-                                             args.n_rows_in_crop,
-                                             args.n_cols_in_crop,
-                                             args.left_crop_from,
-                                             args.left_crop_to,
-                                             args.right_crop_from,
-                                             args.right_crop_to)
-                         for crop_image in crop_images[1:]]
-    logging.info("Computing reference crops")
-    image_reference_crops = [ip.crop_image_reference(crop_image,
-                                                     args.n_cols_in_crop,
-                                                     args.left_crop_from,
-                                                     args.left_crop_to,
-                                                     args.right_crop_from,
-                                                     args.right_crop_to)
-                             for crop_image in crop_images[:-1]]
-    logging.debug(f"Number of comparisons: {len(image_slice_crops)}")
-
-    logging.info("Computing match scores for all crops")
-    min_score_indices = []
-    # min_scores = []
-    for i, (crop, crop_image) in enumerate(zip(image_slice_crops,
-                                               image_reference_crops)):
-        logging.info(f"computing match scores for crop {i}")
-        match_score = im.compute_match_scores(crop, crop_image)
-        min_match_score = np.min(match_score)
-        if min_match_score > args.match_score_threshold:
-            logging.warning(f"match score {min_match_score} is \
-                            above threshold {args.match_score_threshold}")
-            # Print error message to stderr
-            sys.stderr.write("Error when computing best match for image: \
-                smallest match score above threshold.\n")
-            sys.exit(1)
-
-        min_score_indices.append(np.argmin(match_score))
-
-    min_score_indices = np.array(min_score_indices)
+def join_chats(args,
+               profiler: profiling.Profiler,
+               frames: Optional[Iterable[np.ndarray]] = None) -> List[str]:
+    return join_chats_series(args, profiler, frames)[1]
 
-    logging.info("finished computing match scores for all crops")
 
-    logging.info("Joining images")
-    new_image = ij.join_series_vertically_top_wise(crop_images, min_score_indices)
-    logging.info("new image shape: %s", new_image.shape)
-
-    logging.info("Extracting image boundaries from first the first image")
-    new_image_boundaries = ip.extract_image_boundaries_by_indices(np_images[0],
-                                                                  crop_indices)
-
-    logging.info("fitting boundaries to new image")
-    new_image_boundaries = ip.extend_boundaries_to_new_image_shape(new_image_boundaries,
-                                                                   new_image.shape)
-
-    new_image_with_boundaries = ij.join_image_with_boundaries(new_image,
-                                                              new_image_boundaries)
-
-    logging.debug(f"new image with boundaries shape: {new_image_with_boundaries.shape}")
-
-    logging.debug("writing new image to file")
-    iio.write_npimage_to_file(new_image_with_boundaries,
-                              args.output_filename)
+def join_chats_series(args,
+                      profiler: profiling.Profiler,
+                      frames: Optional[Iterable[np.ndarray]] = None
+                      ) -> Tuple[cj.MatchedSeries, List[str]]:
+    """
+    Join the images in args.input_folder, or the given frames, and write the
+    result, as join_chats. Returns the matched series as well as the paths of the
+    written files, so the offsets of the join can be checked.
+    """
+    with profiler.stage("load"):
+        logging.info("Reading images")
+        if frames is None:
+            np_images = iio.load_images_lazily(args.input_folder,
+                                               args.memory_budget * 1024 * 1024)
+        else:
+            np_images = rf.RawFrames(list(frames))
+
+        logging.debug("original image shape: %s", np_images[0].shape)
+
+    with iio.create_work_folder(args.work_dir) as work_folder:
+        series = cj.match_series(args, np_images, profiler, work_folder)
+
+        with profiler.stage("encode"):
+            logging.info("Joining images with boundaries and writing to file")
+            strips = cj.split_series_into_strips(series)
+            output_filenames = ij.write_strips_with_boundaries(args, strips,
+                                                               series.boundaries,
+                                                               series.height,
+                                                               work_folder, profiler)
+            logging.debug(f"wrote {output_filenames}")
     logging.info("Successfully joined images.")
     logging.debug("Finished full test")
-    return 0
+    return series, output_filenames
+
+
+def join(args, profiler: profiling.Profiler) -> List[str]:
+    if args.video is not None:
+        logging.debug("Running join_chats_incremental on video frames")
+        # Stops ffmpeg if the join fails before all frames are decoded
+        with closing(vf.decode_video_frames(args.ffmpeg, args.video,
+                                            args.video_fps)) as frames:
+            return incremental.join_chats_incremental(
+                        args, profiler,
+                        vf.skip_unchanged_frames(frames, args.video_change_threshold))
+    if args.raw_frames is not None:
+        with rf.open_raw_frames(args.raw_frames) as frames:
+            if args.watch:
+                logging.debug("Running join_chats_incremental on raw frames")
+                return incremental.join_chats_incremental(args, profiler, frames)
+            logging.debug("Running join_chats on raw frames")
+            return join_chats(args, profiler, frames)
+    if args.watch:
+        logging.debug("Running join_chats_incremental")
+        return incremental.join_chats_incremental(args, profiler)
+    logging.debug("Running join_chats")
+    return join_chats(args, profiler)
+
+
+def run_job(argv: List[str]) -> dict:
+    """
+    Run a join for a single server request, given the same arguments as the
+    command line. Returns the fields to add to the response: the output filename,
+    the filenames of all pages, and the profile if it was requested for stdout,
+    which carries the responses. Invalid arguments raise argparse.ArgumentError.
+    """
+    args = parse_args(argv, request=True)
+    if args.raw_frames == rf.STDIN_SOURCE:
+        # stdin of a server carries its requests
+        raise ValueError("raw frames can only be read from stdin on the command "
+                         + "line, use shared memory instead")
+    logging.getLogger().setLevel(LOGGING_MODES[args.logging_mode])
+    logging.debug(pformat(args.__dict__))
+    profiler = profiling.Profiler(args.profile is not None)
+    try:
+        output_filenames = join(args, profiler)
+    finally:
+        report = profiler.report()
+        if args.profile is not None and args.profile != "-":
+            profiling.write_report(report, args.profile)
+
+    result = {"output_filename": args.output_filename,
+              "output_filenames": output_filenames}
+    if args.profile == "-":
+        result["profile"] = report
+    return result
+
+
+def serve(args):
+    logging.debug("Serving requests from stdin")
+    try:
+        return server.serve(run_job, sys.stdin, sys.stdout)
+    finally:
+        imp.shutdown_executor()
 
 
 def main():
     """
     Load all images from a folder and print their shape.
     """
+    multiprocessing.freeze_support()
     args = parse_args()
 
     logging_mode = LOGGING_MODES[args.logging_mode]
@@ -178,15 +389,28 @@ def main():
 
     logging.debug("Starting program")
 
-    if args.test:
+    if args.serve:
+        return serve(args)
+
+    elif args.test:
         logging.debug("Running tests")
         logging.debug(pformat(args.__dict__))
         return test(args)
 
     else:
-        logging.debug("Running join_chats")
         logging.debug(pformat(args.__dict__))
-        return join_chats(args)
+        profiler = profiling.Profiler(args.profile is not None)
+        try:
+            join(args, profiler)
+            return 0
+        except im.MatchScoreError as error:
+            # Print error message to stderr
+            sys.stderr.write(f"{error}\n")
+            sys.exit(1)
+        finally:
+            imp.shutdown_executor()
+            if args.profile is not None:
+                profiling.write_report(profiler.report(), args.profile)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,208 @@
+"""
+Profiling of the chat joiner. With the --profile flag, the wall time, CPU time and
+peak memory of each stage, and the search of each image pair, are collected into
+a JSON report:
+
+    {
+        "total": {"wall_time": 1.23, "cpu_time": 1.1, "peak_memory": 123456},
+        "stages": [{"stage": "load", "wall_time": ..., "cpu_time": ...,
+                    "peak_memory": ...}, ...],
+        "pairs": [{"pair": 0, "offsets_searched": 676, "best_offset": 120,
+                   "best_score": 0.0, "wall_time": ..., "cpu_time": ...}, ...]
+    }
+
+Times are in seconds and memory in bytes. Peak memory is the largest amount of
+memory traced by tracemalloc during the stage, which includes numpy arrays but not
+memory held inside Pillow. The CPU time of a stage only counts this process, so
+with --workers the matching stage leaves out the CPU time of the workers, which is
+in the pairs instead.
+
+A stage run inside another stage, such as the joining of the bands of an image
+that are encoded as they are joined, is left out of the times of the stage
+around it, so the stages add up to the total. The peak memory of the stage
+around it still includes it.
+"""
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List, Tuple, TypeVar
+
+import numpy as np
+
+T = TypeVar("T")
+
+
+class Profiler:
+    """
+    Collects the profile of a single join. A disabled profiler records nothing,
+    so the stages can be wrapped whether profiling is enabled or not. Without
+    trace_memory, only times are recorded, and the peak memory is 0, so the
+    tracing of memory does not slow down the stages.
+    """
+
+    def __init__(self, enabled: bool, trace_memory: bool = True):
+        self.enabled = enabled
+        self.trace_memory = enabled and trace_memory
+        self.stages: List[dict] = []
+        self.pairs: List[dict] = []
+        self.begin_wall_time = time.perf_counter()
+        self.begin_cpu_time = time.process_time()
+        self.peak_memory = 0
+        # Timings of the stages that are running, from the outermost
+        self.open_timings: List[dict] = []
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def get_peak_memory(self) -> int:
+        """
+        Get the peak memory traced since it was last reset, or 0 if memory is
+        not traced.
+        """
+        if not self.trace_memory:
+            return 0
+        return tracemalloc.get_traced_memory()[1]
+
+    def begin_timing(self):
+        """
+        Begin timing a stage, inside the stages that are running.
+        """
+        if self.open_timings:
+            outer_timing = self.open_timings[-1]
+            outer_timing["peak_memory"] = max(outer_timing["peak_memory"],
+                                              self.get_peak_memory())
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        self.open_timings.append({
+            "wall_time": time.perf_counter(),
+            "cpu_time": time.process_time(),
+            "nested_wall_time": 0.0,
+            "nested_cpu_time": 0.0,
+            "peak_memory": 0,
+        })
+
+    def end_timing(self) -> Tuple[float, float, int]:
+        """
+        End timing the innermost running stage. Returns its wall time and CPU
+        time, without those of the stages run inside it, and its peak memory.
+        """
+        timing = self.open_timings.pop()
+        wall_time = time.perf_counter() - timing["wall_time"]
+        cpu_time = time.process_time() - timing["cpu_time"]
+        peak_memory = max(timing["peak_memory"], self.get_peak_memory())
+        if self.open_timings:
+            outer_timing = self.open_timings[-1]
+            outer_timing["nested_wall_time"] += wall_time
+            outer_timing["nested_cpu_time"] += cpu_time
+            outer_timing["peak_memory"] = max(outer_timing["peak_memory"], peak_memory)
+        self.peak_memory = max(self.peak_memory, peak_memory)
+        return (wall_time - timing["nested_wall_time"],
+                cpu_time - timing["nested_cpu_time"],
+                peak_memory)
+
+    def add_stage(self, name: str, wall_time: float, cpu_time: float,
+                  peak_memory: int):
+        """
+        Record a stage.
+        """
+        self.stages.append({
+            "stage": name,
+            "wall_time": round(wall_time, 6),
+            "cpu_time": round(cpu_time, 6),
+            "peak_memory": peak_memory,
+        })
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Profile the stage run inside the with block.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        self.begin_timing()
+        try:
+            yield
+        finally:
+            self.add_stage(name, *self.end_timing())
+
+    def stage_items(self, name: str, items: Iterable[T]) -> Iterator[T]:
+        """
+        Profile a stage that produces items for the stage that consumes them, such
+        as the bands of an image that are encoded as they are joined. The times of
+        producing each item are added up into one stage, which is recorded once
+        the items are consumed.
+        """
+        if not self.enabled:
+            yield from items
+            return
+
+        wall_time = cpu_time = 0.0
+        peak_memory = 0
+        iterator = iter(items)
+        try:
+            while True:
+                self.begin_timing()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    item_wall_time, item_cpu_time, item_peak_memory = self.end_timing()
+                    wall_time += item_wall_time
+                    cpu_time += item_cpu_time
+                    peak_memory = max(peak_memory, item_peak_memory)
+                yield item
+        finally:
+            self.add_stage(name, wall_time, cpu_time, peak_memory)
+
+    def add_pair(self,
+                 pair_index: int,
+                 match_scores: np.ndarray,
+                 wall_time: float,
+                 cpu_time: float):
+        """
+        Record the search of an image pair, from its match scores. Offsets that
+        were not searched hold np.inf.
+        """
+        if not self.enabled:
+            return
+
+        self.pairs.append({
+            "pair": pair_index,
+            "offsets_searched": int(np.count_nonzero(np.isfinite(match_scores))),
+            "best_offset": int(np.argmin(match_scores)),
+            "best_score": float(np.min(match_scores)),
+            "wall_time": round(wall_time, 6),
+            "cpu_time": round(cpu_time, 6),
+        })
+
+    def report(self) -> dict:
+        """
+        Stop profiling and return the report.
+        """
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        return {
+            "total": {
+                "wall_time": round(time.perf_counter() - self.begin_wall_time, 6),
+                "cpu_time": round(time.process_time() - self.begin_cpu_time, 6),
+                "peak_memory": self.peak_memory,
+            },
+            "stages": self.stages,
+            "pairs": self.pairs,
+        }
+
+
+def write_report(report: dict, filename: str):
+    """
+    Write a report as JSON to a file, or to stdout if filename is "-".
+    """
+    if filename == "-":
+        sys.stdout.write(json.dumps(report) + "\n")
+        sys.stdout.flush()
+        return
+    with open(filename, "w") as report_file:
+        json.dump(report, report_file, indent=2)
@@ -0,0 +1,92 @@
+"""
+Server mode of the chat joiner. Keeps a single process, with its imports and
+worker pool, alive between scrollshots.
+
+Protocol: JSON lines over stdin/stdout. Each request is one line holding a JSON
+object with the arguments of a command line run:
+
+    {"id": 1, "args": ["<input_folder>", "-o", "<output_filename>", ...]}
+
+Each request is answered by exactly one line on stdout, in request order:
+
+    {"id": 1, "status": "ok", "output_filename": "...", "output_filenames": ["..."],
+     "elapsed": 1.23}
+    {"id": 1, "status": "error", "error": "...", "elapsed": 0.12}
+
+output_filenames lists every written file, which is more than one when the
+output is split into pages with --page_height.
+
+A request with a bare --profile argument gets the profile report (see
+profiling.py) in the "profile" field of its ok response.
+
+Logging is written to stderr, so stdout only carries responses. The arguments of
+a request have no --help, and invalid arguments get an error response. The server stops
+when stdin is closed.
+"""
+import argparse
+import json
+import logging
+import time
+from typing import Callable, List, TextIO
+
+from image_utils import image_matching as im
+
+
+def run_request(request_id,
+                argv: List[str],
+                run_job: Callable[[List[str]], dict]) -> dict:
+    """
+    Run a job with the given arguments and return its response, which reports
+    the error instead of raising it if the job fails.
+    """
+    begin_time = time.perf_counter()
+    try:
+        result = run_job(argv)
+        response = {"id": request_id, "status": "ok", **result}
+    except im.MatchScoreError as error:
+        response = {"id": request_id, "status": "error", "error": str(error)}
+    except argparse.ArgumentError as error:
+        response = {"id": request_id, "status": "error",
+                    "error": f"invalid arguments: {error}"}
+    except Exception as error:
+        logging.exception("Request failed")
+        response = {"id": request_id, "status": "error",
+                    "error": f"{type(error).__name__}: {error}"}
+
+    response["elapsed"] = round(time.perf_counter() - begin_time, 3)
+    return response
+
+
+def handle_request(line: str, run_job: Callable[[List[str]], dict]) -> dict:
+    """
+    Handle a single request line and return its response.
+    """
+    request_id = None
+    try:
+        request = json.loads(line)
+        request_id = request.get("id")
+        argv = [str(arg) for arg in request["args"]]
+    except Exception as error:
+        logging.exception("Invalid request")
+        return {"id": request_id, "status": "error",
+                "error": f"{type(error).__name__}: {error}", "elapsed": 0.0}
+    return run_request(request_id, argv, run_job)
+
+
+def serve(run_job: Callable[[List[str]], dict],
+          input_stream: TextIO,
+          output_stream: TextIO) -> int:
+    """
+    Read requests from input_stream and write responses to output_stream until
+    input_stream is closed. run_job is called with the arguments of each request
+    and returns the fields to add to its response, such as the output filename.
+    """
+    for line in input_stream:
+        if not line.strip():
+            continue
+        response = handle_request(line, run_job)
+        output_stream.write(json.dumps(response) + "\n")
+        output_stream.flush()
+
+    logging.debug("Input closed, stopping server")
+    return 0
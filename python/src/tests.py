@@ -1,13 +1,26 @@
 import logging
 import sys
 import argparse
+import itertools
 import os
+import io
+import json
+import contextlib
+import tempfile
+import subprocess
+import shutil
+from multiprocessing import shared_memory
+from typing import List, Sequence
 
 import numpy as np
+import chat_joiner as cj
+import image_utils.image_features as ifeat
 import image_utils.image_io as iio
 import image_utils.image_joining as ij
 import image_utils.image_matching as im
 import image_utils.image_processing as ip
+import image_utils.raw_frames as rf
+import image_utils.video_frames as vf
 
 
 def test_full_join(args: argparse.Namespace) -> int:
@@ -39,14 +52,28 @@ def test_full_join(args: argparse.Namespace) -> int:
     n_crops_before = len(crop_images)
     logging.debug(f"Number of crop images before removing duplicates: {n_crops_before}")
 
-    logging.debug("Removing initial identical crop images")
-    crop_images = ip.remove_identical_crop_images(crop_images)
+    logging.debug("Removing duplicate crop images")
+    crop_images = [crop_images[i]
+                   for i in ip.find_distinct_crop_images(crop_images,
+                                                         args.duplicate_threshold)]
     n_crops_removed = n_crops_before - len(crop_images)
-    logging.debug(f"removed initial {n_crops_removed} identical crop images")
+    logging.debug(f"removed {n_crops_removed} duplicate crop images")
+
+    logging.debug("Computing frame features")
+    features = ifeat.compute_frame_features(crop_images,
+                                            args.n_cols_in_crop,
+                                            args.left_crop_from,
+                                            args.left_crop_to,
+                                            args.right_crop_from,
+                                            args.right_crop_to,
+                                            args.precision)
 
     logging.debug("Computing crop direction")
-    crop_direction = im.get_crop_direction(args, crop_images)
-    crop_images = crop_images[::-1] if crop_direction == "up" else crop_images
+    pyramid = im.build_search_pyramid(args, features)
+    crop_direction = im.get_crop_direction(args, pyramid)
+    if crop_direction == "up":
+        crop_images = crop_images[::-1]
+        pyramid = ifeat.reverse_feature_pyramid(pyramid)
     logging.debug(f"crop_direction: {crop_direction}")
     logging.debug("Computing slice crops")
     image_slice_crops = [ip.crop_image_slice(crop_image,
@@ -65,7 +92,7 @@ def test_full_join(args: argparse.Namespace) -> int:
                                                      args.right_crop_from,
                                                      args.right_crop_to)
                              for crop_image in crop_images[:-1]]
-    logging.debug(f"Number of comparisons: {len(image_slice_crops)}")
+    logging.debug(f"Number of comparisons: {len(crop_images) - 1}")
 
     for i, (slice_crop, reference_crop) in enumerate(zip(image_slice_crops,
                                                          image_reference_crops)):
@@ -78,10 +105,9 @@ def test_full_join(args: argparse.Namespace) -> int:
     logging.debug("Computing match scores for all crops")
     min_score_indices = []
     # min_scores = []
-    for i, (crop, crop_image) in enumerate(zip(image_slice_crops,
-                                               image_reference_crops)):
+    for i in range(len(crop_images) - 1):
         logging.debug(f"computing match scores for crop {i}")
-        match_score = im.compute_match_scores(crop, crop_image)
+        match_score = im.search_match_scores(args, pyramid, i + 1, i)
         min_match_score = np.min(match_score)
         if min_match_score > args.match_score_threshold:
             logging.warning(f"match score {min_match_score} is \
@@ -125,3 +151,627 @@ def test_full_join(args: argparse.Namespace) -> int:
     logging.info("Successfully joined images.")
     logging.debug("Finished full test")
     return 0
+
+
+def test_search_window(n_seeds: int = 3) -> int:
+    """
+    Check that --search_window and --max_scroll_per_frame do not change the best
+    offsets of any pair of a corpus of synthetic scrollshots with a large scroll
+    jitter, scrolled down and up, with and without noise, with every metric.
+    The offsets are compared to those of a search of all offsets, and to the
+    offsets the scrollshots were generated with.
+    """
+    # benchmarks and main import this module
+    import benchmarks
+    import main
+
+    corpus = [benchmarks.generate_scrollshot(12, 900, 800, 120, 60, 40,
+                                             direction, seed, noise)
+              for seed in range(n_seeds)
+              for direction in ["down", "up"]
+              for noise in [0.0, 3.0]]
+    window_options = [["--search_window", "8"],
+                      ["--max_scroll_per_frame", "100"],
+                      ["--search_window", "8", "--max_scroll_per_frame", "100"]]
+
+    n_failures = 0
+    for metric in im.METRICS:
+        for exact_match in ["--exact_match", "--no-exact_match"]:
+            base_argv = ["synthetic", "--metric", metric, exact_match]
+            args = main.parse_args(base_argv)
+            full_offsets = [np.argmin(benchmarks.compute_scrollshot_match_scores(
+                                args, scrollshot), axis=1)
+                            for scrollshot in corpus]
+            for options in window_options:
+                args = main.parse_args(base_argv + options)
+                for scrollshot, expected_offsets in zip(corpus, full_offsets):
+                    offsets = np.argmin(benchmarks.compute_scrollshot_match_scores(
+                        args, scrollshot), axis=1)
+                    if not np.array_equal(offsets, expected_offsets) \
+                            or not np.array_equal(offsets, scrollshot.offsets):
+                        logging.warning(f"{metric} {exact_match} {options}: offsets "
+                                        + f"{offsets.tolist()}, expected "
+                                        + f"{scrollshot.offsets.tolist()}")
+                        n_failures += 1
+    print(f"search window test: {n_failures} scrollshots with wrong offsets")
+    return 0 if n_failures == 0 else 1
+
+
+def test_boundary_scale(scales: Sequence[int] = (2, 3, 4, 8, 16)) -> int:
+    """
+    Check that the frame boundary found at reduced resolution is the one found
+    at full resolution, on synthetic scrollshots with and without a border
+    around the content, scrolled down and up. Without a border, the bounds found
+    at reduced resolution are on the edge of the image.
+    """
+    # benchmarks imports this module
+    import benchmarks
+
+    n_failures = 0
+    for border, direction, seed in itertools.product([0, 40], ["down", "up"], [0, 1]):
+        frames = benchmarks.generate_scrollshot(30, 900, 800, 120, 20, border,
+                                                direction, seed).frames
+        filter_frame = ip.create_npimage_filter(frames[-1], frames[0], 0.1)
+        expected = tuple(int(bound) for bound in
+                         ip.find_frame_boundary_of_npimage_filter(filter_frame))
+        for scale in scales:
+            boundary = ip.find_frame_boundary_at_reduced_resolution(
+                frames[-1], frames[0], 0.1, scale)
+            if boundary != expected:
+                logging.warning(f"border {border} {direction} seed {seed} "
+                                + f"scale {scale}: "
+                                + f"boundary {boundary}, expected {expected}")
+                n_failures += 1
+    print(f"boundary scale test: {n_failures} boundaries differ")
+    return 0 if n_failures == 0 else 1
+
+
+def test_kernel_parity() -> int:
+    """
+    Check that the kernels of image_matching_jit give the match scores of
+    im.batched_score_function, on float64 and uint8 grayscale planes of a
+    synthetic scrollshot. The kernels are run as plain Python, without numba,
+    so the check does not depend on it being installed.
+    """
+    # benchmarks imports this module
+    import benchmarks
+    from image_utils import image_matching_jit as imjit
+
+    frame = benchmarks.generate_scrollshot(2, 900, 800, 120, 20, 40, "down",
+                                           seed=0).frames[0]
+    n_failures = 0
+    for precision, kernel in [("float64", imjit.float_scores_at_offsets),
+                              ("int", imjit.integer_scores_at_offsets)]:
+        # numba keeps the undecorated function of a compiled kernel
+        kernel = getattr(kernel, "py_func", kernel)
+        grayscale_reference = ifeat.convert_to_grayscale(frame[200:280, 60:92],
+                                                         precision)
+        grayscale_slice = grayscale_reference[37:53]
+        slice_row_squared_norms = ifeat.compute_row_squared_norms(grayscale_slice)
+        reference_row_squared_norms = \
+            ifeat.compute_row_squared_norms(grayscale_reference)
+
+        expected = im.batched_score_function(grayscale_slice, grayscale_reference,
+                                             slice_row_squared_norms,
+                                             reference_row_squared_norms)
+        offsets = np.arange(len(expected))
+        match_scores = kernel(grayscale_slice, grayscale_reference,
+                              slice_row_squared_norms, reference_row_squared_norms,
+                              offsets)
+        max_difference = np.max(np.abs(match_scores - expected))
+        if max_difference > 1e-12 or np.argmin(match_scores) != 37:
+            logging.warning(f"{precision} kernel: max score difference "
+                            + f"{max_difference}, best offset "
+                            + f"{np.argmin(match_scores)}")
+            n_failures += 1
+    print(f"kernel parity test: {n_failures} kernels differ")
+    return 0 if n_failures == 0 else 1
+
+
+def count_different_joins(name: str, frame_series: List[Sequence[np.ndarray]],
+                          **options) -> int:
+    """
+    Join each series of frames with the given options of the command line, and
+    with the default exhaustive search, and count the series whose composite,
+    scroll direction or offsets differ between the two joins.
+    """
+    n_different = 0
+    for i, frames in enumerate(frame_series):
+        expected = cj.join_frames(frames)
+        result = cj.join_frames(frames, **options)
+        if result.crop_direction != expected.crop_direction \
+                or not np.array_equal(result.offsets, expected.offsets) \
+                or not np.array_equal(result.image, expected.image):
+            logging.warning(f"{name} join {i}: direction {result.crop_direction}, "
+                            + f"offsets {result.offsets.tolist()}, expected "
+                            + f"{expected.crop_direction}, "
+                            + f"{expected.offsets.tolist()}")
+            n_different += 1
+    return n_different
+
+
+def test_phase_low_overlap(n_seeds: int = 3) -> int:
+    """
+    Check that --search_mode phase joins synthetic scrollshots whose frames
+    overlap by less than half their height, scrolled down and up, as the default
+    exhaustive search does. Many wrong shifts of such frames match their top rows
+    below the match score threshold.
+    """
+    # benchmarks imports this module
+    import benchmarks
+
+    scrollshots = [benchmarks.generate_scrollshot(10, 900, 800, 500, 20, 40,
+                                                  direction, seed)
+                   for seed in range(n_seeds) for direction in ["down", "up"]]
+    n_failures = count_different_joins("phase",
+                                       [scrollshot.frames for scrollshot in scrollshots],
+                                       search_mode="phase")
+    for scrollshot in scrollshots:
+        if not np.array_equal(cj.join_frames(scrollshot.frames).offsets,
+                              scrollshot.offsets):
+            logging.warning(f"exhaustive offsets differ from {scrollshot.offsets}")
+            n_failures += 1
+    print(f"phase low overlap test: {n_failures} joins differ")
+    return 0 if n_failures == 0 else 1
+
+
+def test_server() -> int:
+    """
+    Check that the server answers --help and invalid arguments with an error
+    response without writing to stdout, and that a valid request joins a
+    synthetic scrollshot as chat_joiner does.
+    """
+    # benchmarks and main import this module
+    import benchmarks
+    import main
+    import server
+
+    n_failures = 0
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout):
+        for argv in [["--help"], ["frames", "--nonsense"]]:
+            response = server.handle_request(json.dumps({"id": 1, "args": argv}),
+                                             main.run_job)
+            if response["status"] != "error":
+                logging.warning(f"server request {argv}: {response}")
+                n_failures += 1
+    if stdout.getvalue():
+        logging.warning(f"server wrote to stdout: {stdout.getvalue()!r}")
+        n_failures += 1
+
+    scrollshot = benchmarks.generate_scrollshot(6, 600, 500, 200, 20, 30, "down", 0)
+    with tempfile.TemporaryDirectory() as folder:
+        frames_folder = os.path.join(folder, "frames")
+        os.mkdir(frames_folder)
+        benchmarks.write_scrollshot(scrollshot, frames_folder)
+        output_filename = os.path.join(folder, "joined.png")
+        request = {"id": 2, "args": [frames_folder, "-o", output_filename]}
+        response = server.handle_request(json.dumps(request), main.run_job)
+        if response["status"] != "ok":
+            logging.warning(f"server request {request}: {response}")
+            n_failures += 1
+        elif not np.array_equal(iio.image_to_np(iio.load_image(output_filename)),
+                                cj.join_frames(scrollshot.frames).image):
+            logging.warning("server join differs from chat_joiner")
+            n_failures += 1
+    print(f"server test: {n_failures} requests failed")
+    return 0 if n_failures == 0 else 1
+
+
+def test_output_formats() -> int:
+    """
+    Check that PNG output written in strips and compressed in parallel decodes to
+    the composite of chat_joiner, and that RGBA images can be written as JPEG,
+    without their alpha channel.
+    """
+    # benchmarks and main import this module
+    import benchmarks
+    import main
+
+    n_failures = 0
+    scrollshot = benchmarks.generate_scrollshot(6, 600, 500, 200, 20, 30, "down", 0)
+    expected = cj.join_frames(scrollshot.frames).image
+    options = [[], ["--output_strip_height", "100"],
+               ["--output_strip_height", "100", "--encode_workers", "3"]]
+    with tempfile.TemporaryDirectory() as folder:
+        frames_folder = os.path.join(folder, "frames")
+        os.mkdir(frames_folder)
+        benchmarks.write_scrollshot(scrollshot, frames_folder)
+        output_filename = os.path.join(folder, "joined.png")
+        for option in options:
+            main.run_job([frames_folder, "-o", output_filename] + option)
+            if not np.array_equal(iio.image_to_np(iio.load_image(output_filename)),
+                                  expected):
+                logging.warning(f"PNG output with {option} differs from chat_joiner")
+                n_failures += 1
+
+    alpha = np.full(scrollshot.frames[0].shape[:2] + (1,), 255, dtype=np.uint8)
+    rgba_scrollshot = scrollshot._replace(
+        frames=[np.concatenate([frame, alpha], axis=2) for frame in scrollshot.frames])
+    with tempfile.TemporaryDirectory() as folder:
+        frames_folder = os.path.join(folder, "frames")
+        os.mkdir(frames_folder)
+        benchmarks.write_scrollshot(rgba_scrollshot, frames_folder)
+        for output_name, option in [("joined.jpg", []),
+                                    ("joined.png", ["--output_format", "jpeg"])]:
+            output_filename = os.path.join(folder, output_name)
+            main.run_job([frames_folder, "-o", output_filename] + option)
+            image = iio.load_image(output_filename)
+            if image.format != "JPEG" or image.mode != "RGB" \
+                    or image.size != (expected.shape[1], expected.shape[0]):
+                logging.warning(f"JPEG output {output_name} with {option} is a "
+                                + f"{image.format} {image.mode} image of {image.size}")
+                n_failures += 1
+    print(f"output formats test: {n_failures} outputs differ")
+    return 0 if n_failures == 0 else 1
+
+
+def test_watch_duplicates() -> int:
+    """
+    Check that --watch joins a folder of synthetic scrollshot frames, with runs of
+    near-duplicate frames, into the same image as chat_joiner, which keeps the
+    last frame of each run.
+    """
+    # benchmarks and main import this module
+    import benchmarks
+    import main
+
+    scrollshot = benchmarks.generate_scrollshot(6, 600, 500, 200, 20, 30, "down", 0)
+    frames = []
+    for i, frame in enumerate(scrollshot.frames):
+        frames.append(frame)
+        if i in (2, 5):
+            # A few rows change while scrolling is paused, as a blinking cursor
+            for value in (0, 255):
+                duplicate = frame.copy()
+                duplicate[300:306, 100:400] = value
+                frames.append(duplicate)
+    expected = cj.join_frames(frames).image
+
+    n_failures = 0
+    with tempfile.TemporaryDirectory() as folder:
+        frames_folder = os.path.join(folder, "frames")
+        os.mkdir(frames_folder)
+        benchmarks.write_scrollshot(scrollshot._replace(frames=frames), frames_folder)
+        output_filename = os.path.join(folder, "joined.png")
+        for option in [[], ["--watch"]]:
+            if option:
+                # All frames are written, and the folder join is done with them
+                open(os.path.join(frames_folder, "done"), "w").close()
+            main.run_job([frames_folder, "-o", output_filename] + option)
+            if not np.array_equal(iio.image_to_np(iio.load_image(output_filename)),
+                                  expected):
+                logging.warning(f"join of folder with {option} differs from "
+                                + "chat_joiner")
+                n_failures += 1
+    print(f"watch duplicates test: {n_failures} joins differ")
+    return 0 if n_failures == 0 else 1
+
+
+def test_duplicate_selection() -> int:
+    """
+    Check that runs of duplicate and near-duplicate frames anywhere in a synthetic
+    scrollshot are reduced to the last frame of each run, so the scrollshot joins
+    into the same image and offsets as without them.
+    """
+    # benchmarks imports this module
+    import benchmarks
+
+    scrollshot = benchmarks.generate_scrollshot(8, 600, 500, 200, 20, 30, "down", 0)
+    # Index of the scrollshot frame of each frame, with runs of duplicates at the
+    # start, in the middle and at the end
+    frame_sources = [0, 0, 0, 1, 2, 2, 3, 4, 4, 5, 6, 7, 7]
+    frames = [scrollshot.frames[i].copy() for i in frame_sources]
+    # A near-duplicate that differs in a few rows, as a blinking cursor
+    frames[7][300:306, 100:400] = 0
+
+    n_failures = 0
+    expected_indices = [i for i in range(len(frame_sources))
+                        if i + 1 == len(frame_sources)
+                        or frame_sources[i + 1] != frame_sources[i]]
+    distinct_indices = ip.find_distinct_crop_images(frames, 0.9)
+    if distinct_indices != expected_indices:
+        logging.warning(f"distinct frames {distinct_indices}, expected "
+                        + f"{expected_indices}")
+        n_failures += 1
+
+    expected = cj.join_frames(scrollshot.frames)
+    result = cj.join_frames(frames)
+    if not np.array_equal(result.offsets, expected.offsets) \
+            or not np.array_equal(result.image, expected.image):
+        logging.warning(f"join with duplicates has offsets {result.offsets.tolist()}, "
+                        + f"expected {expected.offsets.tolist()}")
+        n_failures += 1
+    print(f"duplicate selection test: {n_failures} selections differ")
+    return 0 if n_failures == 0 else 1
+
+
+def test_exact_match(n_seeds: int = 2) -> int:
+    """
+    Check that the exact match of the row hashes joins synthetic scrollshots,
+    scrolled down and up, as searching the match scores of all offsets with
+    --no-exact_match does. Image pairs with a single exact match must be joined
+    at it, and pairs whose rows match at several offsets fall back to the search.
+    """
+    # benchmarks imports this module
+    import benchmarks
+
+    scrollshots = [benchmarks.generate_scrollshot(8, 600, 500, 200, 20, 30,
+                                                  direction, seed)
+                   for seed in range(n_seeds) for direction in ["down", "up"]]
+    n_failures = count_different_joins("exact match",
+                                       [scrollshot.frames for scrollshot in scrollshots],
+                                       exact_match=False)
+    config = cj.create_config()
+    n_exact_pairs = 0
+    for scrollshot in scrollshots:
+        result = cj.join_frames(scrollshot.frames)
+        scored = cj.join_frames(scrollshot.frames, exact_match=False)
+        if not np.allclose(result.scores, scored.scores):
+            logging.warning(f"exact match scores {result.scores.tolist()}, expected "
+                            + f"{scored.scores.tolist()}")
+            n_failures += 1
+        crop_images = [ip.crop_image_by_indices(scrollshot.frames[i], result.crop_indices)
+                       for i in result.frame_indices]
+        features = ifeat.compute_frame_features(crop_images,
+                                                config.n_cols_in_crop,
+                                                config.left_crop_from,
+                                                config.left_crop_to,
+                                                config.right_crop_from,
+                                                config.right_crop_to)
+        for i, offset in enumerate(result.offsets):
+            exact_offsets = im.find_exact_offsets(features, i + 1, i,
+                                                  config.n_rows_in_crop)
+            if len(exact_offsets) == 1:
+                n_exact_pairs += 1
+                if exact_offsets[0] != offset:
+                    logging.warning(f"pair {i} joined at {offset}, exact match at "
+                                    + f"{exact_offsets[0]}")
+                    n_failures += 1
+    if n_exact_pairs == 0:
+        logging.warning("no image pair has a single exact match")
+        n_failures += 1
+    print(f"exact match test: {n_failures} joins differ, {n_exact_pairs} pairs "
+          + "matched exactly")
+    return 0 if n_failures == 0 else 1
+
+def test_decimate(seeds: Sequence[int] = (1, 3)) -> int:
+    """
+    Check that --decimate joins slowly scrolled synthetic scrollshots, scrolled
+    down and up, into the same image as joining every frame, from fewer frames.
+    Slow scrolling repeats the rows of the synthetic chat at many shifts, so the
+    seeds are those whose exhaustive offsets are the generated ones.
+    """
+    # benchmarks imports this module
+    import benchmarks
+
+    n_failures = 0
+    for seed in seeds:
+        for direction in ["down", "up"]:
+            scrollshot = benchmarks.generate_scrollshot(16, 600, 500, 60, 10, 30,
+                                                        direction, seed)
+            expected = cj.join_frames(scrollshot.frames)
+            result = cj.join_frames(scrollshot.frames, decimate=True)
+            if not np.array_equal(expected.offsets, scrollshot.offsets):
+                logging.warning(f"exhaustive offsets differ from {scrollshot.offsets}")
+                n_failures += 1
+            if result.crop_direction != expected.crop_direction \
+                    or len(result.frame_indices) >= len(expected.frame_indices) \
+                    or not np.array_equal(result.image, expected.image):
+                logging.warning(f"decimated join of seed {seed} {direction}: "
+                                + f"direction {result.crop_direction}, frames "
+                                + f"{result.frame_indices.tolist()}, expected "
+                                + f"{expected.crop_direction}")
+                n_failures += 1
+    print(f"decimate test: {n_failures} joins differ")
+    return 0 if n_failures == 0 else 1
+
+
+def test_work_dir(n_seeds: int = 2) -> int:
+    """
+    Check that --work_dir joins synthetic scrollshots, scrolled down and up, out
+    of core in chunks of a small memory budget, and with --watch, into the same
+    image as joining them in memory, and that the work files are removed.
+    """
+    # benchmarks and main import this module
+    import benchmarks
+    import main
+
+    scrollshots = [benchmarks.generate_scrollshot(8, 600, 500, 200, 20, 30,
+                                                  direction, seed)
+                   for seed in range(n_seeds) for direction in ["down", "up"]]
+    with tempfile.TemporaryDirectory() as folder:
+        work_dir = os.path.join(folder, "work")
+        n_failures = count_different_joins("work_dir",
+                                           [scrollshot.frames
+                                            for scrollshot in scrollshots],
+                                           work_dir=work_dir, memory_budget=1)
+
+        for i, scrollshot in enumerate(scrollshots):
+            frames_folder = os.path.join(folder, f"frames_{i}")
+            os.mkdir(frames_folder)
+            benchmarks.write_scrollshot(scrollshot, frames_folder)
+            open(os.path.join(frames_folder, "done"), "w").close()
+            output_filename = os.path.join(folder, "joined.png")
+            main.run_job([frames_folder, "-o", output_filename, "--watch",
+                          "--work_dir", work_dir])
+            if not np.array_equal(iio.image_to_np(iio.load_image(output_filename)),
+                                  cj.join_frames(scrollshot.frames).image):
+                logging.warning(f"watched join {i} with work_dir differs from "
+                                + "chat_joiner")
+                n_failures += 1
+
+        if os.listdir(work_dir):
+            logging.warning(f"work files left in {work_dir}: {os.listdir(work_dir)}")
+            n_failures += 1
+    print(f"work_dir test: {n_failures} joins differ")
+    return 0 if n_failures == 0 else 1
+
+
+def encode_raw_frame(frame: np.ndarray, padding: int) -> bytes:
+    """
+    Encode a frame as a raw frame, see image_utils/raw_frames.py, with padding
+    bytes after each row.
+    """
+    height, width, channels = frame.shape
+    rows = np.zeros((height, width * channels + padding), dtype=np.uint8)
+    rows[:, :width * channels] = frame.reshape(height, -1)
+    return rf.FRAME_HEADER.pack(rf.FRAME_MAGIC, width, height, rows.shape[1],
+                                channels) + rows.tobytes()
+
+
+def test_raw_frames() -> int:
+    """
+    Check that synthetic scrollshot frames given to main.py as raw frames with
+    padded rows, over stdin, with --watch, and in shared memory as RGBA, are
+    joined into the same image as by chat_joiner.
+    """
+    # benchmarks imports this module
+    import benchmarks
+
+    scrollshot = benchmarks.generate_scrollshot(6, 600, 500, 200, 20, 30, "down", 0)
+    alpha = np.full(scrollshot.frames[0].shape[:2] + (1,), 255, dtype=np.uint8)
+    rgba_frames = [np.concatenate([frame, alpha], axis=2)
+                   for frame in scrollshot.frames]
+    main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+    n_failures = 0
+    with tempfile.TemporaryDirectory() as folder:
+        output_filename = os.path.join(folder, "joined.png")
+        stream = b"".join(encode_raw_frame(frame, 16) for frame in scrollshot.frames)
+        for option in [[], ["--watch"]]:
+            subprocess.run([sys.executable, main_path, "--raw_frames", rf.STDIN_SOURCE,
+                            "-o", output_filename] + option,
+                           input=stream, check=True)
+            if not np.array_equal(iio.image_to_np(iio.load_image(output_filename)),
+                                  cj.join_frames(scrollshot.frames).image):
+                logging.warning(f"join of raw frames from stdin with {option} "
+                                + "differs from chat_joiner")
+                n_failures += 1
+
+        data = b"".join(encode_raw_frame(frame, 16) for frame in rgba_frames)
+        shm = shared_memory.SharedMemory(create=True, size=len(data))
+        try:
+            shm.buf[:len(data)] = data
+            subprocess.run([sys.executable, main_path, "--raw_frames", shm.name,
+                            "-o", output_filename], check=True)
+        finally:
+            shm.close()
+            shm.unlink()
+        if not np.array_equal(iio.image_to_np(iio.load_image(output_filename)),
+                              cj.join_frames(rgba_frames).image):
+            logging.warning("join of RGBA raw frames in shared memory differs from "
+                            + "chat_joiner")
+            n_failures += 1
+    print(f"raw frames test: {n_failures} joins differ")
+    return 0 if n_failures == 0 else 1
+
+
+def test_video_frames(ffmpeg: str = "ffmpeg") -> int:
+    """
+    Check that the frames of a synthetic scroll recording, with pauses in which
+    the same frame is repeated, are reduced to the frames that scrolled, and that
+    the recording is joined with --video into the same image as those frames by
+    chat_joiner. The video is only written and decoded if ffmpeg is found.
+    """
+    # benchmarks and main import this module
+    import benchmarks
+    import main
+
+    scrollshot = benchmarks.generate_scrollshot(6, 600, 500, 200, 20, 30, "down", 0)
+    recording = [frame for frame in scrollshot.frames for _ in range(3)]
+    expected = cj.join_frames(scrollshot.frames).image
+
+    n_failures = 0
+    frames = list(vf.skip_unchanged_frames(recording, 1.0))
+    if len(frames) != len(scrollshot.frames) \
+            or not np.array_equal(cj.join_frames(frames).image, expected):
+        logging.warning(f"{len(frames)} frames of the recording were kept, expected "
+                        + f"{len(scrollshot.frames)}")
+        n_failures += 1
+
+    if shutil.which(ffmpeg) is None:
+        print(f"video frames test: {n_failures} joins differ, {ffmpeg} not found, "
+              + "video not decoded")
+        return 0 if n_failures == 0 else 1
+    with tempfile.TemporaryDirectory() as folder:
+        # Uncompressed, so the decoded frames are the recorded ones
+        video_path = os.path.join(folder, "recording.nut")
+        height, width = recording[0].shape[:2]
+        subprocess.run([ffmpeg, "-v", "error", "-f", "rawvideo", "-pix_fmt", "rgb24",
+                        "-s", f"{width}x{height}", "-r", "30", "-i", "-",
+                        "-c:v", "rawvideo", video_path],
+                       input=b"".join(frame.tobytes() for frame in recording),
+                       check=True)
+        output_filename = os.path.join(folder, "joined.png")
+        main.run_job(["--video", video_path, "--ffmpeg", ffmpeg,
+                      "-o", output_filename])
+        if not np.array_equal(iio.image_to_np(iio.load_image(output_filename)),
+                              expected):
+            logging.warning("join of the video differs from chat_joiner")
+            n_failures += 1
+    print(f"video frames test: {n_failures} joins differ")
+    return 0 if n_failures == 0 else 1
+
+
+def test_phase(n_seeds: int = 2) -> int:
+    """
+    Check that --search_mode phase joins synthetic scrollshots, scrolled down and
+    up, as the default exhaustive search does, and that it recovers the offsets
+    and column shifts of scrollshots whose content also moved sideways, which the
+    exhaustive search cannot join, in batch and with --watch.
+    """
+    # benchmarks and main import this module
+    import benchmarks
+    import main
+
+    scrollshots = [benchmarks.generate_scrollshot(8, 900, 800, 200, 20, 40,
+                                                  direction, seed)
+                   for seed in range(n_seeds) for direction in ["down", "up"]]
+    n_failures = count_different_joins("phase",
+                                       [scrollshot.frames for scrollshot in scrollshots],
+                                       search_mode="phase")
+
+    with tempfile.TemporaryDirectory() as folder:
+        for i in range(len(scrollshots)):
+            seed, direction = divmod(i, 2)
+            scrollshot = benchmarks.generate_scrollshot(8, 900, 800, 200, 20, 40,
+                                                        ["down", "up"][direction],
+                                                        seed, column_jitter=12)
+            result = cj.join_frames(scrollshot.frames, search_mode="phase")
+            expected_offsets, expected_column_shifts = \
+                benchmarks.find_expected_shifts(scrollshot, result)
+            if not np.array_equal(result.offsets, expected_offsets) \
+                    or not np.array_equal(result.column_shifts, expected_column_shifts):
+                logging.warning(f"phase offsets {result.offsets.tolist()} and column "
+                                + f"shifts {result.column_shifts.tolist()}, expected "
+                                + f"{expected_offsets.tolist()} and "
+                                + f"{expected_column_shifts.tolist()}")
+                n_failures += 1
+
+            frames_folder = os.path.join(folder, f"frames_{i}")
+            os.mkdir(frames_folder)
+            benchmarks.write_scrollshot(scrollshot, frames_folder)
+            open(os.path.join(frames_folder, "done"), "w").close()
+            output_filename = os.path.join(folder, "joined.png")
+            # The content moves sideways, so the crop boundary is found from all
+            # images, as without --watch
+            main.run_job([frames_folder, "-o", output_filename, "--watch",
+                          "--search_mode", "phase",
+                          "--boundary_frames", str(len(scrollshot.frames))])
+            if not np.array_equal(iio.image_to_np(iio.load_image(output_filename)),
+                                  result.image):
+                logging.warning(f"watched phase join {i} differs from chat_joiner")
+                n_failures += 1
+    print(f"phase test: {n_failures} joins differ")
+    return 0 if n_failures == 0 else 1
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(max(test_search_window(), test_boundary_scale(), test_kernel_parity(),
+                 test_phase_low_overlap(), test_server(),
+                 test_output_formats(), test_watch_duplicates(),
+                 test_duplicate_selection(), test_exact_match(), test_decimate(),
+                 test_work_dir(), test_raw_frames(), test_video_frames(),
+                 test_phase()))